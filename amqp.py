@@ -0,0 +1,143 @@
+import collections
+import logging
+import os
+import threading
+import time
+import pika
+import metrics
+
+"""
+Resilient RabbitMQ connection shared by the watcher and its consumers.
+
+One background thread owns the pika BlockingConnection: it connects lazily, reconnects with
+exponential backoff, keeps heartbeats going and drains a bounded outbox of messages. Other
+threads only ever append to the outbox, so publishing never blocks on the broker and messages
+published during an outage are delivered once the broker is back (up to `outboxsize` of them).
+"""
+
+log = logging.getLogger('amqp')
+
+def parametersfromenv():
+    credentials = pika.PlainCredentials(os.getenv("MQRABBIT_USER"), os.getenv("MQRABBIT_PASSWORD"))
+    return pika.ConnectionParameters(
+        host=os.getenv("MQRABBIT_HOST"),
+        virtual_host=os.getenv("MQRABBIT_VHOST", "/"),
+        port=os.getenv("MQRABBIT_PORT"),
+        credentials=credentials,
+        heartbeat=int(os.getenv("MQRABBIT_HEARTBEAT", 60)))
+
+class AmqpConnection:
+    def __init__(self, parameters=None, outboxsize=1000, minbackoff=1, maxbackoff=60) -> None:
+        self.parameters = parameters
+        self.outbox = collections.deque()
+        self.outboxsize = outboxsize
+        self.minbackoff = minbackoff
+        self.maxbackoff = maxbackoff
+        self.confirm = False
+        self.setups = []
+        self.resynclisteners = []
+        self.dropped = 0
+        self.connected = False
+        self.lock = threading.Lock()
+        self.thread = None
+        self.connection = None
+        self.channel = None
+
+    def start(self):
+        """Start the I/O thread; the connection itself is made by that thread."""
+        with self.lock:
+            if self.thread is None:
+                if self.parameters is None:
+                    self.parameters = parametersfromenv()
+                self.thread = threading.Thread(target=self._run, name='amqp', daemon=True)
+                self.thread.start()
+        return self
+
+    def onconnect(self, setup):
+        """Register `setup(channel)`, run on every (re)connect to declare exchanges, queues and consumers."""
+        self.setups.append(setup)
+        return self
+
+    def onresync(self, listener):
+        """Register `listener()`, called after a reconnect when outbox messages had to be dropped."""
+        self.resynclisteners.append(listener)
+        return self
+
+    def exchange_declare(self, exchange, exchange_type='fanout'):
+        return self.onconnect(lambda channel: channel.exchange_declare(exchange=exchange, exchange_type=exchange_type))
+
+    def confirm_delivery(self):
+        """Use publisher confirms; unconfirmed messages stay in the outbox and are retried."""
+        self.confirm = True
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        with self.lock:
+            if len(self.outbox) >= self.outboxsize:
+                self.outbox.popleft()
+                self.dropped += 1
+                metrics.dropped_messages.labels('amqp').inc()
+                log.warning("Outbox full, dropped oldest message (%d dropped so far)", self.dropped)
+            self.outbox.append((exchange, routing_key, body, properties))
+            metrics.amqp_outbox.set(len(self.outbox))
+        self.start()
+
+    def run_forever(self):
+        """For consumer processes: run the I/O loop in the current thread."""
+        if self.parameters is None:
+            self.parameters = parametersfromenv()
+        self.thread = threading.current_thread()
+        self._run()
+
+    def _connect(self):
+        self.connection = pika.BlockingConnection(self.parameters)
+        self.channel = self.connection.channel()
+        if self.confirm:
+            self.channel.confirm_delivery()
+        for setup in self.setups:
+            setup(self.channel)
+        self.connected = True
+        metrics.amqp_connected.set(1)
+        log.info("Connected to %s", self.parameters.host)
+
+    def _disconnect(self):
+        self.connected = False
+        metrics.amqp_connected.set(0)
+        try:
+            if self.connection and self.connection.is_open:
+                self.connection.close()
+        except Exception:
+            pass
+        self.connection = None
+        self.channel = None
+
+    def _drain(self):
+        while True:
+            with self.lock:
+                if not self.outbox:
+                    return
+                exchange, routing_key, body, properties = self.outbox[0]
+            with metrics.amqp_publish_seconds.time():
+                self.channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body, properties=properties)
+            with self.lock:
+                if self.outbox and self.outbox[0][2] is body:
+                    self.outbox.popleft()
+                metrics.amqp_outbox.set(len(self.outbox))
+
+    def _run(self):
+        backoff = self.minbackoff
+        while True:
+            try:
+                if not self.connected:
+                    self._connect()
+                    backoff = self.minbackoff
+                    if self.dropped:
+                        self.dropped = 0
+                        for listener in self.resynclisteners:
+                            listener()
+                self._drain()
+                self.connection.process_data_events(time_limit=0.2)
+            except Exception as exc:
+                log.warning("AMQP connection problem: %s. Retrying in %s seconds", exc, backoff)
+                self._disconnect()
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.maxbackoff)
@@ -0,0 +1,168 @@
+import logging
+import math
+import time
+
+"""
+Streaming anomaly detection on the printer snapshots. Every poll of a printing printer updates a
+few numbers per printer, in constant time and memory:
+
+- stall: progress and z-height have not moved for `stalltime` seconds;
+- thermal: for nozzle and bed, an EWMA of the deviation from the target temperature and of its
+  variance, counted from the moment the target has been steady for `settle` seconds so the heat
+  up does not skew it. The printer is flagged when the average deviation exceeds the tolerance,
+  or when one reading jumps more than `zscore` standard deviations away from it while outside
+  the tolerance.
+
+Each anomaly is reported once when it starts and once when it clears while still printing. When
+the print ends, or the printer stops answering, its alerts are dropped without a message: the
+print job messages already say so, and "back to normal" would be wrong.
+"""
+
+log = logging.getLogger('anomaly')
+
+DEFAULTS = {
+    # Printers report progress in whole percents, and one percent of a long print takes minutes
+    'stalltime': 600,
+    'settle': 300,
+    'alpha': 0.3,
+    'zscore': 4,
+    'nozzletolerance': 10,
+    'bedtolerance': 5,
+    'fastpoll': 10,
+}
+
+DESCRIPTIONS = {
+    'stall': "Print stalled",
+    'nozzle': "Nozzle temperature off target",
+    'bed': "Bed temperature off target",
+}
+
+class Ewma:
+    __slots__ = ('alpha', 'mean', 'var', 'n')
+
+    def __init__(self, alpha) -> None:
+        self.alpha = alpha
+        self.mean = 0.0
+        self.var = 0.0
+        self.n = 0
+
+    def update(self, value):
+        if self.n == 0:
+            self.mean = value
+        else:
+            diff = value - self.mean
+            increment = self.alpha * diff
+            self.mean += increment
+            self.var = (1 - self.alpha) * (self.var + diff * increment)
+        self.n += 1
+
+class Heater:
+    __slots__ = ('target', 'since', 'deviation')
+
+    def __init__(self, target, since) -> None:
+        self.target = target
+        self.since = since
+        # Created once the heater has settled
+        self.deviation = None
+
+class PrinterMonitor:
+    __slots__ = ('position', 'lastadvance', 'heaters', 'alerts')
+
+    def __init__(self) -> None:
+        self.position = None
+        self.lastadvance = None
+        self.heaters = {}
+        self.alerts = set()
+
+    def reset(self):
+        self.position = None
+        self.lastadvance = None
+        self.heaters.clear()
+
+class AnomalyDetector:
+    def __init__(self, settings=None, clock=time.monotonic) -> None:
+        self.settings = { **DEFAULTS, **(settings or {}) }
+        self.clock = clock
+        self.monitors = {}
+
+    def config(self, m):
+        return { **self.settings, **m.get('anomaly', {}) }
+
+    def observe(self, m, state, now=None):
+        """Feed a new snapshot of printer `m`; returns [(kind, message, started)] for anomalies that started or cleared."""
+        now = self.clock() if now is None else now
+        config = self.config(m)
+        monitor = self.monitors.setdefault(m['printer'], PrinterMonitor())
+
+        found = {}
+        if state.get('printstate') == 'printing':
+            stall = self._stall(monitor, state, now, config)
+            if stall:
+                found['stall'] = stall
+            for heater in ('nozzle', 'bed'):
+                drift = self._thermal(monitor, heater, state, now, config)
+                if drift:
+                    found[heater] = drift
+        else:
+            monitor.reset()
+            if monitor.alerts:
+                log.info("%s is %s, dropping its alerts: %s", m['printer'], state.get('printstate'), ", ".join(sorted(monitor.alerts)))
+                monitor.alerts = set()
+            return []
+
+        changes = []
+        for kind in found.keys() - monitor.alerts:
+            log.warning("%s on %s: %s", DESCRIPTIONS[kind], m['printer'], found[kind])
+            changes.append((kind, f"<b>{DESCRIPTIONS[kind]} on {m['printer']}</b>\n{found[kind]}", True))
+        for kind in monitor.alerts - found.keys():
+            log.info("%s on %s cleared", DESCRIPTIONS[kind], m['printer'])
+            changes.append((kind, f"<b>{DESCRIPTIONS[kind]} on {m['printer']}</b>\nBack to normal", False))
+        monitor.alerts = set(found)
+        return changes
+
+    def _stall(self, monitor, state, now, config):
+        position = (state.get('progress'), state.get('z-height'))
+        if position != monitor.position or monitor.lastadvance is None:
+            monitor.position = position
+            monitor.lastadvance = now
+            return None
+        stalled = now - monitor.lastadvance
+        if stalled < config['stalltime']:
+            return None
+        progress = (state.get('progress') or 0) * 100
+        return f"No progress for {stalled / 60:.0f} minutes, at {progress:.1f}% and z-height {state.get('z-height')}"
+
+    def _thermal(self, monitor, heater, state, now, config):
+        actual = (state.get('temperature') or {}).get(heater)
+        target = (state.get('targettemperature') or {}).get(heater)
+        if not isinstance(actual, (int, float)) or not isinstance(target, (int, float)) or target <= 0:
+            monitor.heaters.pop(heater, None)
+            return None
+
+        track = monitor.heaters.get(heater)
+        if track is None or track.target != target:
+            # New target: the heater needs time to get there before deviations mean anything
+            track = Heater(target, now)
+            monitor.heaters[heater] = track
+        if now - track.since < config['settle']:
+            return None
+        if track.deviation is None:
+            track.deviation = Ewma(config['alpha'])
+        deviation = actual - target
+        previousmean, previousstd = track.deviation.mean, math.sqrt(track.deviation.var)
+        seen = track.deviation.n
+        track.deviation.update(deviation)
+
+        tolerance = config[f'{heater}tolerance']
+        if abs(track.deviation.mean) > tolerance:
+            return f"{actual}\U000000B0 against a target of {target}\U000000B0, {track.deviation.mean:+.1f}\U000000B0 on average"
+        if seen >= 5 and abs(deviation) > tolerance and abs(deviation - previousmean) > config['zscore'] * max(previousstd, 0.5):
+            return f"{actual}\U000000B0 against a target of {target}\U000000B0, a sudden jump of {deviation - previousmean:+.1f}\U000000B0"
+        return None
+
+    def active(self, name):
+        monitor = self.monitors.get(name)
+        return bool(monitor and monitor.alerts)
+
+    def forget(self, name):
+        self.monitors.pop(name, None)
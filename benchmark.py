@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import random
+import resource
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+"""
+Benchmark and load simulation for the watcher.
+
+Runs local stand-ins for everything the watcher talks to: PrusaLink (legacy and v1 API) and
+OctoPrint printers including the DisplayLayerProgress plugin, WLED and ESP32-cam light controllers,
+camera snapshots and the Telegram Bot API, plus an in-process stand-in for the AMQP connection.
+Every simulated printer listens on its own loopback address (127.1.x.y, Linux only) so one server
+can tell them apart. Then it drives watcher.main_loop for a number of cycles and reports cycle
+time, per-printer poll latency (p50/p99), CPU time and RSS.
+
+    python benchmark.py --printers 100 --latency 50 --failure-rate 0.02 --offline 0.05 --cycles 10
+
+With --max-cycle the script exits non-zero when the slowest cycle is slower than the given number
+of seconds, so it can guard against regressions.
+"""
+
+JPEG = bytes.fromhex(
+    'ffd8ffe000104a46494600010100000100010000ffdb004300080606070605080707070909080a0c140d0c0b0b0c1912'
+    '130f141d1a1f1e1d1a1c1c20242e2720222c231c1c2837292c30313434341f27393d38323c2e333432ffc0000b0800'
+    '01000101011100ffc4001f0000010501010101010100000000000000000102030405060708090a0bffc400b5100002'
+    '010303020403050504040000017d01020300041105122131410613516107227114328191a1082342b1c11552d1f024'
+    '33627282090a161718191a25262728292a3435363738393a434445464748494a535455565758595a63646566676869'
+    '6a737475767778797a838485868788898a92939495969798999aa2a3a4a5a6a7a8a9aab2b3b4b5b6b7b8b9bac2c3c4'
+    'c5c6c7c8c9cad2d3d4d5d6d7d8d9dae1e2e3e4e5e6e7e8e9eaf1f2f3f4f5f6f7f8f9faffda0008010100003f00fbd3'
+    'ffd9')
+
+def address(index):
+    return f"127.1.{index // 250}.{index % 250 + 1}"
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def rss():
+    """Current resident set size in MiB."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class FakePrinter:
+    """A printer that alternates between printing a job of `jobseconds` and idling for `idleseconds`."""
+
+    def __init__(self, index, api, firmware, jobseconds, idleseconds, offline) -> None:
+        self.index = index
+        self.api = api
+        self.firmware = firmware
+        self.jobseconds = jobseconds
+        self.idleseconds = idleseconds
+        self.offline = offline
+        self.offset = random.uniform(0, jobseconds + idleseconds)
+        self.started = time.monotonic()
+
+    def phase(self):
+        t = (time.monotonic() - self.started + self.offset) % (self.jobseconds + self.idleseconds)
+        printing = t < self.jobseconds
+        done = t if printing else 0
+        left = self.jobseconds - t if printing else 0
+        return printing, done, left
+
+    def temperatures(self, printing):
+        jitter = random.uniform(-0.3, 0.3)
+        return (60 + jitter if printing else 25 + jitter), (215 + jitter if printing else 30 + jitter), (60 if printing else 0), (215 if printing else 0)
+
+    def route(self, path):
+        printing, done, left = self.phase()
+        bed, nozzle, targetbed, targetnozzle = self.temperatures(printing)
+        progress = done / self.jobseconds if printing else 0
+        name = f"job{self.index}.gcode"
+
+        if path.startswith('/api/version'):
+            return { 'api': '2.0.0' if self.firmware == 'v1' else '0.1', 'server': '2.1.2', 'text': 'fake' }
+
+        if self.api == 'prusalink':
+            if path.startswith('/api/v1/status'):
+                status = { 'printer': { 'state': 'PRINTING' if printing else 'IDLE', 'temp_bed': bed, 'target_bed': targetbed,
+                                        'temp_nozzle': nozzle, 'target_nozzle': targetnozzle, 'axis_z': round(progress * 40, 2) } }
+                if printing:
+                    status['job'] = { 'id': int(self.started + self.offset) % 1000, 'progress': progress * 100,
+                                      'time_remaining': int(left), 'time_printing': int(done) }
+                return status
+            if path.startswith('/api/v1/job'):
+                return { 'file': { 'name': name, 'display_name': name } } if printing else None
+            if path.startswith('/api/printer'):
+                return { 'telemetry': { 'temp-bed': bed, 'temp-nozzle': nozzle, 'z-height': round(progress * 40, 2) },
+                         'temperature': { 'bed': { 'actual': bed, 'target': targetbed }, 'tool0': { 'actual': nozzle, 'target': targetnozzle } } }
+            if path.startswith('/api/job'):
+                return { 'state': 'Printing' if printing else 'Operational',
+                         'job': { 'estimatedPrintTime': self.jobseconds, 'file': { 'name': name } },
+                         'progress': { 'completion': progress, 'printTime': int(done), 'printTimeLeft': int(left) } }
+        else:
+            if path.startswith('/api/printer'):
+                return { 'state': { 'flags': { 'printing': printing } },
+                         'temperature': { 'bed': { 'actual': bed, 'target': targetbed }, 'tool0': { 'actual': nozzle, 'target': targetnozzle } } }
+            if path.startswith('/api/job'):
+                return { 'job': { 'file': { 'name': name } },
+                         'progress': { 'completion': progress * 100, 'printTime': int(done), 'printTimeLeft': int(left) } }
+            if path.startswith('/api/connection'):
+                return { 'current': { 'state': 'Printing' if printing else 'Operational' } }
+            if path.startswith('/plugin/DisplayLayerProgress/values'):
+                return { 'height': { 'current': round(progress * 40, 2) }, 'layer': { 'current': int(progress * 200), 'total': 200 } }
+        return None
+
+class FakeFarm(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, printers, latency, jitter, failurerate, port=0) -> None:
+        self.printers = { address(p.index): p for p in printers }
+        self.latency = latency
+        self.jitter = jitter
+        self.failurerate = failurerate
+        self.counts = {}
+        self.countlock = threading.Lock()
+        super().__init__(('', port), FakeHandler)
+
+    def count(self, what):
+        with self.countlock:
+            self.counts[what] = self.counts.get(what, 0) + 1
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body=b'', contenttype='application/json', headers={}):
+        self.send_response(status)
+        self.send_header('Content-Type', contenttype)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _json(self, data):
+        if data is None:
+            self._reply(204)
+        else:
+            self._reply(200, json.dumps(data).encode())
+
+    def _delay(self):
+        server = self.server
+        delay = server.latency + random.uniform(0, server.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _handle(self):
+        server = self.server
+        if 'Content-Length' in self.headers:
+            self.rfile.read(int(self.headers['Content-Length']))
+
+        if self.path.startswith('/bot'):
+            server.count('telegram')
+            self._json({ 'ok': True, 'result': {} })
+            return
+        if self.path.startswith('/snapshot'):
+            server.count('snapshot')
+            self._delay()
+            self._reply(200, JPEG, 'image/jpeg')
+            return
+        if self.path.startswith('/json/state') or self.path.startswith('/control') or self.path.startswith('/status'):
+            server.count('lights')
+            self._json({ 'on': False, 'bri': 128, 'lamp': 0 })
+            return
+
+        printer = server.printers.get(self.connection.getsockname()[0])
+        if printer is None:
+            self._reply(404)
+            return
+        server.count('printer')
+        if printer.offline:
+            # Looks like a dead printer: the connection just goes away
+            self.close_connection = True
+            self.connection.close()
+            return
+        self._delay()
+        if random.random() < server.failurerate:
+            server.count('failure')
+            self._reply(503)
+            return
+        data = printer.route(self.path)
+        if data is None:
+            self._reply(204)
+            return
+        body = json.dumps(data).encode()
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            server.count('notmodified')
+            self._reply(304, headers={ 'ETag': etag })
+            return
+        self._reply(200, body, headers={ 'ETag': etag })
+
+    do_GET = _handle
+    do_POST = _handle
+
+class FakeChannel:
+    """In-process stand-in for amqp.AmqpConnection that only counts what is published."""
+
+    def __init__(self) -> None:
+        self.outboxsize = 1000
+        self.published = 0
+        self.bytes = 0
+        self.seconds = 0
+
+    def confirm_delivery(self):
+        pass
+
+    def onresync(self, listener):
+        return self
+
+    def start(self):
+        return self
+
+    def basic_publish(self, exchange, routing_key, body):
+        started = time.perf_counter()
+        self.published += 1
+        self.bytes += len(body)
+        self.seconds += time.perf_counter() - started
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test watcher.main_loop against simulated printers.")
+    parser.add_argument('--printers', type=int, default=40, help="number of simulated printers (1-500)")
+    parser.add_argument('--octoprint', type=float, default=0.25, help="fraction of printers that speak OctoPrint")
+    parser.add_argument('--firmware', choices=['legacy', 'v1'], default='legacy', help="PrusaLink API the fake printers offer")
+    parser.add_argument('--latency', type=float, default=20, help="printer response latency in ms")
+    parser.add_argument('--jitter', type=float, default=10, help="extra random latency in ms")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="fraction of printer requests answered with 503")
+    parser.add_argument('--offline', type=float, default=0.0, help="fraction of printers that drop every connection")
+    parser.add_argument('--cycles', type=int, default=5)
+    parser.add_argument('--interval', type=float, default=0, help="seconds between cycles")
+    parser.add_argument('--job-seconds', type=float, default=30)
+    parser.add_argument('--idle-seconds', type=float, default=15)
+    parser.add_argument('--workers', type=int, default=None, help="poller threads (default: as in the watcher)")
+    parser.add_argument('--polltimeout', type=float, default=5)
+    parser.add_argument('--json', help="also write the report to this file")
+    parser.add_argument('--max-cycle', type=float, help="exit with status 1 when a cycle takes longer than this")
+    args = parser.parse_args()
+
+    if not 1 <= args.printers <= 500:
+        parser.error("--printers must be between 1 and 500")
+
+    printers = []
+    for i in range(args.printers):
+        api = 'octoprint' if i < round(args.printers * args.octoprint) else 'prusalink'
+        offline = random.random() < args.offline
+        printers.append(FakePrinter(i, api, args.firmware, args.job_seconds, args.idle_seconds, offline))
+
+    farm = FakeFarm(printers, args.latency / 1000, args.jitter / 1000, args.failure_rate)
+    port = farm.server_address[1]
+    threading.Thread(target=farm.serve_forever, name='fakefarm', daemon=True).start()
+
+    import logsetup
+    logsetup.setup({ 'file': None, 'consolelevel': 'WARNING', 'level': 'WARNING' })
+    # Cameras, lights and Telegram all live on 127.0.0.1 here, which overflows that host's pool
+    logging.getLogger('urllib3.connectionpool').setLevel(logging.ERROR)
+
+    import watcher
+    from notifier import TelegramDispatcher
+    from publisher import DeltaPublisher
+    from snapshots import SnapshotService
+    import concurrent.futures
+
+    channel = FakeChannel()
+    watcher.channel = channel
+    watcher.publisher = DeltaPublisher(channel, 'bench', default=watcher.jsonserializer)
+    watcher.dispatcher = TelegramDispatcher('token', 'chat', batchwindow=0.1, apiurl=f'http://127.0.0.1:{port}')
+    watcher.snapshotservice = SnapshotService(warmup=0)
+
+    settings = []
+    for p in printers:
+        m = { 'printer': f'printer{p.index}', 'api': p.api, 'key': 'key', 'statusinterval': 60,
+              'camera': { 'url': f'http://127.0.0.1:{port}/snapshot{p.index % 8}.jpg',
+                          'lights': { 'controller': 'WLEDController', 'arguments': f'127.0.0.1:{port}' } } }
+        if p.api == 'prusalink':
+            m.update(host=address(p.index), port=port)
+        else:
+            m.update(url=f'http://{address(p.index)}:{port}', layerplugin=True)
+        settings.append(m)
+
+    globalsettings = { 'interval': args.interval, 'cooldowntimeout': 30, 'cooldowntemperature': 35, 'polltimeout': args.polltimeout }
+    workers = args.workers or min(32, len(settings))
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='poller')
+    state = watcher.init_states(settings)
+
+    latencies = []
+    originalpoll = watcher.poll
+    def timedpoll(m, timeout):
+        started = time.perf_counter()
+        try:
+            return originalpoll(m, timeout)
+        finally:
+            latencies.append(time.perf_counter() - started)
+    watcher.poll = timedpoll
+
+    cycles = []
+    cpustart = time.process_time()
+    wallstart = time.perf_counter()
+    for _ in range(args.cycles):
+        started = time.perf_counter()
+        watcher.main_loop(state=state, settings=settings, globalsettings=globalsettings, executor=executor, workers=workers)
+        cycles.append(time.perf_counter() - started)
+        time.sleep(args.interval)
+    wall = time.perf_counter() - wallstart
+    cpu = time.process_time() - cpustart
+    # Let the last notifications go out before the fake servers go away
+    watcher.dispatcher.join(timeout=60)
+
+    report = {
+        'printers': args.printers,
+        'workers': workers,
+        'cycles': len(cycles),
+        'cycle_seconds': { 'min': min(cycles), 'mean': statistics.mean(cycles), 'max': max(cycles) },
+        'poll_seconds': { 'p50': percentile(latencies, 0.5), 'p99': percentile(latencies, 0.99), 'max': max(latencies, default=0) },
+        'cpu_seconds': cpu,
+        'cpu_fraction': cpu / wall if wall else 0,
+        'rss_mib': rss(),
+        'requests': dict(farm.counts),
+        'amqp': { 'published': channel.published, 'bytes': channel.bytes },
+        'states': { s: sum(1 for v in state.values() if v['printstate'] == s) for s in ('printing', 'idle', 'unknown') },
+    }
+
+    print(f"{report['printers']} printers, {report['workers']} workers, {report['cycles']} cycles")
+    print(f"cycle time   min {report['cycle_seconds']['min']:.3f}s  mean {report['cycle_seconds']['mean']:.3f}s  max {report['cycle_seconds']['max']:.3f}s")
+    print(f"poll latency p50 {report['poll_seconds']['p50'] * 1000:.1f}ms  p99 {report['poll_seconds']['p99'] * 1000:.1f}ms")
+    print(f"cpu          {report['cpu_seconds']:.2f}s ({report['cpu_fraction'] * 100:.0f}% of wall time)")
+    print(f"rss          {report['rss_mib']:.1f} MiB")
+    print(f"requests     {report['requests']}")
+    print(f"amqp         {report['amqp']}")
+    print(f"states       {report['states']}")
+
+    if args.json:
+        with open(args.json, 'w') as outfile:
+            json.dump(report, outfile, indent=2)
+
+    farm.shutdown()
+    if args.max_cycle is not None and report['cycle_seconds']['max'] > args.max_cycle:
+        print(f"Slowest cycle {report['cycle_seconds']['max']:.3f}s exceeds --max-cycle {args.max_cycle}s")
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
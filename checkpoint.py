@@ -0,0 +1,71 @@
+import json
+import logging
+import os
+import tempfile
+from datetime import datetime
+
+"""
+On-disk checkpoint of the per-printer state machine, so a restart picks up where the previous
+process left off instead of announcing every running job as newly started. Only the fields that
+drive the state machine are kept, one small JSON file per printer, and a file is only rewritten
+(atomically, through a temporary file and a rename) when its fields actually changed.
+"""
+
+log = logging.getLogger('checkpoint')
+
+FIELDS = ('printstate', 'lastsend', 'cooldowntimeout', 'jobname')
+DATETIMES = ('lastsend', 'cooldowntimeout')
+
+def encode(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+class StateCheckpoint:
+    def __init__(self, directory) -> None:
+        self.directory = directory
+        self.saved = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, printer):
+        return os.path.join(self.directory, f"{printer}.json")
+
+    def load(self, printer):
+        """Return the checkpointed fields for `printer`, or an empty dict."""
+        try:
+            with open(self._path(printer), "r") as infile:
+                saved = json.load(infile)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as exc:
+            log.warning("Ignoring unreadable checkpoint for %s: %s", printer, exc)
+            return {}
+
+        self.saved[printer] = saved
+        state = dict(saved)
+        for field in DATETIMES:
+            if field in state:
+                state[field] = datetime.fromisoformat(state[field])
+        return state
+
+    def update(self, printer, state):
+        """Write the checkpoint for `printer` if its state machine fields changed since the last write."""
+        fields = { field: encode(state[field]) for field in FIELDS if field in state }
+        if self.saved.get(printer) == fields:
+            return False
+
+        fd, temppath = tempfile.mkstemp(dir=self.directory, prefix=f".{printer}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as outfile:
+                json.dump(fields, outfile)
+            os.replace(temppath, self._path(printer))
+        except Exception:
+            os.unlink(temppath)
+            raise
+        self.saved[printer] = fields
+        return True
+
+    def remove(self, printer):
+        self.saved.pop(printer, None)
+        try:
+            os.remove(self._path(printer))
+        except FileNotFoundError:
+            pass
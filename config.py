@@ -0,0 +1,70 @@
+import logging
+import os
+
+"""
+Watching of the settings file. A Kubernetes ConfigMap mount replaces the file through a symlink
+swap, so besides the modification time the inode is compared too. A file that no longer parses
+is ignored until it is fixed, and so is one the optional `validate` callable reports problems
+with; the last good settings stay in effect.
+"""
+
+log = logging.getLogger('config')
+
+def load(path):
+    # PyYAML is the slowest import of the watcher, so it is only paid for when there is a file to read
+    import yaml
+    with open(path, "r") as settingsfile:
+        try:
+            settings = yaml.safe_load(settingsfile)
+        except yaml.YAMLError as exc:
+            raise ValueError(f"not valid YAML: {exc}") from exc
+    if not isinstance(settings, dict) or not isinstance(settings.get('settings'), dict) or not isinstance(settings.get('printers'), list):
+        raise ValueError("settings file needs a 'settings' mapping and a 'printers' list")
+    for i, m in enumerate(settings['printers']):
+        if not isinstance(m, dict):
+            raise ValueError(f"printer #{i + 1} must be a mapping, not {type(m).__name__}")
+    names = [m.get('printer') for m in settings['printers']]
+    if len(set(names)) != len(names):
+        raise ValueError("printer names must be unique")
+    return settings
+
+def diffprinters(old, new):
+    """Compare two printers lists by name; returns the added, removed and changed printer configs."""
+    before = { m['printer']: m for m in old }
+    after = { m['printer']: m for m in new }
+    added = [m for name, m in after.items() if name not in before]
+    removed = [m for name, m in before.items() if name not in after]
+    changed = [m for name, m in after.items() if name in before and before[name] != m]
+    return added, removed, changed
+
+class ConfigWatcher:
+    def __init__(self, path, validate=None) -> None:
+        self.path = path
+        self.validate = validate
+        self.signature = self._signature()
+
+    def _signature(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def changed(self):
+        """Return the new settings when the file changed and still parses, None otherwise."""
+        signature = self._signature()
+        if signature is None or signature == self.signature:
+            return None
+        self.signature = signature
+        try:
+            settings = load(self.path)
+            problems = self.validate(settings) if self.validate else []
+        except Exception as exc:
+            # Whatever is wrong with the new file, the watcher keeps running on the old settings
+            log.error("Ignoring changed settings in %s: %s", self.path, exc)
+            return None
+        if problems:
+            log.error("Ignoring changed settings in %s: %s", self.path, "; ".join(problems))
+            return None
+        log.info("Settings in %s changed", self.path)
+        return settings
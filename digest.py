@@ -0,0 +1,122 @@
+import io
+import logging
+import threading
+import time
+from datetime import datetime
+import sessions
+
+try:
+    from PIL import Image, ImageDraw
+except ImportError:
+    Image = None
+
+"""
+Fleet digest. Instead of a routine status message per printer every `statusinterval`, the printers
+that are printing or cooling down are summarized in one table every `interval` seconds, optionally
+together with a contact sheet of their camera snapshots. Starts, ends and final cool downs are
+still sent per printer by the watcher. With sharding every replica sends the digest of its own
+printers, labelled and keyed with its `shard` name so the leader does not replace one replica's
+digest with another's.
+"""
+
+log = logging.getLogger('digest')
+
+def formatduration(seconds):
+    seconds = int(seconds or 0)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02}"
+
+def formattemperature(state, name):
+    actual = (state.get('temperature') or {}).get(name)
+    return "-" if actual is None else f"{actual:.0f}"
+
+class FleetDigest:
+    def __init__(self, interval=600, contactsheet=False, columns=3, thumbwidth=320, snapshot=None, shard=None, clock=time.time) -> None:
+        self.interval = interval
+        self.shard = shard
+        self.contactsheet = contactsheet and Image is not None
+        self.columns = columns
+        self.thumbwidth = thumbwidth
+        self.snapshot = snapshot
+        self.clock = clock
+        self.active = {}
+        self.lastsent = clock()
+        self.lock = threading.Lock()
+        if contactsheet and Image is None:
+            log.warning("Pillow is not installed, sending digests without contact sheet")
+
+    def update(self, m, state):
+        """Remember the latest state of printer `m`; only printing and cooling printers are listed."""
+        with self.lock:
+            if state['printstate'] == 'printing' or 'cooldowntimeout' in state:
+                self.active[m['printer']] = (m, state)
+            else:
+                self.active.pop(m['printer'], None)
+
+    def remove(self, name):
+        with self.lock:
+            self.active.pop(name, None)
+
+    def table(self, entries):
+        lines = [f"{'Printer':<12} {'%':>5} {'Left':>5} {'Z':>6} {'Noz':>4} {'Bed':>4}"]
+        for m, state in entries:
+            if state['printstate'] == 'printing':
+                progress = f"{(state.get('progress') or 0) * 100:5.1f}"
+                left = formatduration(state.get('stillprinting'))
+            else:
+                progress, left = " cool", ""
+            lines.append(f"{m['printer'][:12]:<12} {progress:>5} {left:>5} {str(state.get('z-height', ''))[:6]:>6} "
+                         f"{formattemperature(state, 'nozzle'):>4} {formattemperature(state, 'bed'):>4}")
+        return "\n".join(lines)
+
+    def maybesend(self, send):
+        """Send the digest through `send(message, picture=None, key=None)` when it is due."""
+        now = self.clock()
+        if now - self.lastsent < self.interval:
+            return False
+        self.lastsent = now
+        with self.lock:
+            entries = sorted(self.active.values(), key=lambda entry: entry[0]['printer'])
+        if not entries:
+            return False
+
+        sent = datetime.fromtimestamp(now).strftime('%H:%M')
+        label, suffix = (f" ({self.shard})", f":{self.shard}") if self.shard else ("", "")
+        header = f"<b>Fleet status{label} {sent}: {len(entries)} active</b>\n"
+        send(header + f"<pre>{self.table(entries)}</pre>", key=f"digest{suffix}")
+        cameras = [m for m, _ in entries if 'camera' in m]
+        if self.contactsheet and cameras and self.snapshot:
+            send(f"<b>Fleet cameras{label} {sent}</b>",
+                 picture=lambda: self.compose(cameras), key=f"digest-cameras{suffix}")
+        return True
+
+    def compose(self, printers):
+        """Capture the cameras of `printers` in parallel and lay them out in a labelled grid."""
+        pictures = sessions.parallel(*[lambda m=m: self._thumbnail(m) for m in printers], pool='digest')
+        thumbnails = [(m['printer'], p) for m, p in zip(printers, pictures) if p is not None]
+        if not thumbnails:
+            return None
+
+        cellheight = max(p.height for _, p in thumbnails)
+        columns = min(self.columns, len(thumbnails))
+        rows = (len(thumbnails) + columns - 1) // columns
+        sheet = Image.new('RGB', (columns * self.thumbwidth, rows * cellheight), 'black')
+        draw = ImageDraw.Draw(sheet)
+        for i, (name, picture) in enumerate(thumbnails):
+            x, y = (i % columns) * self.thumbwidth, (i // columns) * cellheight
+            sheet.paste(picture, (x, y))
+            draw.rectangle((x, y, x + 8 + 7 * len(name), y + 16), fill='black')
+            draw.text((x + 4, y + 2), name, fill='white')
+        output = io.BytesIO()
+        sheet.save(output, format='JPEG', quality=80, optimize=True)
+        return output.getvalue()
+
+    def _thumbnail(self, m):
+        try:
+            content = self.snapshot(m['camera'])
+            if not content:
+                return None
+            picture = Image.open(io.BytesIO(content)).convert('RGB')
+            return picture.resize((self.thumbwidth, round(picture.height * self.thumbwidth / picture.width)))
+        except Exception as exc:
+            log.warning("No snapshot of %s for the contact sheet: %s", m['printer'], exc)
+            return None
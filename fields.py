@@ -0,0 +1,82 @@
+"""
+Field extraction for printer API responses. Each protocol declares the fields it needs as paths
+into the raw response documents, with a default and an optional conversion. An Extractor resolves
+all of them in one pass straight into a PrinterSnapshot, without wrapping or copying the
+intermediate dicts.
+"""
+
+MISSING = object()
+
+class Field:
+    __slots__ = ('paths', 'default', 'convert')
+
+    def __init__(self, *path, default=None, convert=None, alternatives=()) -> None:
+        """`path` is a sequence of keys; `alternatives` are further paths tried in order when it is missing."""
+        self.paths = (tuple(path),) + tuple(tuple(p) for p in alternatives)
+        self.default = default
+        self.convert = convert
+
+def resolve(document, path, default=None):
+    value = document
+    for key in path:
+        try:
+            value = value[key]
+        except (KeyError, IndexError, TypeError):
+            return default
+    return default if value is None else value
+
+class PrinterSnapshot:
+    """Normalized printer status, as produced by every protocol."""
+
+    __slots__ = ('printstate', 'bed', 'nozzle', 'targetbed', 'targetnozzle', 'zheight',
+                 'fulljobtime', 'alreadyprinted', 'stillprinting', 'progress', 'jobname')
+
+    def __init__(self, **values) -> None:
+        for name in self.__slots__:
+            setattr(self, name, values.get(name))
+
+    def asstate(self):
+        """The snapshot in the state dict layout used by the state machine and the exchange."""
+        return {
+            'printstate': self.printstate,
+            'temperature': {
+                'bed': self.bed,
+                'nozzle': self.nozzle,
+            },
+            'targettemperature': {
+                'bed': self.targetbed,
+                'nozzle': self.targetnozzle,
+            },
+            'z-height': self.zheight,
+            'fulljobtime': self.fulljobtime,
+            'alreadyprinted': self.alreadyprinted,
+            'stillprinting': self.stillprinting,
+            'progress': self.progress,
+            'jobname': self.jobname,
+        }
+
+class Extractor:
+    def __init__(self, **fields) -> None:
+        unknown = set(fields) - set(PrinterSnapshot.__slots__)
+        if unknown:
+            raise ValueError(f"Unknown snapshot fields: {', '.join(sorted(unknown))}")
+        self.fields = tuple((name, f.paths, f.default, f.convert) for name, f in fields.items())
+
+    def extract(self, document):
+        """Resolve every declared field against `document` and return a PrinterSnapshot."""
+        snapshot = PrinterSnapshot()
+        for name, paths, default, convert in self.fields:
+            value = MISSING
+            for path in paths:
+                value = resolve(document, path, MISSING)
+                if value is not MISSING:
+                    break
+            if value is MISSING:
+                value = default
+            if convert is not None:
+                try:
+                    value = convert(value)
+                except (TypeError, ValueError):
+                    value = default
+            setattr(snapshot, name, value)
+        return snapshot
@@ -0,0 +1,174 @@
+#!/bin/env -S python -u
+
+import argparse
+import concurrent.futures
+import fnmatch
+import hashlib
+import logging
+import os
+import threading
+import yaml
+from prusalink import prusalink
+
+"""
+Bulk G-code distribution to PrusaLink printers. The same file is uploaded to many printers in
+parallel, at most `concurrency` at a time, each upload streamed from disk. A printer that already
+has the file (same hash when its listing reports one, same name and size otherwise) is skipped.
+
+PrintQueue feeds printers from a directory, <directory>/<printer>/*.gcode: when the watcher sees
+a printer idle and cooled down, the next file in its directory is uploaded (and started when
+`autostart` is set) and moved to the done/ subdirectory.
+
+Run as a script to push a file to printers from the settings file:
+    jobs.py part.gcode 'mk4-*' mini --start
+"""
+
+log = logging.getLogger('jobs')
+
+def findfile(listing, name, size, digest):
+    """Look for a file in a get_files() listing, walking the folders."""
+    entries = list(listing.get('files', []))
+    while entries:
+        entry = entries.pop()
+        entries.extend(entry.get('children', []))
+        if name not in (entry.get('name'), entry.get('display')):
+            continue
+        if 'hash' in entry:
+            if entry['hash'] == digest:
+                return entry
+        elif entry.get('size') == size:
+            return entry
+    return None
+
+class JobDispatcher:
+    def __init__(self, clientfor, concurrency=4, maxage=60) -> None:
+        """`clientfor(m)` returns the prusalink client for printer config `m`."""
+        self.clientfor = clientfor
+        self.maxage = maxage
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='upload')
+        self.digests = {}
+        self.uploaded = {}
+        self.lock = threading.Lock()
+
+    def digest(self, path):
+        st = os.stat(path)
+        key = (path, st.st_mtime_ns, st.st_size)
+        with self.lock:
+            if key in self.digests:
+                return self.digests[key]
+        sha = hashlib.sha256()
+        with open(path, 'rb') as infile:
+            for chunk in iter(lambda: infile.read(1024 * 1024), b''):
+                sha.update(chunk)
+        with self.lock:
+            self.digests[key] = sha.hexdigest()
+        return self.digests[key]
+
+    def upload(self, m, path, start=False):
+        """Upload `path` to printer `m` unless it is already there, and start it when asked."""
+        name = os.path.basename(path)
+        size = os.path.getsize(path)
+        digest = self.digest(path)
+        client = self.clientfor(m)
+
+        with self.lock:
+            known = self.uploaded.get((m['printer'], name)) == digest
+        if known or findfile(client.list_files(maxage=self.maxage), name, size, digest):
+            log.info("%s already has %s", m['printer'], name)
+            result = 'skipped'
+        else:
+            reported = [0]
+            def progress(sent, total):
+                if sent * 10 // total > reported[0]:
+                    reported[0] = sent * 10 // total
+                    log.info("Uploading %s to %s: %d%%", name, m['printer'], reported[0] * 10)
+            r = client.post_gcode(path, progress=progress)
+            r.raise_for_status()
+            with self.lock:
+                self.uploaded[(m['printer'], name)] = digest
+            result = 'uploaded'
+
+        if start:
+            r = client.post_print_gcode('/local/' + name)
+            r.raise_for_status()
+            log.info("Started %s on %s", name, m['printer'])
+            result += ' and started'
+        return result
+
+    def distribute(self, printers, path, start=False):
+        """Upload `path` to all `printers` in parallel; returns a Future per printer name."""
+        return { m['printer']: self.executor.submit(self.upload, m, path, start) for m in printers }
+
+class PrintQueue:
+    def __init__(self, dispatcher, directory, autostart=False, extensions=('.gcode', '.bgcode')) -> None:
+        self.dispatcher = dispatcher
+        self.directory = directory
+        self.autostart = autostart
+        self.extensions = extensions
+        self.staged = {}
+        self.inflight = {}
+
+    def nextjob(self, printer):
+        folder = os.path.join(self.directory, printer)
+        try:
+            names = sorted(name for name in os.listdir(folder) if name.endswith(self.extensions))
+        except FileNotFoundError:
+            return None
+        return os.path.join(folder, names[0]) if names else None
+
+    def observe(self, m, state):
+        """Called with every new state; hands the next job to a printer that is idle and cooled down."""
+        printer = m['printer']
+        if state['printstate'] == 'printing':
+            self.staged.pop(printer, None)
+            return
+        if state['printstate'] != 'idle' or 'cooldowntimeout' in state or printer in self.staged:
+            return
+        future = self.inflight.get(printer)
+        if future and not future.done():
+            return
+        path = self.nextjob(printer)
+        if path:
+            self.inflight[printer] = self.dispatcher.executor.submit(self._dispatch, m, path)
+
+    def _dispatch(self, m, path):
+        try:
+            result = self.dispatcher.upload(m, path, start=self.autostart)
+        except Exception as exc:
+            log.warning("Could not hand %s to %s: %s", path, m['printer'], exc)
+            return
+        # Until the printer is seen printing, it gets nothing else
+        self.staged[m['printer']] = os.path.basename(path)
+        done = os.path.join(os.path.dirname(path), 'done')
+        os.makedirs(done, exist_ok=True)
+        os.replace(path, os.path.join(done, os.path.basename(path)))
+        log.info("%s %s on %s", os.path.basename(path), result, m['printer'])
+
+def main():
+    parser = argparse.ArgumentParser(description="Upload a G-code file to PrusaLink printers from the settings file.")
+    parser.add_argument('file', help="G-code file to upload")
+    parser.add_argument('printers', nargs='+', help="printer names or name patterns")
+    parser.add_argument('--start', action='store_true', help="start printing after the upload")
+    parser.add_argument('--concurrency', type=int, default=4, help="uploads running at the same time")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(message)s')
+    with open(os.getenv('INPUTFILE'), "r") as settingsfile:
+        settings = yaml.safe_load(settingsfile)
+    printers = [m for m in settings['printers'] if m['api'] == 'prusalink'
+                and any(fnmatch.fnmatchcase(m['printer'], pattern) for pattern in args.printers)]
+    if not printers:
+        parser.error("no PrusaLink printers match")
+
+    dispatcher = JobDispatcher(lambda m: prusalink(m['host'], m['key'], port=m.get('port', 80)), concurrency=args.concurrency)
+    failed = 0
+    for printer, future in dispatcher.distribute(printers, args.file, start=args.start).items():
+        try:
+            print(f"{printer}: {future.result()}")
+        except Exception as exc:
+            failed += 1
+            print(f"{printer}: failed, {exc}")
+    raise SystemExit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,5 @@
 from abc import abstractmethod, ABCMeta
-import requests
+import sessions
 
 class LightController(metaclass=ABCMeta):
     @abstractmethod
@@ -20,10 +20,11 @@ class WLEDController(LightController):
         super().__init__()
         self.address = address
         self.base = f"http://{address}/json"
+        self.session = sessions.getsession(address)
 
     def _postdata(self, data):
         setstate = f"{self.base}/state"
-        r = requests.post(setstate, json=data, headers={"Content-Type": "application/json"})
+        r = self.session.post(setstate, json=data, headers={"Content-Type": "application/json"})
         return r
 
     def lights(self, status):
@@ -31,7 +32,7 @@ class WLEDController(LightController):
 
     def getstate(self):
         getstate = f"{self.base}/state"
-        r = requests.get(url=getstate)
+        r = self.session.get(url=getstate)
         return r.json()
     
     def savestate(self):
@@ -46,15 +47,16 @@ class Esp32Cam(LightController):
         super().__init__()
         self.address = address
         self.base = f"http://{address}"
+        self.session = sessions.getsession(address)
 
     def lights(self, status):
         value = 100 if status else 0
         setlights = f"{self.base}/control?var=lamp&val={value}"
-        r = requests.get(url=setlights)
+        r = self.session.get(url=setlights)
     
     def getstate(self):
         getstate = f"{self.base}/status"
-        r = requests.get(url=getstate)
+        r = self.session.get(url=getstate)
         return r.json()
     
     def savestate(self):
@@ -63,7 +65,7 @@ class Esp32Cam(LightController):
 
     def restorestate(self):
         restorelights = f"{self.base}/control?var=lamp&val={self._savedstate['lamp']}"
-        r = requests.get(url=restorelights)
+        r = self.session.get(url=restorelights)
 
 
 def maintest():
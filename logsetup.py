@@ -0,0 +1,114 @@
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import threading
+import time
+
+"""
+Logging for the watcher processes. Records go through a queue to a background listener, are
+buffered in memory and flushed to a rotating (optionally gzip-compressed) JSON-lines file in
+batches, so the polling threads never wait for disk I/O and the log cannot grow without bound.
+"""
+
+DEFAULTS = {
+    'level': 'INFO',
+    'consolelevel': 'INFO',
+    'file': 'debuglog',
+    'maxbytes': 5 * 1024 * 1024,
+    'when': None,
+    'backupcount': 3,
+    'compress': True,
+    'bufferlines': 200,
+    'flushinterval': 5,
+}
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; structured payloads passed as extra={'data': ...} are kept as-is."""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if hasattr(record, 'data'):
+            entry['data'] = record.data
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+def debuglog(logger, message, data=None):
+    """Log a structured payload at DEBUG, without copying it when DEBUG is off."""
+    if logger.isEnabledFor(logging.DEBUG):
+        # Copy, the record is serialized later by the log listener thread
+        logger.debug(message, extra={ 'data': dict(data) if isinstance(data, dict) else data })
+
+def gznamer(name):
+    return name + '.gz'
+
+def gzrotator(source, dest):
+    with open(source, 'rb') as infile, gzip.open(dest, 'wb') as outfile:
+        shutil.copyfileobj(infile, outfile)
+    os.remove(source)
+
+class PeriodicFlush(threading.Thread):
+    """Flushes the memory buffer every `interval` seconds so quiet periods still reach the file."""
+
+    def __init__(self, handler, interval) -> None:
+        super().__init__(name='logflush', daemon=True)
+        self.handler = handler
+        self.interval = interval
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.handler.flush()
+
+def filehandler(config):
+    if config['when']:
+        handler = logging.handlers.TimedRotatingFileHandler(config['file'], when=config['when'], backupCount=config['backupcount'])
+    else:
+        handler = logging.handlers.RotatingFileHandler(config['file'], maxBytes=config['maxbytes'], backupCount=config['backupcount'])
+    if config['compress']:
+        handler.namer = gznamer
+        handler.rotator = gzrotator
+    handler.setFormatter(JsonFormatter())
+    handler.setLevel(config['level'])
+    return handler
+
+def setup(config=None):
+    """
+    Configure the root logger from the `logging` settings. The LOGLEVEL environment variable
+    overrides the configured file level. Returns the started QueueListener.
+    """
+    config = { **DEFAULTS, **(config or {}) }
+    config['level'] = os.getenv('LOGLEVEL', config['level']).upper()
+    config['consolelevel'] = config['consolelevel'].upper()
+
+    handlers = []
+    if config['file']:
+        buffered = logging.handlers.MemoryHandler(config['bufferlines'], flushLevel=logging.ERROR, target=filehandler(config))
+        buffered.setLevel(config['level'])
+        PeriodicFlush(buffered, config['flushinterval']).start()
+        handlers.append(buffered)
+
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    console.setLevel(config['consolelevel'])
+    handlers.append(console)
+
+    logqueue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(logqueue))
+    root.setLevel(min(logging.getLevelName(config['level']), logging.getLevelName(config['consolelevel'])))
+
+    listener = logging.handlers.QueueListener(logqueue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
@@ -0,0 +1,78 @@
+import logging
+import os
+import threading
+
+"""
+Prometheus metrics for the watcher and prusargb processes. Both serve /metrics on METRICSPORT
+when that environment variable is set.
+
+prometheus_client takes longer to import than the watcher needs to start, so it is only imported
+when a metric is first used or the server is started.
+"""
+
+log = logging.getLogger('metrics')
+
+_lock = threading.Lock()
+_declared = []
+
+class LazyMetric:
+    """Stands in for a prometheus_client metric and creates it on first use."""
+
+    def __init__(self, kind, *args, **kwargs) -> None:
+        self.kind = kind
+        self.args = args
+        self.kwargs = kwargs
+        self.metric = None
+        _declared.append(self)
+
+    def create(self):
+        with _lock:
+            if self.metric is None:
+                import prometheus_client
+                self.metric = getattr(prometheus_client, self.kind)(*self.args, **self.kwargs)
+        return self.metric
+
+    def __getattr__(self, name):
+        return getattr(self.metric or self.create(), name)
+
+def Counter(*args, **kwargs):
+    return LazyMetric('Counter', *args, **kwargs)
+
+def Gauge(*args, **kwargs):
+    return LazyMetric('Gauge', *args, **kwargs)
+
+def Histogram(*args, **kwargs):
+    return LazyMetric('Histogram', *args, **kwargs)
+
+LATENCY = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+poll_seconds = Histogram('printwatcher_poll_seconds', 'Time to fetch the status of one printer', ['protocol'], buckets=LATENCY)
+layerplugin_seconds = Histogram('printwatcher_layerplugin_seconds', 'Time to fetch DisplayLayerProgress data', buckets=LATENCY)
+cycle_seconds = Histogram('printwatcher_cycle_seconds', 'Duration of one polling cycle', buckets=LATENCY + (60, 120))
+telegram_seconds = Histogram('printwatcher_telegram_seconds', 'Time of one Telegram API call', ['method'], buckets=LATENCY)
+snapshot_seconds = Histogram('printwatcher_snapshot_seconds', 'Time to capture one camera snapshot', buckets=LATENCY)
+amqp_publish_seconds = Histogram('printwatcher_amqp_publish_seconds', 'Time of one AMQP basic_publish', buckets=LATENCY)
+
+timeouts = Counter('printwatcher_timeouts_total', 'Printer polls that missed their deadline', ['printer'])
+unknown_states = Counter('printwatcher_unknown_states_total', 'Polls that ended in printstate unknown', ['printer'])
+pushed_states = Counter('printwatcher_pushed_states_total', 'Polls answered from a push connection instead of HTTP', ['protocol'])
+dropped_messages = Counter('printwatcher_dropped_messages_total', 'Messages that were dropped', ['kind'])
+
+notification_backlog = Gauge('printwatcher_notification_backlog', 'Telegram messages waiting to be sent')
+amqp_outbox = Gauge('printwatcher_amqp_outbox', 'AMQP messages waiting in the outbox')
+amqp_connected = Gauge('printwatcher_amqp_connected', '1 when connected to the broker')
+
+consumed_messages = Counter('printwatcher_consumed_messages_total', 'Messages consumed from the state exchange')
+rejected_messages = Counter('printwatcher_rejected_messages_total', 'Consumed messages that could not be decoded')
+consumer_batch_size = Histogram('printwatcher_consumer_batch_size', 'Messages handled per consumer batch', buckets=(1, 2, 5, 10, 20, 50, 100, 200))
+
+def serve(port=None):
+    """Start the /metrics HTTP server on `port`, or on METRICSPORT when no port is given."""
+    port = port or os.getenv('METRICSPORT')
+    if port:
+        from prometheus_client import start_http_server
+        # Every metric shows up on /metrics, also the ones nothing has touched yet
+        for metric in _declared:
+            metric.create()
+        start_http_server(int(port))
+        log.info("Serving metrics on port %s", port)
@@ -0,0 +1,222 @@
+import json
+import threading
+import time
+import logging
+import zlib
+import sessions
+import metrics
+from urllib.parse import urlsplit
+
+"""
+Background Telegram dispatcher. Messages are queued per printer and sent by a small pool of
+worker threads, so polling never waits for Telegram or a camera. All messages for one printer go
+through the same worker, in the order they were submitted. Messages that arrive close together
+are merged into text messages and media groups, Telegram 429 responses are honored, and a queued
+routine update is replaced when a newer one for the same printer arrives. When a call to Telegram
+fails, the forced messages in it (starts, ends, alerts) are tried again; routine ones are dropped.
+"""
+
+log = logging.getLogger('notifier')
+
+MAXTEXT = 4096
+MAXCAPTION = 1024
+MAXGROUP = 10
+RETRIES = 3
+ERRORPAUSE = 5
+
+class notification:
+    def __init__(self, key, message, picture=None, force=False, done=None) -> None:
+        self.key = key
+        self.message = message
+        self.picture = picture
+        self.force = force
+        self.done = done
+        self.attempts = 0
+
+    def finish(self):
+        if self.done:
+            try:
+                self.done()
+            except Exception as exc:
+                log.warning("error finishing notification: %s", exc)
+
+class TelegramDispatcher:
+    def __init__(self, apitoken, chatid, workers=2, batchwindow=2, apiurl='https://api.telegram.org') -> None:
+        self.chatid = chatid
+        self.baseurl = f'{apiurl}/bot{apitoken}'
+        self.session = sessions.getsession(urlsplit(apiurl).netloc)
+        self.batchwindow = batchwindow
+        self.queues = [[] for _ in range(workers)]
+        self.pauseuntil = 0
+        self.lock = threading.Lock()
+        self.wakeups = [threading.Condition(self.lock) for _ in range(workers)]
+        # join() waits on its own condition, so a submit() never wakes it instead of a worker
+        self.drained = threading.Condition(self.lock)
+        self.dropped = 0
+        self.busy = 0
+        self.workers = [threading.Thread(target=self._run, args=(i,), name=f'notifier-{i}', daemon=True) for i in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def _worker(self, key):
+        # Alerts use '<printer>:<kind>' keys and go through the worker of their printer
+        return zlib.crc32(key.split(':')[0].encode()) % len(self.queues)
+
+    def _backlog(self):
+        metrics.notification_backlog.set(sum(len(pending) for pending in self.queues))
+
+    def submit(self, key, message, picture=None, force=False, done=None):
+        """
+        Queue a message for printer `key`. `picture` is either image bytes or a callable that
+        returns them; callables are only invoked by the worker that sends the message. A forced
+        message is always sent; a routine one replaces any routine message still queued for `key`.
+        `done()` is called once the message is out of the queue: sent, superseded or given up on.
+        """
+        index = self._worker(key)
+        superseded = []
+        with self.lock:
+            pending = self.queues[index]
+            if not force:
+                superseded = [n for n in pending if n.key == key and not n.force]
+                pending[:] = [n for n in pending if n.key != key or n.force]
+                self.dropped += len(superseded)
+                metrics.dropped_messages.labels('superseded').inc(len(superseded))
+            pending.append(notification(key, message, picture, force, done))
+            self._backlog()
+            self.wakeups[index].notify()
+        for n in superseded:
+            n.finish()
+
+    def join(self, timeout=None):
+        """Wait until everything queued so far has been sent. Returns False on timeout."""
+        with self.lock:
+            return self.drained.wait_for(lambda: not any(self.queues) and not self.busy, timeout)
+
+    def _take(self, index):
+        with self.lock:
+            while not self.queues[index]:
+                self.wakeups[index].wait()
+        # Give other printers changing state in the same cycle a moment to join the batch
+        time.sleep(self.batchwindow)
+        with self.lock:
+            batch, self.queues[index] = self.queues[index], []
+            self.busy += 1
+            self._backlog()
+        return batch
+
+    def _run(self, index):
+        while True:
+            batch = self._take(index)
+            retry = []
+            try:
+                retry = self.sendbatch(batch)
+            except Exception as exc:
+                log.exception(exc)
+            finally:
+                for n in batch:
+                    if n not in retry:
+                        n.finish()
+                with self.lock:
+                    # In front of anything newer for the same printers, to keep their order
+                    self.queues[index][:0] = retry
+                    self.busy -= 1
+                    self._backlog()
+                    self.drained.notify_all()
+
+    def sendbatch(self, batch):
+        """Send `batch` in submission order; returns the forced messages that have to be tried again."""
+        pictures = sessions.parallel(*[lambda n=n: self._picture(n) for n in batch], pool='notifier')
+        retry = []
+        group, text = [], []
+        for n, picture in zip(batch, pictures):
+            if picture:
+                if text:
+                    retry += self._sendtext(text)
+                    text = []
+                group.append((n, picture))
+                if len(group) == MAXGROUP:
+                    retry += self._sendpictures(group)
+                    group = []
+            else:
+                if group:
+                    retry += self._sendpictures(group)
+                    group = []
+                if text and sum(len(t.message) for t in text) + len(n.message) > MAXTEXT:
+                    retry += self._sendtext(text)
+                    text = []
+                text.append(n)
+        if group:
+            retry += self._sendpictures(group)
+        if text:
+            retry += self._sendtext(text)
+        return retry
+
+    def _sendpictures(self, group):
+        notifications = [n for n, _ in group]
+        if len(group) == 1:
+            n, picture = group[0]
+            return self._deliver(notifications, 'sendPhoto', params={
+                'chat_id': self.chatid,
+                'parse_mode': "HTML",
+                'caption': n.message[:MAXCAPTION] },
+                files={'photo': picture})
+        media = [{ 'type': 'photo', 'media': f'attach://photo{j}', 'caption': n.message[:MAXCAPTION], 'parse_mode': "HTML" }
+                 for j, (n, _) in enumerate(group)]
+        return self._deliver(notifications, 'sendMediaGroup', data={
+            'chat_id': self.chatid,
+            'media': json.dumps(media) },
+            files={f'photo{j}': picture for j, (_, picture) in enumerate(group)})
+
+    def _sendtext(self, notifications):
+        text = "".join(n.message for n in notifications)
+        return self._deliver(notifications, 'sendMessage', json={
+            'chat_id': self.chatid,
+            'parse_mode': "HTML",
+            'text': text[:MAXTEXT] })
+
+    def _deliver(self, notifications, method, **kwargs):
+        """Make one Telegram call for `notifications`; returns the forced ones to try again if it failed."""
+        try:
+            response = self._post(method, **kwargs)
+            if response.status_code == 429 or response.status_code >= 500:
+                problem = f"HTTP {response.status_code}"
+            else:
+                if response.status_code != 200:
+                    log.warning("Telegram refused %s: %s", method, response.text)
+                return []
+        except Exception as exc:
+            problem = exc
+        log.warning("Sending %d notification(s) failed: %s", len(notifications), problem)
+        self.pauseuntil = max(self.pauseuntil, time.monotonic() + ERRORPAUSE)
+        retry = [n for n in notifications if n.force and n.attempts < RETRIES]
+        for n in retry:
+            n.attempts += 1
+        with self.lock:
+            self.dropped += len(notifications) - len(retry)
+        metrics.dropped_messages.labels('telegram').inc(len(notifications) - len(retry))
+        return retry
+
+    def _picture(self, n):
+        try:
+            return n.picture() if callable(n.picture) else n.picture
+        except Exception as exc:
+            log.warning("error making picture: %s", exc)
+            return None
+
+    def _post(self, method, retries=3, **kwargs):
+        for _ in range(retries + 1):
+            wait = self.pauseuntil - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            with metrics.telegram_seconds.labels(method).time():
+                response = self.session.post(f'{self.baseurl}/{method}', **kwargs)
+            log.debug("response = [%s]", response.text)
+            if response.status_code != 429:
+                return response
+            try:
+                retryafter = response.json()['parameters']['retry_after']
+            except (ValueError, KeyError, TypeError):
+                retryafter = 5
+            log.warning("Telegram asks us to wait %s seconds", retryafter)
+            self.pauseuntil = max(self.pauseuntil, time.monotonic() + retryafter)
+        return response
@@ -0,0 +1,192 @@
+import json
+import logging
+import threading
+import time
+from urllib.parse import urlsplit
+import octorest
+import logsetup
+import metrics
+import sessions
+import sources
+from fields import Extractor, Field, resolve
+
+try:
+    import websocket
+except ImportError:
+    websocket = None
+
+"""
+OctoPrint protocol, for printers with `api: octoprint`. Loaded by sources.py the first time such a
+printer is configured. Printers with `push: true` follow the OctoPrint push API and only fall back
+to polling while the push connection is down or quiet.
+"""
+
+log = logging.getLogger('protocol_octoprint')
+
+REQUIRED = ('url', 'key')
+
+OCTOPRINT = Extractor(
+    printstate=Field('printer', 'state', 'flags', 'printing', convert=lambda p: 'printing' if p else 'idle'),
+    bed=Field('printer', 'temperature', 'bed', 'actual'),
+    nozzle=Field('printer', 'temperature', 'tool0', 'actual'),
+    targetbed=Field('printer', 'temperature', 'bed', 'target'),
+    targetnozzle=Field('printer', 'temperature', 'tool0', 'target'),
+    alreadyprinted=Field('job', 'progress', 'printTime', default=0),
+    stillprinting=Field('job', 'progress', 'printTimeLeft', default=0, convert=int),
+    progress=Field('job', 'progress', 'completion', default=0, convert=lambda p: p / 100),
+    jobname=Field('job', 'job', 'file', 'name', default='Unknown'),
+)
+
+OCTOPRINT_PUSH = Extractor(
+    printstate=Field('state', 'flags', 'printing', convert=lambda p: 'printing' if p else 'idle'),
+    bed=Field('temps', -1, 'bed', 'actual'),
+    nozzle=Field('temps', -1, 'tool0', 'actual'),
+    targetbed=Field('temps', -1, 'bed', 'target'),
+    targetnozzle=Field('temps', -1, 'tool0', 'target'),
+    zheight=Field('currentZ', default='unknown'),
+    alreadyprinted=Field('progress', 'printTime', default=0),
+    stillprinting=Field('progress', 'printTimeLeft', default=0, convert=int),
+    progress=Field('progress', 'completion', default=0, convert=lambda p: p / 100),
+    jobname=Field('job', 'file', 'name', default='Unknown'),
+)
+
+def poll(printerinfo, timeout=30):
+    def getlayerplugindata(client):
+        layer = f"{client.url}/plugin/DisplayLayerProgress/values"
+        session = client.__dict__['session']
+        
+        with metrics.layerplugin_seconds.time():
+            r = session.get(url=layer, timeout=timeout)
+        return r.json()
+
+    url = printerinfo['url']
+    key = printerinfo['key']
+
+    try:
+        # octorest sends its requests without a timeout, so the poll timeout goes on the session
+        session = sessions.getsession(f"octoprint:{url}", timeout=timeout)
+        client = sources.getclient(printerinfo, lambda: octorest.OctoRest(url=url, apikey=key, session=session))
+
+        calls = [client.job_info, client.printer]
+        if 'layerplugin' in printerinfo and printerinfo['layerplugin']:
+            calls.append(lambda: getlayerplugindata(client=client))
+        results = sessions.parallel(*calls)
+
+        document = { 'job': results[0], 'printer': results[1] }
+        logsetup.debuglog(log, f"Status of {printerinfo['printer']}", document)
+        snapshot = OCTOPRINT.extract(document)
+        snapshot.fulljobtime = snapshot.alreadyprinted + snapshot.stillprinting
+
+        snapshot.zheight = "unknown"
+        if len(results) > 2:
+            data = results[2]
+            logsetup.debuglog(log, f"Layer info of {printerinfo['printer']}", data)
+            height = resolve(data, ('height', 'current'))
+            layer = resolve(data, ('layer', 'current'))
+            total = resolve(data, ('layer', 'total'))
+            if height is not None and layer is not None and total is not None:
+                snapshot.zheight = f"{height} ({layer}/{total})"
+            elif height is not None:
+                snapshot.zheight = f"{height}"
+
+        state = snapshot.asstate()
+    except Exception as exc:
+        log.debug("No state from %s: %s", printerinfo['printer'], exc)
+        state = {
+            'printstate': 'unknown',
+        }
+    return state
+
+def decode(current):
+    """State dict from the payload of a push API 'current' message."""
+    snapshot = OCTOPRINT_PUSH.extract(current)
+    snapshot.fulljobtime = snapshot.alreadyprinted + snapshot.stillprinting
+    return snapshot.asstate()
+
+def source(m, poller, wake):
+    if not m.get('push'):
+        return sources.PollingSource(m, poller, wake)
+    return OctoPrintPushSource(m, poller, wake, staleafter=m.get('pushstaleafter', 30))
+
+class OctoPrintPushSource(sources.PollingSource):
+    """
+    Follows the OctoPrint push API on /sockjs/websocket and answers polls from the last pushed
+    state; pushed states older than `staleafter` seconds are not trusted.
+    """
+
+    def __init__(self, m, poller, wake=None, staleafter=30, backoff=5) -> None:
+        super().__init__(m, poller, wake)
+        self.staleafter = staleafter
+        self.backoff = backoff
+        self.latest = None
+        self.receivedat = 0
+        self.temps = []
+        self.app = None
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+
+    def start(self):
+        if websocket is None:
+            log.warning("websocket-client is not installed, polling %s instead", self.m['printer'])
+            return self
+        threading.Thread(target=self._run, name=f"push-{self.m['printer']}", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.app:
+            self.app.close()
+
+    def poll(self, timeout):
+        with self.lock:
+            latest, receivedat = self.latest, self.receivedat
+        if latest is not None and time.monotonic() - receivedat < self.staleafter:
+            metrics.pushed_states.labels(self.m['api']).inc()
+            return dict(latest)
+        return super().poll(timeout)
+
+    def _login(self):
+        """Get a session for the socket; the push API only sends printer data to authenticated clients."""
+        session = sessions.getsession(f"octoprint:{self.m['url']}")
+        r = session.post(f"{self.m['url']}/api/login", json={ 'passive': True }, headers={ 'X-Api-Key': self.m['key'] }, timeout=10)
+        r.raise_for_status()
+        user = r.json()
+        return f"{user['name']}:{user['session']}"
+
+    def _run(self):
+        parts = urlsplit(self.m['url'])
+        url = f"{'wss' if parts.scheme == 'https' else 'ws'}://{parts.netloc}{parts.path.rstrip('/')}/sockjs/websocket"
+        while not self.stopped.is_set():
+            try:
+                auth = self._login()
+                self.app = websocket.WebSocketApp(url,
+                                                  on_open=lambda ws: ws.send(json.dumps({ 'auth': auth })),
+                                                  on_message=self._message)
+                self.app.run_forever(ping_interval=30, ping_timeout=10)
+            except Exception as exc:
+                log.warning("Push connection to %s failed: %s", self.m['printer'], exc)
+            with self.lock:
+                self.latest = None
+            self.stopped.wait(self.backoff)
+
+    def _message(self, ws, message):
+        try:
+            data = json.loads(message)
+        except ValueError:
+            return
+        current = data.get('current')
+        if current is None:
+            return
+        # Temperatures only come along every now and then; keep the last ones in between
+        if current.get('temps'):
+            self.temps = current['temps']
+        else:
+            current['temps'] = self.temps
+        state = decode(current)
+        with self.lock:
+            previous = self.latest
+            self.latest = state
+            self.receivedat = time.monotonic()
+        if self.wake and (previous is None or previous['printstate'] != state['printstate']):
+            log.debug("%s pushed printstate %s", self.m['printer'], state['printstate'])
+            self.wake(self.m['printer'])
@@ -0,0 +1,66 @@
+import logging
+import requests
+import logsetup
+import sources
+from prusalink import prusalink
+from fields import Extractor, Field
+
+"""
+PrusaLink protocol, for printers with `api: prusalink`. Loaded by sources.py the first time such
+a printer is configured.
+"""
+
+log = logging.getLogger('protocol_prusalink')
+
+REQUIRED = ('host', 'key')
+
+PRUSALINK_LEGACY = Extractor(
+    printstate=Field('job', 'state', convert=lambda s: 'printing' if s == 'Printing' else 'idle'),
+    bed=Field('printer', 'telemetry', 'temp-bed'),
+    nozzle=Field('printer', 'telemetry', 'temp-nozzle'),
+    targetbed=Field('printer', 'temperature', 'bed', 'target'),
+    targetnozzle=Field('printer', 'temperature', 'tool0', 'target'),
+    zheight=Field('printer', 'telemetry', 'z-height'),
+    fulljobtime=Field('job', 'job', 'estimatedPrintTime'),
+    alreadyprinted=Field('job', 'progress', 'printTime', default=0),
+    stillprinting=Field('job', 'progress', 'printTimeLeft', default=0),
+    progress=Field('job', 'progress', 'completion', default=0),
+    jobname=Field('job', 'job', 'file', 'name', default='Unknown'),
+)
+
+PRUSALINK_V1 = Extractor(
+    printstate=Field('status', 'printer', 'state', convert=lambda s: 'printing' if s == 'PRINTING' else 'idle'),
+    bed=Field('status', 'printer', 'temp_bed'),
+    nozzle=Field('status', 'printer', 'temp_nozzle'),
+    targetbed=Field('status', 'printer', 'target_bed'),
+    targetnozzle=Field('status', 'printer', 'target_nozzle'),
+    zheight=Field('status', 'printer', 'axis_z'),
+    alreadyprinted=Field('status', 'job', 'time_printing', default=0),
+    stillprinting=Field('status', 'job', 'time_remaining', default=0),
+    progress=Field('status', 'job', 'progress', default=0, convert=lambda p: p / 100),
+    jobname=Field('job', 'file', 'display_name', default='Unknown', alternatives=[('job', 'file', 'name')]),
+)
+
+def client(printerinfo):
+    return sources.getclient(printerinfo, lambda: prusalink(printerinfo['host'], printerinfo['key'], port=printerinfo.get('port', 80)))
+
+def poll(printerinfo, timeout=30):
+    try:
+        prusa = client(printerinfo)
+        prusa.extraargs['timeout'] = timeout
+        status = prusa.get_status()
+
+        logsetup.debuglog(log, f"Status of {printerinfo['printer']}", status)
+
+        if status['api'] == 'v1':
+            snapshot = PRUSALINK_V1.extract(status)
+            snapshot.fulljobtime = snapshot.alreadyprinted + snapshot.stillprinting
+        else:
+            snapshot = PRUSALINK_LEGACY.extract(status)
+        state = snapshot.asstate()
+    except requests.exceptions.ConnectionError:
+        state = {
+            'printstate': 'unknown',
+        }
+
+    return state
@@ -1,7 +1,56 @@
 #!/usr/bin/python
 
-import requests
 import json
+import os
+import time
+import uuid
+import sessions
+
+class UploadBody:
+    """
+    Multipart body for a file upload that is read from disk as it is sent, so memory use stays at
+    one chunk whatever the file size. `progress(sent, total)` is called after every chunk.
+    """
+
+    def __init__(self, path, fieldname='file', filename=None, progress=None, chunksize=64 * 1024) -> None:
+        self.boundary = uuid.uuid4().hex
+        filename = filename or os.path.basename(path)
+        self.head = (f'--{self.boundary}\r\n'
+                     f'Content-Disposition: form-data; name="{fieldname}"; filename="{filename}"\r\n'
+                     'Content-Type: application/octet-stream\r\n\r\n').encode()
+        self.tail = f'\r\n--{self.boundary}--\r\n'.encode()
+        self.path = path
+        self.size = os.path.getsize(path)
+        self.progress = progress
+        self.chunksize = chunksize
+        self.sent = 0
+        self.file = None
+
+    @property
+    def contenttype(self):
+        return f'multipart/form-data; boundary={self.boundary}'
+
+    def __len__(self):
+        return len(self.head) + self.size + len(self.tail)
+
+    def __enter__(self):
+        self.file = open(self.path, 'rb')
+        return self
+
+    def __exit__(self, *exc):
+        self.file.close()
+
+    def read(self, size=-1):
+        if self.sent < len(self.head):
+            chunk = self.head[self.sent:]
+        else:
+            chunk = self.file.read(self.chunksize)
+            if not chunk:
+                chunk = self.tail[self.sent - len(self.head) - self.size:]
+        self.sent += len(chunk)
+        if self.progress and chunk:
+            self.progress(min(self.sent, len(self)), len(self))
+        return chunk
 
 class prusalink:
     """Wrapper for the PrusaLinkPy API.
@@ -15,22 +64,98 @@ class prusalink:
         self.api_key = api_key
         self.headers = {'X-Api-Key': api_key}
         self.extraargs = kwargs
+        self.base = 'http://' + self.host + ':' + self.port
+        self.session = sessions.getsession(self.host + ':' + self.port)
+        self.apiversion = None
+        self._jobid = None
+        self._job = None
+        self._cached = {}
+        self._listings = {}
         
+    def _get(self, path) :
+        """
+        GET with If-None-Match when an earlier answer carried an ETag. A 304 Not Modified is
+        answered with the earlier response, so an unchanged status costs no body transfer.
+        """
+        headers = self.headers
+        cached = self._cached.get(path)
+        if cached is not None:
+            headers = dict(self.headers, **{'If-None-Match': cached.headers['ETag']})
+        r = self.session.get(self.base + path, headers=headers, **self.extraargs)
+        if r.status_code == 304 and cached is not None:
+            return cached
+        if r.status_code == 200 and 'ETag' in r.headers:
+            r.content  # read the body now, the response is handed out again later
+            self._cached[path] = r
+        else:
+            self._cached.pop(path, None)
+        return r
+
     def get_version(self) :
         """Get the version."""
-        r = requests.get('http://' + self.host + ':' + self.port + '/api/version', headers=self.headers, **self.extraargs)
+        r = self.session.get(self.base + '/api/version', headers=self.headers, **self.extraargs)
         return r
         
     def get_printer(self) :
         """Get the printer."""
-        r = requests.get('http://' + self.host + ':' + self.port + '/api/printer', headers=self.headers, **self.extraargs)
+        r = self._get('/api/printer')
         return r
         
     def get_job(self) :
         """Get the job."""
-        r = requests.get('http://' + self.host + ':' + self.port + '/api/job', headers=self.headers)
+        r = self._get('/api/job')
         return r
         
+    def get_v1_status(self) :
+        """Get printer and job status through the PrusaLink v1 API."""
+        r = self._get('/api/v1/status')
+        return r
+
+    def get_v1_job(self) :
+        """Get the current job through the PrusaLink v1 API."""
+        r = self._get('/api/v1/job')
+        return r
+
+    def detect_apiversion(self) :
+        """
+        Find out once whether the firmware supports the v1 API and remember the answer.
+        Firmware reporting api version 2 or higher serves /api/v1/status.
+        """
+        if self.apiversion is None:
+            api = self.get_version().json().get('api', '0')
+            try:
+                major = int(str(api).split('.')[0])
+            except ValueError:
+                major = 0
+            self.apiversion = 'v1' if major >= 2 else 'legacy'
+        return self.apiversion
+
+    def get_status(self) :
+        """
+        Get printer and job state in as few round trips as possible.
+
+        With the v1 API this is a single /api/v1/status call; the job details are only fetched
+        when a new job shows up. Older firmware gets /api/printer and /api/job in parallel.
+        Returns { 'api': 'v1', 'status': ..., 'job': ... } or { 'api': 'legacy', 'printer': ..., 'job': ... }
+        """
+        if self.detect_apiversion() == 'v1':
+            r = self.get_v1_status()
+            if r.status_code == 404:
+                self.apiversion = 'legacy'
+            else:
+                status = r.json()
+                jobid = status.get('job', {}).get('id')
+                if jobid is None:
+                    self._jobid, self._job = None, None
+                elif jobid != self._jobid:
+                    j = self.get_v1_job()
+                    self._job = j.json() if j.status_code == 200 else None
+                    self._jobid = jobid if self._job else None
+                return { 'api': 'v1', 'status': status, 'job': self._job }
+
+        printer, job = sessions.parallel(self.get_printer, self.get_job)
+        return { 'api': 'legacy', 'printer': printer.json(), 'job': job.json() }
+
     def get_files(self, remoteDir = '/') :
         """
         List files on USB Drive.
@@ -44,12 +169,28 @@ class prusalink:
         
         """
         # was : r = requests.get('http://' + self.host + ':' + self.port + '/api/files?recursive=true', headers=self.headers)
-        r = requests.get('http://' + self.host + ':' + self.port + '/api/files' + remoteDir, headers=self.headers)
+        r = self.session.get(self.base + '/api/files' + remoteDir, headers=self.headers, **self.extraargs)
         return r
-        
-    def post_gcode(self, filePathLocal) :
+
+    def list_files(self, remoteDir = '/', maxage = 60) :
+        """
+        Parsed get_files() listing, cached for `maxage` seconds. Uploads and deletes through this
+        object invalidate the cache.
+        """
+        cached = self._listings.get(remoteDir)
+        if cached and time.monotonic() - cached[0] < maxage:
+            return cached[1]
+        r = self.get_files(remoteDir)
+        r.raise_for_status()
+        listing = r.json()
+        self._listings[remoteDir] = (time.monotonic(), listing)
+        return listing
+
+    def post_gcode(self, filePathLocal, progress = None, remoteName = None) :
         """
         Send a file on USB Drive.
+
+        The file is streamed from disk in chunks; `progress(sent, total)` is called as it goes.
         
         Test code :
         import PrusaLinkPy
@@ -59,10 +200,12 @@ class prusalink:
         files.json()['refs']['resource']
         
         """
-        fileContentBinary = {'file': open(filePathLocal,'rb')}
         # Marche aussi avec 
         #r = requests.post('http://' + self.host + ':' + self.port + '/api/files/usb/', headers=self.headers, files=fileContentBinary )
-        r = requests.post('http://' + self.host + ':' + self.port + '/api/files/local/', headers=self.headers, files=fileContentBinary )
+        with UploadBody(filePathLocal, filename=remoteName, progress=progress) as body:
+            headers = dict(self.headers, **{'Content-Type': body.contenttype})
+            r = self.session.post(self.base + '/api/files/local/', headers=headers, data=body, **self.extraargs)
+        self._listings.clear()
         return r
         
     def post_print_gcode(self, remotePath) :
@@ -76,7 +219,7 @@ class prusalink:
         
         """
         payload = {'command': 'start'}
-        r = requests.post('http://' + self.host + ':' + self.port + '/api/files' + remotePath, headers=self.headers, data=json.dumps(payload))
+        r = self.session.post(self.base + '/api/files' + remotePath, headers=self.headers, data=json.dumps(payload), **self.extraargs)
         return r
         
         
@@ -89,7 +232,8 @@ class prusalink:
             prusaMini = PrusaLinkPy.PrusaLinkPy("192.168.1.211", "<<TOKEN>>")
             ret = prusaMini.delete_gcode('/usb/DEBOUC~1.GCO').json()
         """
-        r = requests.delete('http://' + self.host + ':' + self.port + '/api/files' + filePathRemote, headers=self.headers)
+        r = self.session.delete(self.base + '/api/files' + filePathRemote, headers=self.headers, **self.extraargs)
+        self._listings.clear()
         return r
         
     def rm(self, filePathRemote = '/') :
@@ -105,10 +249,10 @@ class prusalink:
         
         # Check if response is json 
         if "{" in ret.text :
-            for filejson in ret.json()['files'][0]['children'] :
-                print("Delete file : " + filejson["path"])
-                self.delete_gcode( filejson["path"])
-        else :
-            return ret
-        
-        
+            paths = [filejson["path"] for filejson in ret.json()['files'][0]['children']]
+            for path in paths:
+                print("Delete file : " + path)
+            # The deletes go out side by side instead of one after the other
+            ret = sessions.parallel(*[lambda path=path: self.delete_gcode(path) for path in paths])
+            self._listings.clear()
+        return ret
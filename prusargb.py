@@ -1,84 +1,140 @@
 #!/usr/bin/env python
 
-import pika
+from amqp import AmqpConnection
 import json
-import time
 import datetime
 import os
-
-from dotenv import load_dotenv
-
-load_dotenv()
+import publisher
+import metrics
+import sinks
+import yaml
 
 """
-This script reads the prusalink exchange and transforms the message to an RFC8428-compliant message
-that will be placed on the output EXCHANGE.
+This script reads the prusalink exchange and hands every printer state to a set of sinks (see
+sinks.py), which transform them and place them on their output exchanges: status lines for the
+RGB displays, RFC8428 SenML packs, plain JSON. The sinks are listed in the YAML file SINKSFILE;
+without it the RGB sink for mk3 and mk4 is run on MQRABBIT_RGBEXCHANGE.
 """
 
-mqrabbit_user = os.getenv("MQRABBIT_USER")
-mqrabbit_password = os.getenv("MQRABBIT_PASSWORD")
-mqrabbit_host = os.getenv("MQRABBIT_HOST")
-mqrabbit_vhost = os.getenv("MQRABBIT_VHOST")
-mqrabbit_port = os.getenv("MQRABBIT_PORT")
-mqrabbit_exchange = os.getenv("MQRABBIT_EXCHANGE")
-mqrabbit_rgbexchange = os.getenv("MQRABBIT_RGBEXCHANGE")
+mqrabbit_exchange = None
+mqrabbit_rgbexchange = None
+mqrabbit_deadletter = None
+prefetch = 100
+batchsize = 50
+batchwait = 0.5
+sinksfile = None
 
-print(f"rgbex: {mqrabbit_rgbexchange}")
 everythingfine = True
+states = {}
+pending = []
+outputs = []
+flushscheduled = False
+
+def loadsinks(channel):
+    if sinksfile:
+        with open(sinksfile, "r") as infile:
+            configs = yaml.safe_load(infile)['sinks']
+    else:
+        configs = [{ 'type': 'rgb', 'exchange': mqrabbit_rgbexchange, 'printers': [ 'mk3', 'mk4' ] }]
+    for config in configs:
+        sink = sinks.create(channel, config)
+        print(f"[R] Sink {config['type']} to {sink.exchange} for {', '.join(sink.printers)}")
+        outputs.append(sink)
 
 def callback(ch, method, properties, body):
-    print(f"[W] Handling: {body}")
-
-    try:
-        input = json.loads(body)
-        print(f"[W] Parsed: {input}")
-
-        if input['machine']['printer'] in [ 'mk3', 'mk4' ]:
-
-            state = input['state']
-            if state['printstate'] == 'printing':
-                statusline = f"{input['machine']['printer']}:P {state['stillprinting']//3600}:{(state['stillprinting']//60)%60:02}"
-            elif state['printstate'] == 'idle' and 'cooldowntimeout' in state:
-                statusline = f"{input['machine']['printer']}:CD {state['temperature']['bed']}"
-            elif state['printstate'] == 'idle':
-                statusline = f"{input['machine']['printer']}: idle"
-            elif state['printstate'] == 'unknown':
-                statusline = ""
-
-            message = { 
-                'type': input['machine']['printer'], 
-                'list': [
-                    {
-                        'text': statusline,
-                        'color': 'cc4400'},
-                ],
-                'key': input['machine']['printer'], 
-            }
-            print(f"Going to send: {message}")
-            m = json.dumps(message)
-            print(f"json: {m}")
-            channel.basic_publish(exchange=mqrabbit_rgbexchange, routing_key='*', body=json.dumps(message))
-
-        ch.basic_ack(delivery_tag = method.delivery_tag)
-    except Exception as e:
-        print(f"[W]: errored {e}")
-
-print("[R] Connecting")
-mqrabbit_credentials = pika.PlainCredentials(mqrabbit_user, mqrabbit_password)
-mqparameters = pika.ConnectionParameters(
-    host=mqrabbit_host,
-    virtual_host=mqrabbit_vhost,
-    port=mqrabbit_port,
-    credentials=mqrabbit_credentials)
-
-mqconnection = pika.BlockingConnection(mqparameters)
-channel = mqconnection.channel()
-
-queuename = 'prusalink_prusargb_' + datetime.datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
-q = channel.queue_declare(queue=queuename, exclusive=True, auto_delete=True)
-channel.queue_bind(exchange=mqrabbit_exchange, queue=q.method.queue)
-
-channel.basic_consume(queue=queuename, on_message_callback=callback)
-
-print('[R] Waiting for messages. To exit press CTRL+C')
-channel.start_consuming()
\ No newline at end of file
+    pending.append((method.delivery_tag, body))
+    if len(pending) >= batchsize:
+        flush(ch)
+    elif len(pending) == 1:
+        ch.connection.call_later(batchwait, lambda: flush(ch))
+
+def flush(ch):
+    """
+    Handle all buffered messages at once: every message is decoded once, updates for the same
+    printer are coalesced so only its newest state is sent on, poison messages are rejected
+    (and dead-lettered when MQRABBIT_DEADLETTER is set) and the rest is acked in one go.
+    """
+    if not pending:
+        return
+    batch = pending[:]
+    pending.clear()
+    metrics.consumed_messages.inc(len(batch))
+    metrics.consumer_batch_size.observe(len(batch))
+
+    touched = {}
+    lastgood = None
+    for tag, body in batch:
+        try:
+            for update in publisher.expand(json.loads(body)):
+                touched[update['machine']['printer']] = publisher.apply(states, update)
+            lastgood = tag
+        except Exception as e:
+            print(f"[W]: rejecting message {tag}: {e}")
+            metrics.rejected_messages.inc()
+            ch.basic_nack(delivery_tag=tag, requeue=False)
+
+    for printer, state in touched.items():
+        for sink in outputs:
+            try:
+                sink.offer(printer, state)
+            except Exception as e:
+                print(f"[W]: {type(sink).__name__} errored on {printer}: {e}")
+
+    if lastgood is not None:
+        ch.basic_ack(delivery_tag=lastgood, multiple=True)
+
+    flushsinks(ch)
+
+def flushsinks(ch, timer=False):
+    """Flush the sinks whose batch is full or whose wait is over, and come back for the others."""
+    global flushscheduled
+    if timer:
+        flushscheduled = False
+    for sink in outputs:
+        try:
+            sink.maybeflush()
+        except Exception as e:
+            print(f"[W]: {type(sink).__name__} failed to flush: {e}")
+    waits = [wait for wait in (sink.due() for sink in outputs) if wait is not None]
+    if waits and not flushscheduled:
+        flushscheduled = True
+        ch.connection.call_later(max(min(waits), 0.05), lambda: flushsinks(ch, timer=True))
+
+def setup(channel):
+    # Delivery tags and timers of a previous connection are gone now
+    global flushscheduled
+    flushscheduled = False
+    pending.clear()
+    channel.basic_qos(prefetch_count=prefetch)
+
+    arguments = { 'x-dead-letter-exchange': mqrabbit_deadletter } if mqrabbit_deadletter else None
+    queuename = 'prusalink_prusargb_' + datetime.datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
+    q = channel.queue_declare(queue=queuename, exclusive=True, auto_delete=True, arguments=arguments)
+    channel.queue_bind(exchange=mqrabbit_exchange, queue=q.method.queue)
+
+    channel.basic_consume(queue=queuename, on_message_callback=callback)
+    print('[R] Waiting for messages. To exit press CTRL+C')
+
+def main():
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    global mqrabbit_exchange, mqrabbit_rgbexchange, mqrabbit_deadletter, prefetch, batchsize, batchwait, sinksfile
+    mqrabbit_exchange = os.getenv("MQRABBIT_EXCHANGE")
+    mqrabbit_rgbexchange = os.getenv("MQRABBIT_RGBEXCHANGE")
+    mqrabbit_deadletter = os.getenv("MQRABBIT_DEADLETTER")
+    prefetch = int(os.getenv("PREFETCH", prefetch))
+    batchsize = int(os.getenv("BATCHSIZE", batchsize))
+    batchwait = float(os.getenv("BATCHWAIT", batchwait))
+    sinksfile = os.getenv("SINKSFILE")
+    print(f"rgbex: {mqrabbit_rgbexchange}")
+
+    metrics.serve()
+
+    print("[R] Connecting")
+    channel = AmqpConnection().onconnect(setup)
+    loadsinks(channel)
+    channel.run_forever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+import json
+import logging
+import time
+
+"""
+Change-detection publisher for the printer state exchange. It remembers the last snapshot that was
+published for every printer and only publishes the fields that changed meaningfully, with a full
+snapshot every `heartbeat` seconds so new consumers catch up. The updates of one cycle are sent
+as a single batch message, with publisher confirms when enabled.
+
+Message format, per update:
+    { 'machine': { 'printer': <name> }, 'type': 'full', 'state': {...} }
+    { 'machine': { 'printer': <name> }, 'type': 'delta', 'state': {<changed fields>}, 'removed': [<fields>] }
+and, when batching:
+    { 'type': 'batch', 'updates': [<update>, ...] }
+"""
+
+log = logging.getLogger('publisher')
+
+DEFAULT_TOLERANCE = {
+    'temperature': 0.5,
+}
+
+def differs(old, new, tolerance=0):
+    numbers = (int, float)
+    if isinstance(old, numbers) and isinstance(new, numbers) and not isinstance(old, bool) and not isinstance(new, bool):
+        return abs(old - new) > tolerance
+    if isinstance(old, dict) and isinstance(new, dict):
+        return any(differs(old.get(k), new.get(k), tolerance) for k in old.keys() | new.keys())
+    return old != new
+
+def expand(message):
+    """Turn a received message into a list of updates, whatever format it was published in."""
+    if message.get('type') == 'batch':
+        return message['updates']
+    if 'type' not in message:
+        # Old style message: full machine config and full state
+        return [{ 'machine': message['machine'], 'type': 'full', 'state': message['state'] }]
+    return [message]
+
+def apply(states, update):
+    """Merge an update into `states` (printer name -> state) and return the printer's merged state."""
+    name = update['machine']['printer']
+    if update['type'] == 'full':
+        states[name] = dict(update['state'])
+    else:
+        merged = states.setdefault(name, {})
+        merged.update(update['state'])
+        for field in update.get('removed', []):
+            merged.pop(field, None)
+    return states[name]
+
+class DeltaPublisher:
+    def __init__(self, channel, exchange, heartbeat=300, tolerance=None, batch=True, confirm=True, default=None, clock=time.monotonic) -> None:
+        self.channel = channel
+        self.clock = clock
+        self.exchange = exchange
+        self.heartbeat = heartbeat
+        self.tolerance = { **DEFAULT_TOLERANCE, **(tolerance or {}) }
+        self.batch = batch
+        self.default = default
+        self.published = {}
+        self.lastfull = {}
+        self.pending = {}
+        self.resyncneeded = False
+        if confirm:
+            self.channel.confirm_delivery()
+
+    def update(self, name, state):
+        """Queue whatever needs publishing for printer `name` after a poll."""
+        now = self.clock()
+        if self.resyncneeded:
+            self.resyncneeded = False
+            self.published.clear()
+            self.lastfull.clear()
+        last = self.published.get(name)
+        if last is None or now - self.lastfull.get(name, 0) > self.heartbeat:
+            update = { 'machine': { 'printer': name }, 'type': 'full', 'state': dict(state) }
+            self.lastfull[name] = now
+        else:
+            changed = { k: v for k, v in state.items() if k not in last or differs(last[k], v, self.tolerance.get(k, 0)) }
+            removed = [k for k in last if k not in state]
+            if not changed and not removed:
+                return
+            update = { 'machine': { 'printer': name }, 'type': 'delta', 'state': changed }
+            if removed:
+                update['removed'] = removed
+        self.pending[name] = self._merge(self.pending.get(name), update)
+
+    def _merge(self, previous, update):
+        if previous is None or update['type'] == 'full':
+            return update
+        state = { **previous['state'], **update['state'] }
+        for field in update.get('removed', []):
+            state.pop(field, None)
+        merged = dict(previous, state=state)
+        if previous['type'] == 'delta':
+            removed = (set(previous.get('removed', [])) - update['state'].keys()) | set(update.get('removed', []))
+            merged.pop('removed', None)
+            if removed:
+                merged['removed'] = sorted(removed)
+        return merged
+
+    def flush(self):
+        """Publish everything queued since the last flush."""
+        if not self.pending:
+            return
+        updates = list(self.pending.values())
+        if self.batch:
+            bodies = [{ 'type': 'batch', 'updates': updates }]
+        else:
+            bodies = updates
+        try:
+            for body in bodies:
+                self.channel.basic_publish(exchange=self.exchange, routing_key='', body=json.dumps(body, default=self.default))
+        except Exception:
+            # Nothing is known about what arrived; make sure everyone gets a full snapshot next time
+            self.published.clear()
+            self.lastfull.clear()
+            self.pending.clear()
+            raise
+
+        for update in updates:
+            name = update['machine']['printer']
+            if update['type'] == 'full':
+                self.published[name] = dict(update['state'])
+            else:
+                apply(self.published, update)
+        self.pending.clear()
+        log.debug("Published %d update(s)", len(updates))
+
+    def resync(self):
+        """Send full snapshots from the next update on, e.g. after messages were lost."""
+        self.resyncneeded = True
+
+    def forget(self, name):
+        self.published.pop(name, None)
+        self.lastfull.pop(name, None)
+        self.pending.pop(name, None)
@@ -0,0 +1,68 @@
+import atexit
+import gzip
+import json
+import logging
+import threading
+import time
+import zlib
+
+"""
+Append-only recordings of what the printers answered, for replay.py. Every line is a compact JSON
+array: [time, printer, handler output] for a poll result and [time] for the end of a polling
+cycle. Files ending in .gz are written as one gzip stream per watcher run, flushed after every
+cycle, so a recording that was cut off by a crash is readable up to its last complete cycle.
+"""
+
+log = logging.getLogger('recording')
+
+def opener(path):
+    return gzip.open if path.endswith('.gz') else open
+
+class Recorder:
+    def __init__(self, path, clock=time.time) -> None:
+        self.path = path
+        self.clock = clock
+        self.lines = []
+        self.file = None
+        self.lock = threading.Lock()
+        atexit.register(self.close)
+
+    def record(self, printer, output):
+        line = json.dumps([round(self.clock(), 3), printer, output], separators=(',', ':'), default=str)
+        with self.lock:
+            self.lines.append(line)
+
+    def endcycle(self):
+        with self.lock:
+            lines, self.lines = self.lines, []
+        lines.append(json.dumps([round(self.clock(), 3)]))
+        try:
+            if self.file is None:
+                self.file = opener(self.path)(self.path, 'at')
+            self.file.write('\n'.join(lines) + '\n')
+            self.file.flush()
+        except OSError as exc:
+            log.warning("Could not append to recording %s: %s", self.path, exc)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+def read(path):
+    """Yield (time, printer, output) for poll results and (time, None, None) for cycle ends."""
+    try:
+        with opener(path)(path, 'rt') as infile:
+            for line in infile:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    log.warning("Skipping damaged line in %s", path)
+                    continue
+                if len(entry) == 1:
+                    yield entry[0], None, None
+                else:
+                    yield entry[0], entry[1], entry[2]
+    except (EOFError, zlib.error, gzip.BadGzipFile):
+        # A watcher that was killed leaves its gzip stream unterminated
+        log.warning("Recording %s was not closed cleanly, replaying it up to that point", path)
@@ -0,0 +1,142 @@
+#!/bin/env -S python -u
+
+import argparse
+import json
+import logging
+import time
+from datetime import datetime
+import yaml
+import watcher
+import recording
+from publisher import DeltaPublisher
+from anomaly import AnomalyDetector
+from digest import FleetDigest
+
+"""
+Replays a recording made with the watcher's 'record' setting through the watcher state machine.
+Time comes from a virtual clock that jumps to the timestamp of every recorded poll, so weeks of
+traffic go through in seconds. Nothing leaves the process: Telegram messages and exchange publishes
+are captured instead of sent, cameras are never asked for pictures and no state is written to disk.
+
+    replay.py recording.jsonl.gz settings.yaml [--speed 60] [--messages] [--json result.json]
+"""
+
+log = logging.getLogger('replay')
+
+class VirtualClock:
+    def __init__(self, start=0) -> None:
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def datetime(self):
+        return datetime.fromtimestamp(self.now)
+
+class CapturingDispatcher:
+    def __init__(self, clock) -> None:
+        self.clock = clock
+        self.messages = []
+
+    def submit(self, key, message, picture=None, force=False):
+        self.messages.append({ 'time': self.clock.time(), 'key': key, 'message': message,
+                               'picture': picture is not None, 'force': force })
+
+    def join(self, timeout=None):
+        return True
+
+class CapturingChannel:
+    def __init__(self, clock) -> None:
+        self.clock = clock
+        self.published = []
+
+    def confirm_delivery(self):
+        pass
+
+    def basic_publish(self, exchange, routing_key, body):
+        self.published.append({ 'time': self.clock.time(), 'body': json.loads(body) })
+
+def replay(path, settings, speed=None):
+    """Feed the recording at `path` through the state machine; returns the captured messages and publishes."""
+    clock = VirtualClock()
+    globalsettings = settings['settings']
+    printers = { m['printer']: m for m in settings['printers'] }
+
+    dispatcher = CapturingDispatcher(clock)
+    channel = CapturingChannel(clock)
+    watcher.clock = clock.datetime
+    watcher.dispatcher = dispatcher
+    watcher.publisher = DeltaPublisher(channel, 'replay', heartbeat=globalsettings.get('publish', {}).get('heartbeat', 300),
+                                       tolerance=globalsettings.get('publish', {}).get('tolerance'),
+                                       confirm=False, default=watcher.jsonserializer, clock=clock.time)
+    watcher.detector = AnomalyDetector(globalsettings['anomaly'], clock=clock.time) if 'anomaly' in globalsettings else None
+    watcher.digest = None
+    if 'digest' in globalsettings:
+        digestsettings = globalsettings['digest'] or {}
+        watcher.digest = FleetDigest(interval=digestsettings.get('interval', 600), clock=clock.time)
+    # Everything that would touch disk, cameras, printers or the network stays off
+    watcher.telemetry = watcher.checkpoint = watcher.statuscache = watcher.jobqueue = watcher.recorder = None
+    watcher.membership = None
+
+    state = None
+    polls = 0
+    previous = None
+    started = time.monotonic()
+    for timestamp, printer, output in recording.read(path):
+        if speed and previous is not None and timestamp > previous:
+            time.sleep((timestamp - previous) / speed)
+        previous = timestamp
+        clock.now = timestamp
+        if state is None:
+            state = watcher.init_states(settings=settings['printers'])
+        if printer is None:
+            watcher.publisher.flush()
+            if watcher.digest:
+                watcher.digest.maybesend(watcher.sendmessage)
+            continue
+        if printer not in printers:
+            continue
+        watcher.handle_state(state, printers[printer], output, globalsettings)
+        polls += 1
+    watcher.publisher.flush()
+
+    return {
+        'polls': polls,
+        'seconds': time.monotonic() - started,
+        'messages': dispatcher.messages,
+        'published': channel.published,
+        'state': state or {},
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a watcher recording through the state machine.")
+    parser.add_argument('recording', help="file written by the watcher's 'record' setting")
+    parser.add_argument('settings', help="settings file with the printers of the recording")
+    parser.add_argument('--speed', type=float, help="replay at this many times real time instead of as fast as possible")
+    parser.add_argument('--messages', action='store_true', help="print every captured message")
+    parser.add_argument('--json', help="write the captured messages and publishes to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    with open(args.settings, "r") as settingsfile:
+        settings = yaml.safe_load(settingsfile)
+
+    result = replay(args.recording, settings, speed=args.speed)
+    messages = result['messages']
+    print(f"polls        {result['polls']} in {result['seconds']:.2f}s")
+    if messages:
+        span = messages[-1]['time'] - messages[0]['time']
+        print(f"messages     {len(messages)} ({sum(m['force'] for m in messages)} forced) over {span / 3600:.1f} hours")
+    else:
+        print("messages     0")
+    print(f"publishes    {len(result['published'])}")
+    if args.messages:
+        for m in messages:
+            print(f"--- {datetime.fromtimestamp(m['time']):%Y-%m-%d %H:%M:%S} {m['key']}{' (forced)' if m['force'] else ''}")
+            print(m['message'].strip())
+    if args.json:
+        with open(args.json, "w") as outfile:
+            json.dump({ key: result[key] for key in ('polls', 'messages', 'published') }, outfile, indent=2, default=str)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+"""
+Per-printer poll scheduling. Every printer gets its own next-due time, based on what it is doing:
+printers that are starting or finishing a job or cooling down are polled often, idle printers
+rarely, and unreachable printers back off exponentially. Push sources may pull a poll forward from
+their own threads with pollsoon(), which also wakes the main loop from sleep().
+"""
+
+log = logging.getLogger('scheduler')
+
+class PollScheduler:
+    def __init__(self, printers, globalsettings) -> None:
+        self.globalsettings = globalsettings
+        self.queue = []
+        self.printers = {}
+        self.failures = {}
+        self.counter = itertools.count()
+        self.lock = threading.RLock()
+        self.wakeup = threading.Event()
+        now = time.monotonic()
+        for m in printers:
+            self.add(m, now)
+
+    def defaults(self):
+        interval = self.globalsettings['interval']
+        defaults = {
+            'printing': interval,
+            'transition': max(5, interval / 4),
+            'cooldown': max(5, interval / 2),
+            'idle': interval * 4,
+            'unknown': interval,
+            'maxbackoff': interval * 20,
+            'transitionwindow': 300,
+        }
+        defaults.update(self.globalsettings.get('poll', {}))
+        return defaults
+
+    def cadence(self, m, state):
+        """Seconds until printer `m` should be polled again, given its latest state."""
+        poll = self.defaults()
+        poll.update(m.get('poll', {}))
+
+        printstate = state.get('printstate')
+        if printstate == 'unknown':
+            failures = self.failures.get(m['printer'], 1)
+            return min(poll['unknown'] * 2 ** (failures - 1), poll['maxbackoff'])
+        if printstate == 'printing':
+            window = poll['transitionwindow']
+            if state.get('alreadyprinted', window) < window or 0 < state.get('stillprinting', window) < window:
+                return poll['transition']
+            return poll['printing']
+        if 'cooldowntimeout' in state:
+            return poll['cooldown']
+        return poll['idle']
+
+    def add(self, m, due=None):
+        self.printers[m['printer']] = m
+        self.failures.pop(m['printer'], None)
+        self._push(m['printer'], time.monotonic() if due is None else due)
+
+    def remove(self, name):
+        self.printers.pop(name, None)
+        self.failures.pop(name, None)
+
+    def reschedule(self, m, state, now=None):
+        if m['printer'] not in self.printers:
+            return
+        if state.get('printstate') == 'unknown':
+            self.failures[m['printer']] = self.failures.get(m['printer'], 0) + 1
+        else:
+            self.failures.pop(m['printer'], None)
+        delay = self.cadence(m, state)
+        log.debug("Next poll of %s in %.0f seconds", m['printer'], delay)
+        self._push(m['printer'], (time.monotonic() if now is None else now) + delay)
+
+    def pollsoon(self, name, delay=0):
+        """Move the next poll of printer `name` forward to at most `delay` seconds from now."""
+        if name in self.printers:
+            self._push(name, time.monotonic() + delay)
+            self.wakeup.set()
+
+    def due(self, now=None):
+        """Pop and return the configs of all printers that are due now."""
+        now = time.monotonic() if now is None else now
+        due = {}
+        with self.lock:
+            while self.queue and self.queue[0][0] <= now:
+                _, _, name = heapq.heappop(self.queue)
+                if name in self.printers:
+                    due[name] = self.printers[name]
+            # An earlier entry for a printer supersedes any later one still in the queue
+            self.queue = [entry for entry in self.queue if entry[2] not in due and entry[2] in self.printers]
+            heapq.heapify(self.queue)
+        return list(due.values())
+
+    def wait(self, now=None):
+        """Seconds until the next printer is due."""
+        with self.lock:
+            if not self.queue:
+                return self.globalsettings['interval']
+            now = time.monotonic() if now is None else now
+            return max(0, self.queue[0][0] - now)
+
+    def sleep(self, timeout):
+        """Sleep up to `timeout` seconds, or until pollsoon() is called."""
+        self.wakeup.wait(timeout)
+        self.wakeup.clear()
+
+    def _push(self, name, due):
+        with self.lock:
+            heapq.heappush(self.queue, (due, next(self.counter), name))
@@ -0,0 +1,96 @@
+import threading
+import concurrent.futures
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+"""
+Shared, connection-pooled HTTP sessions. The printers, cameras and light controllers all run
+small embedded web servers, so we keep connections alive and reuse one session per host instead
+of setting up a new TCP connection for every request.
+"""
+
+DEFAULT_TIMEOUT = 30
+RETRIES = 2
+BACKOFF = 0.5
+POOLSIZE = 4
+SUBREQUESTWORKERS = 16
+
+# One pool per kind of work, so a burst of camera captures never holds up the sub-requests of a
+# poll, and a digest that captures cameras from inside a notifier task does not wait on its own pool
+POOLS = {
+    'subrequest': SUBREQUESTWORKERS,
+    'notifier': 8,
+    'digest': 8,
+}
+
+_sessions = {}
+_lock = threading.Lock()
+_executors = {}
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter that applies a default timeout to requests that do not set one."""
+
+    def __init__(self, *args, timeout=DEFAULT_TIMEOUT, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().send(request, **kwargs)
+
+def newsession(timeout=DEFAULT_TIMEOUT, retries=RETRIES, backoff=BACKOFF, poolsize=POOLSIZE):
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=0,
+        backoff_factor=backoff,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset(['GET', 'HEAD']))
+    adapter = TimeoutHTTPAdapter(timeout=timeout, max_retries=retry, pool_connections=1, pool_maxsize=poolsize)
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def getsession(name, **kwargs):
+    """Return the session for `name` (usually host:port), creating it on first use.
+
+    A `timeout` also becomes the default of an existing session, for clients like octorest
+    that do not pass one with their requests.
+    """
+    with _lock:
+        session = _sessions.get(name)
+        if session is None:
+            session = newsession(**kwargs)
+            _sessions[name] = session
+        elif 'timeout' in kwargs:
+            for adapter in session.adapters.values():
+                adapter.timeout = kwargs['timeout']
+        return session
+
+def closeall():
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+def parallel(*calls, pool='subrequest'):
+    """Run the callables concurrently on `pool` and return their results in order.
+
+    The 'subrequest' pool issues the sub-requests of one status fetch side by side; camera
+    captures go to 'notifier' and 'digest'. Called from a task of `pool` itself, the calls run
+    one after the other instead: waiting on a full pool from inside it would deadlock. The
+    first exception raised by any of the calls is re-raised.
+    """
+    if threading.current_thread().name.startswith(f"{pool}_"):
+        return [call() for call in calls]
+    with _lock:
+        executor = _executors.get(pool)
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=POOLS[pool], thread_name_prefix=pool)
+            _executors[pool] = executor
+    futures = [executor.submit(call) for call in calls]
+    return [future.result() for future in futures]
@@ -0,0 +1,217 @@
+import base64
+import bisect
+import hashlib
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+import pika
+
+"""
+Sharding of the printer list over several watcher replicas.
+
+Printers are assigned to replicas with a consistent hash ring on the printer name, so a replica
+joining or leaving only moves the printers it owned. The member list is either static (SHARD_COUNT
+replicas, this one being SHARD_ORDINAL or the ordinal at the end of HOSTNAME, as in a StatefulSet)
+or discovered through the broker: every replica announces itself on a fanout exchange and members
+that have not been heard from for a few intervals drop out. A replica in broker mode owns nothing
+until it has listened for the others for an announce interval, so a rolling restart does not
+have every new replica briefly poll, and announce, the whole fleet.
+
+Telegram is owned by a single leader: all replicas forward their notifications to one durable
+queue, as persistent messages, and only the replica holding the exclusive consumer on that queue
+sends them. It acks a message once Telegram has it.
+"""
+
+log = logging.getLogger('sharding')
+
+def hashkey(value):
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+class HashRing:
+    def __init__(self, members, vnodes=64) -> None:
+        self.members = sorted(members)
+        points = sorted((hashkey(f"{member}#{i}"), member) for member in self.members for i in range(vnodes))
+        self.keys = [key for key, _ in points]
+        self.owners = [member for _, member in points]
+
+    def owner(self, name):
+        if not self.keys:
+            return None
+        index = bisect.bisect(self.keys, hashkey(name)) % len(self.keys)
+        return self.owners[index]
+
+# Largest camera picture forwarded to the leader; base64 makes it a third larger on the wire
+MAXPICTURE = 512 * 1024
+
+def ordinal():
+    """SHARD_ORDINAL, or the ordinal at the end of a StatefulSet HOSTNAME; None when there is neither."""
+    value = os.getenv('SHARD_ORDINAL')
+    if value is None:
+        match = re.search(r'-(\d+)$', os.getenv('HOSTNAME', ''))
+        value = match.group(1) if match else None
+    return None if value is None else int(value)
+
+class Membership:
+    def __init__(self, mode='static', count=1, exchange='printwatcher_members', interval=10) -> None:
+        self.mode = mode
+        self.exchange = exchange
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.version = 0
+        self.lastannounce = 0
+        self.started = time.monotonic()
+        if mode == 'static':
+            me = ordinal()
+            if me is None and count == 1:
+                me = 0
+            if me is None or not 0 <= me < count:
+                # A replica outside the ring would silently poll nothing
+                raise ValueError(f"shard ordinal {me} is not in 0..{count - 1}; set SHARD_ORDINAL or run as a StatefulSet")
+            self.me = f"watcher-{me}"
+            self.seen = { f"watcher-{i}": float('inf') for i in range(count) }
+            self.settled = True
+        else:
+            self.me = os.getenv('HOSTNAME') or f"watcher-{os.getpid()}"
+            self.seen = { self.me: float('inf') }
+            # Until the other replicas have had a chance to announce themselves, this one would
+            # think it owns the whole fleet
+            self.settled = False
+        self.ring = HashRing(self.seen)
+        log.info("Sharding as %s in %s mode", self.me, mode)
+
+    def owns(self, name):
+        return self.settled and self.ring.owner(name) == self.me
+
+    def setup(self, channel):
+        """AMQP setup hook for broker mode: listen to the announcements of the other replicas."""
+        if self.mode != 'broker':
+            return
+        channel.exchange_declare(exchange=self.exchange, exchange_type='fanout')
+        q = channel.queue_declare(queue='', exclusive=True, auto_delete=True)
+        channel.queue_bind(exchange=self.exchange, queue=q.method.queue)
+        channel.basic_consume(queue=q.method.queue, on_message_callback=self._heard, auto_ack=True)
+
+    def _heard(self, ch, method, properties, body):
+        try:
+            member = json.loads(body)['member']
+        except (ValueError, KeyError):
+            return
+        with self.lock:
+            isnew = member not in self.seen
+            self.seen[member] = time.monotonic()
+            if isnew:
+                self._rebuild()
+
+    def _rebuild(self):
+        self.ring = HashRing(self.seen)
+        self.version += 1
+        log.info("Members are now %s", ", ".join(self.ring.members))
+
+    def tick(self, channel):
+        """Announce ourselves and forget members that went quiet; call this from the main loop."""
+        if self.mode != 'broker':
+            return
+        now = time.monotonic()
+        if now - self.lastannounce >= self.interval:
+            self.lastannounce = now
+            channel.basic_publish(exchange=self.exchange, routing_key='', body=json.dumps({ 'member': self.me }))
+        with self.lock:
+            stale = [member for member, seen in self.seen.items() if member != self.me and now - seen > 3 * self.interval]
+            for member in stale:
+                del self.seen[member]
+            if not self.settled and now - self.started >= 1.5 * self.interval:
+                # Every replica that is up has announced itself by now
+                self.settled = True
+                self._rebuild()
+            elif stale:
+                self._rebuild()
+
+class ForwardingDispatcher:
+    """Dispatcher with the TelegramDispatcher.submit() interface that hands notifications to the leader."""
+
+    def __init__(self, channel, notifyqueue) -> None:
+        self.channel = channel
+        self.notifyqueue = notifyqueue
+        self.queue = queue.Queue()
+        threading.Thread(target=self._run, name='forwarder', daemon=True).start()
+
+    def submit(self, key, message, picture=None, force=False):
+        self.queue.put((key, message, picture, force))
+
+    def join(self, timeout=None):
+        deadline = time.monotonic() + (timeout or 0)
+        while self.queue.unfinished_tasks and (timeout is None or time.monotonic() < deadline):
+            time.sleep(0.1)
+        return not self.queue.unfinished_tasks
+
+    def _run(self):
+        while True:
+            key, message, picture, force = self.queue.get()
+            try:
+                if not self.channel.connected:
+                    # The outbox keeps messages through an outage; pictures would blow up its memory
+                    picture = None
+                if callable(picture):
+                    try:
+                        picture = picture()
+                    except Exception as exc:
+                        log.warning("error making picture: %s", exc)
+                        picture = None
+                if picture and len(picture) > MAXPICTURE:
+                    log.warning("Not forwarding a picture of %d bytes for %s", len(picture), key)
+                    picture = None
+                body = { 'key': key, 'message': message, 'force': force,
+                         'picture': base64.b64encode(picture).decode() if picture else None }
+                self.channel.basic_publish(exchange='', routing_key=self.notifyqueue, body=json.dumps(body),
+                                           properties=pika.BasicProperties(delivery_mode=pika.DeliveryMode.Persistent))
+            except Exception as exc:
+                log.exception(exc)
+            finally:
+                self.queue.task_done()
+
+class NotificationLeader:
+    """Tries to become the exclusive consumer of the notification queue and sends what arrives there."""
+
+    def __init__(self, notifyqueue, dispatcher, retry=15) -> None:
+        self.notifyqueue = notifyqueue
+        self.dispatcher = dispatcher
+        self.retry = retry
+        self.isleader = False
+
+    def setup(self, channel):
+        self.isleader = False
+        channel.queue_declare(queue=self.notifyqueue, durable=True)
+        self._claim(channel.connection)
+
+    def _claim(self, connection):
+        leaderchannel = connection.channel()
+        try:
+            leaderchannel.basic_consume(queue=self.notifyqueue, on_message_callback=self._notify, exclusive=True)
+            self.isleader = True
+            log.info("Taking over Telegram notifications")
+        except pika.exceptions.ChannelClosedByBroker:
+            # Someone else is the leader; try again later in case they go away
+            connection.call_later(self.retry, lambda: self._claim(connection))
+
+    def _notify(self, ch, method, properties, body):
+        tag = method.delivery_tag
+        try:
+            n = json.loads(body)
+            key, message, force = n['key'], n['message'], n.get('force', False)
+            picture = base64.b64decode(n['picture']) if n.get('picture') else None
+        except (ValueError, KeyError) as exc:
+            log.warning("Dropping malformed notification: %s", exc)
+            ch.basic_ack(delivery_tag=tag)
+            return
+        # Acked once it has been sent, so a leader that dies first leaves it for the next one
+        self.dispatcher.submit(key, message, picture=picture, force=force,
+                               done=lambda: ch.connection.add_callback_threadsafe(lambda: self._ack(ch, tag)))
+
+    def _ack(self, ch, tag):
+        # After a reconnect the broker has already handed the message out again
+        if ch.is_open:
+            ch.basic_ack(delivery_tag=tag)
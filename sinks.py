@@ -0,0 +1,176 @@
+from abc import abstractmethod, ABCMeta
+import fnmatch
+import json
+import logging
+import time
+
+"""
+Output sinks for the consumer of the watcher exchange. The consumer decodes every message once
+and offers the resulting printer states to each sink. A sink picks the printers it wants through
+`printers`/`exclude` name patterns, keeps the newest state per printer and publishes them in
+batches of up to `batch` printers, at the latest `wait` seconds after the first buffered update.
+
+A batch stays buffered until it has been published; when encoding or publishing fails, the
+sink tries again `retry` seconds later with whatever is newest by then.
+
+New downstreams are a subclass with an encode() method, registered in SINKS.
+"""
+
+log = logging.getLogger('sinks')
+
+class Sink(metaclass=ABCMeta):
+    def __init__(self, channel, exchange, printers=('*',), exclude=(), batch=1, wait=0, routing_key='*', retry=5) -> None:
+        self.channel = channel
+        self.exchange = exchange
+        self.printers = list(printers)
+        self.exclude = list(exclude)
+        self.batch = batch
+        self.wait = wait
+        self.routing_key = routing_key
+        self.retry = retry
+        self.buffer = {}
+        self.since = None
+        self.retryat = None
+
+    def accepts(self, printer):
+        return (any(fnmatch.fnmatchcase(printer, p) for p in self.printers)
+                and not any(fnmatch.fnmatchcase(printer, p) for p in self.exclude))
+
+    def offer(self, printer, state):
+        if not self.accepts(printer):
+            return
+        if not self.buffer:
+            self.since = time.monotonic()
+        self.buffer[printer] = (time.time(), state)
+
+    def due(self, now=None):
+        """Seconds until this sink wants to flush, or None when nothing is buffered."""
+        if not self.buffer:
+            return None
+        now = time.monotonic() if now is None else now
+        if self.retryat is not None and now < self.retryat:
+            return self.retryat - now
+        if len(self.buffer) >= self.batch:
+            return 0
+        return max(0, self.since + self.wait - now)
+
+    def maybeflush(self):
+        if self.due() == 0:
+            self.flush()
+
+    def flush(self):
+        updates = sorted(self.buffer.items())
+        try:
+            for body in list(self.encode(updates)):
+                self.channel.basic_publish(exchange=self.exchange, routing_key=self.routing_key, body=body)
+        except Exception:
+            # Keep the batch; a retry may send some of it twice, which is harmless for states
+            self.retryat = time.monotonic() + self.retry
+            raise
+        self.buffer = {}
+        self.retryat = None
+
+    @abstractmethod
+    def encode(self, updates):
+        """Turn a list of (printer, (timestamp, state)) into message bodies."""
+        pass
+
+class JsonSink(Sink):
+    """The full state of every printer in the batch, as one JSON object keyed by printer."""
+
+    def encode(self, updates):
+        yield json.dumps({ printer: state for printer, (_, state) in updates })
+
+class RgbSink(Sink):
+    """Status lines for the RGB matrix displays, one message per printer."""
+
+    def __init__(self, channel, exchange, color='cc4400', **options) -> None:
+        super().__init__(channel, exchange, **options)
+        self.color = color
+
+    def statusline(self, printer, state):
+        # A state merged from deltas may not have every field yet
+        if state.get('printstate') == 'printing':
+            left = int(state.get('stillprinting') or 0)
+            return f"{printer}:P {left//3600}:{(left//60)%60:02}"
+        if state.get('printstate') == 'idle' and 'cooldowntimeout' in state:
+            return f"{printer}:CD {(state.get('temperature') or {}).get('bed', '?')}"
+        if state.get('printstate') == 'idle':
+            return f"{printer}: idle"
+        return ""
+
+    def encode(self, updates):
+        for printer, (_, state) in updates:
+            if 'printstate' not in state:
+                continue
+            message = {
+                'type': printer,
+                'list': [
+                    {
+                        'text': self.statusline(printer, state),
+                        'color': self.color},
+                ],
+                'key': printer,
+            }
+            yield json.dumps(message)
+
+class SenmlSink(Sink):
+    """
+    RFC 8428 SenML JSON: one pack for the whole batch. Each printer starts with a record carrying
+    its base name and base time, the following records are relative to those.
+    """
+
+    # state path, SenML name, unit, scale
+    MEASUREMENTS = (
+        (('temperature', 'bed'), 'temperature:bed', 'Cel', 1),
+        (('temperature', 'nozzle'), 'temperature:nozzle', 'Cel', 1),
+        (('targettemperature', 'bed'), 'targettemperature:bed', 'Cel', 1),
+        (('targettemperature', 'nozzle'), 'targettemperature:nozzle', 'Cel', 1),
+        (('z-height',), 'z-height', 'm', 0.001),
+        (('progress',), 'progress', '/', 1),
+        (('alreadyprinted',), 'alreadyprinted', 's', 1),
+        (('stillprinting',), 'stillprinting', 's', 1),
+        (('fulljobtime',), 'fulljobtime', 's', 1),
+    )
+
+    def __init__(self, channel, exchange, basename='urn:dev:printer:', **options) -> None:
+        super().__init__(channel, exchange, **options)
+        self.basename = basename
+
+    def records(self, printer, timestamp, state):
+        records = []
+        for path, name, unit, scale in self.MEASUREMENTS:
+            value = state
+            for key in path:
+                value = value.get(key) if isinstance(value, dict) else None
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                records.append({ 'n': name, 'u': unit, 'v': value * scale })
+        for name in ('printstate', 'jobname'):
+            if isinstance(state.get(name), str):
+                records.append({ 'n': name, 'vs': state[name] })
+        if records:
+            records[0] = { 'bn': f"{self.basename}{printer}:", 'bt': round(timestamp, 3), **records[0] }
+        return records
+
+    def encode(self, updates):
+        pack = []
+        for printer, (timestamp, state) in updates:
+            pack.extend(self.records(printer, timestamp, state))
+        if pack:
+            yield json.dumps(pack)
+
+SINKS = {
+    'json': JsonSink,
+    'rgb': RgbSink,
+    'senml': SenmlSink,
+}
+
+def create(channel, config):
+    """Build a sink from its settings: `type` picks the class, the rest are its arguments."""
+    options = dict(config)
+    kind = options.pop('type')
+    try:
+        sink = SINKS[kind]
+    except KeyError:
+        raise ValueError(f"Unknown sink type {kind}")
+    return sink(channel, **options)
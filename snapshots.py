@@ -0,0 +1,144 @@
+import concurrent.futures
+import io
+import logging
+import threading
+import time
+from urllib.parse import urlsplit
+import lights
+import sessions
+import metrics
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+"""
+Camera snapshot service. Recent frames are cached per camera for `ttl` seconds and concurrent
+requests for the same camera share one capture. Printers that use the same light controller share
+one lights-on window: the first capture saves the light state and switches the lights on, the last
+one restores it. Frames are read as a stream with a size cap and, when Pillow is available and
+`maxwidth`/`quality` are configured, downscaled and recompressed before they are handed out.
+"""
+
+log = logging.getLogger('snapshots')
+
+MAXBYTES = 10 * 1024 * 1024
+
+class LightWindow:
+    def __init__(self, controller, warmup) -> None:
+        self.controller = controller
+        self.warmup = warmup
+        self.users = 0
+        self.onsince = None
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        with self.lock:
+            if self.users == 0:
+                self.controller.savestate()
+                self.controller.lights(True)
+                self.onsince = time.monotonic()
+            self.users += 1
+            wait = self.warmup - (time.monotonic() - self.onsince)
+        if wait > 0:
+            time.sleep(wait)
+        return self
+
+    def __exit__(self, *exc):
+        with self.lock:
+            self.users -= 1
+            if self.users == 0:
+                self.controller.restorestate()
+
+class SnapshotService:
+    def __init__(self, ttl=10, warmup=1, maxwidth=None, quality=None) -> None:
+        self.ttl = ttl
+        self.warmup = warmup
+        self.maxwidth = maxwidth
+        self.quality = quality
+        self.cache = {}
+        self.inflight = {}
+        self.windows = {}
+        self.lock = threading.Lock()
+
+    def _window(self, config):
+        if 'lights' not in config:
+            return None
+        key = (config['lights']['controller'], str(config['lights']['arguments']))
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None:
+                controller = getattr(lights, config['lights']['controller'])(config['lights']['arguments'])
+                window = LightWindow(controller, self.warmup)
+                self.windows[key] = window
+        return window
+
+    def get(self, config):
+        """Return a JPEG for the camera `config`, from cache, from a capture in progress or freshly captured."""
+        url = config['url']
+        with self.lock:
+            cached = self.cache.get(url)
+            if cached and time.monotonic() - cached[0] < self.ttl:
+                return cached[1]
+            future = self.inflight.get(url)
+            owner = future is None
+            if owner:
+                future = concurrent.futures.Future()
+                self.inflight[url] = future
+        if not owner:
+            return future.result()
+
+        try:
+            content = self.capture(config)
+            future.set_result(content)
+        except Exception as exc:
+            future.set_exception(exc)
+            raise
+        finally:
+            with self.lock:
+                self.inflight.pop(url, None)
+                if future.done() and not future.exception() and future.result():
+                    self.cache[url] = (time.monotonic(), future.result())
+        return content
+
+    @metrics.snapshot_seconds.time()
+    def capture(self, config):
+        log.debug("Making picture using %s", config)
+        window = self._window(config)
+        if window:
+            with window:
+                content = self._fetch(config['url'])
+        else:
+            time.sleep(self.warmup)
+            content = self._fetch(config['url'])
+        if content:
+            content = self._recompress(content, config.get('maxwidth', self.maxwidth), config.get('quality', self.quality))
+        return content
+
+    def _fetch(self, url):
+        session = sessions.getsession(urlsplit(url).netloc)
+        with session.get(url, stream=True) as response:
+            if response.status_code != 200:
+                return None
+            content = bytearray()
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                content += chunk
+                if len(content) > MAXBYTES:
+                    log.warning("Snapshot from %s is larger than %d bytes, ignoring it", url, MAXBYTES)
+                    return None
+            return bytes(content)
+
+    def _recompress(self, content, maxwidth, quality):
+        if Image is None or not (maxwidth or quality):
+            return content
+        try:
+            image = Image.open(io.BytesIO(content))
+            if maxwidth and image.width > maxwidth:
+                image = image.resize((maxwidth, round(image.height * maxwidth / image.width)))
+            output = io.BytesIO()
+            image.convert('RGB').save(output, format='JPEG', quality=quality or 75, optimize=True)
+            return output.getvalue()
+        except Exception as exc:
+            log.warning("Could not recompress snapshot: %s", exc)
+            return content
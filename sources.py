@@ -0,0 +1,61 @@
+import importlib
+import logging
+
+"""
+Printer state sources. The protocol for `api: <name>` lives in the module protocol_<name>, which is
+only imported once a configured printer uses it. A protocol module has a `poll(printerinfo,
+timeout)` function, a `REQUIRED` tuple of printer settings, and optionally a `source(m, poller,
+wake)` factory for something smarter than polling; register() overrides that factory.
+
+The watcher asks the source of a printer for its current state. Polling sources fetch it over
+HTTP on every call; push sources keep a connection to the printer and wake the scheduler as soon
+as something happens.
+"""
+
+log = logging.getLogger('sources')
+
+factories = {}
+
+# Protocol clients live across polling cycles so their sessions keep connections alive
+clients = {}
+
+def getclient(printerinfo, factory):
+    client = clients.get(printerinfo['printer'])
+    if client is None:
+        client = factory()
+        clients[printerinfo['printer']] = client
+    return client
+
+def register(api, factory):
+    """Register `factory(m, poller, wake)` as the source for printers with `api: <api>`."""
+    factories[api] = factory
+
+def protocol(api):
+    """Import and return the protocol module for `api`."""
+    name = f"protocol_{api}"
+    try:
+        return importlib.import_module(name)
+    except ModuleNotFoundError as exc:
+        if exc.name != name:
+            raise
+        raise ValueError(f"Unknown api {api}")
+
+def create(m, wake=None):
+    module = protocol(m['api'])
+    factory = factories.get(m['api']) or getattr(module, 'source', PollingSource)
+    return factory(m, module.poll, wake)
+
+class PollingSource:
+    def __init__(self, m, poller, wake=None) -> None:
+        self.m = m
+        self.poller = poller
+        self.wake = wake
+
+    def start(self):
+        return self
+
+    def stop(self):
+        pass
+
+    def poll(self, timeout):
+        return self.poller(self.m, timeout=timeout)
@@ -0,0 +1,183 @@
+import json
+import logging
+import queue
+import threading
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+
+"""
+Read-through status API. The watcher hands every new printer state to a StatusCache, which
+serializes it once when it changed and keeps the bytes, so any number of clients are served from
+memory without touching the printers:
+
+    GET /printers          all states, keyed by printer name
+    GET /printers/<name>   the state of one printer
+    GET /events            server-sent events: every current state, then each change as it happens
+
+The JSON responses carry an ETag and answer If-None-Match with 304 Not Modified.
+"""
+
+log = logging.getLogger('statusapi')
+
+def etag(body):
+    return f'"{zlib.crc32(body):08x}-{len(body)}"'
+
+class StatusCache:
+    def __init__(self, default=None, keepalive=15, backlog=100) -> None:
+        self.default = default
+        self.keepalive = keepalive
+        self.backlog = backlog
+        self.entries = {}
+        self.events = {}
+        self.fleet = None
+        self.version = 0
+        self.subscribers = set()
+        self.lock = threading.Lock()
+
+    def update(self, name, state):
+        """Remember the state of printer `name`; returns True when it changed."""
+        body = json.dumps(state, default=self.default, sort_keys=True).encode()
+        with self.lock:
+            if name in self.entries and self.entries[name][0] == body:
+                return False
+            self.version += 1
+            self.entries[name] = (body, etag(body))
+            self.fleet = None
+            event = self._event('state', name, body)
+            self.events[name] = event
+            subscribers = list(self.subscribers)
+        self._send(subscribers, event)
+        return True
+
+    def remove(self, name):
+        with self.lock:
+            if self.entries.pop(name, None) is None:
+                return
+            self.events.pop(name, None)
+            self.version += 1
+            self.fleet = None
+            event = self._event('removed', name, b'null')
+            subscribers = list(self.subscribers)
+        self._send(subscribers, event)
+
+    def _event(self, kind, name, body):
+        data = b'{"printer": ' + json.dumps(name).encode() + b', "state": ' + body + b'}'
+        return f"event: {kind}\nid: {self.version}\n".encode() + b'data: ' + data + b'\n\n'
+
+    def _send(self, subscribers, event):
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                # Too slow to keep up; it gets disconnected and can come back for a fresh start
+                with self.lock:
+                    self.subscribers.discard(subscriber)
+                while not subscriber.empty():
+                    subscriber.get_nowait()
+                subscriber.put_nowait(None)
+
+    def printer(self, name):
+        with self.lock:
+            return self.entries.get(name)
+
+    def all(self):
+        with self.lock:
+            if self.fleet is None:
+                body = b'{' + b', '.join(json.dumps(name).encode() + b': ' + entry[0]
+                                         for name, entry in sorted(self.entries.items())) + b'}'
+                self.fleet = (body, etag(body))
+            return self.fleet
+
+    def subscribe(self):
+        """A queue that receives the current state of every printer and then every change; None means goodbye."""
+        subscriber = queue.Queue(maxsize=self.backlog + len(self.entries))
+        with self.lock:
+            for event in self.events.values():
+                subscriber.put_nowait(event)
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+class StatusHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        log.debug("%s %s", self.address_string(), format % args)
+
+    def _reply(self, status, body=b'', headers={}):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _json(self, entry):
+        if entry is None:
+            self._reply(404, b'{"error": "unknown printer"}', { 'Content-Type': 'application/json' })
+            return
+        body, tag = entry
+        headers = { 'ETag': tag, 'Cache-Control': 'no-cache' }
+        if self.headers.get('If-None-Match') == tag:
+            self._reply(304, headers=headers)
+        else:
+            self._reply(200, body, { 'Content-Type': 'application/json', **headers })
+
+    def do_GET(self):
+        cache = self.server.cache
+        path = urlsplit(self.path).path.rstrip('/')
+        if path == '/printers':
+            self._json(cache.all())
+        elif path.startswith('/printers/'):
+            self._json(cache.printer(unquote(path[len('/printers/'):])))
+        elif path == '/events':
+            self._events(cache)
+        else:
+            self._reply(404)
+
+    do_HEAD = do_GET
+
+    def _events(self, cache):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        if self.command == 'HEAD':
+            # Headers only; the stream itself would hold this thread forever
+            return
+        subscriber = cache.subscribe()
+        try:
+            while True:
+                try:
+                    event = subscriber.get(timeout=cache.keepalive)
+                except queue.Empty:
+                    event = b': keepalive\n\n'
+                if event is None:
+                    break
+                self.wfile.write(event)
+                self.wfile.flush()
+        except OSError:
+            pass
+        finally:
+            cache.unsubscribe(subscriber)
+
+class StatusServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, cache, port, address='') -> None:
+        self.cache = cache
+        super().__init__((address, port), StatusHandler)
+
+def serve(cache, port, address=''):
+    """Serve `cache` on `port` from a background thread."""
+    server = StatusServer(cache, port, address)
+    threading.Thread(target=server.serve_forever, name='statusapi', daemon=True).start()
+    log.info("Serving printer status on port %s", port)
+    return server
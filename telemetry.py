@@ -0,0 +1,163 @@
+import logging
+import sqlite3
+import threading
+import time
+from array import array
+
+"""
+Embedded time-series store for printer telemetry (temperatures, z-height and progress).
+
+Samples are appended to flat arrays in memory and written to SQLite (WAL mode) in batches. Every
+flush also rolls the samples up into 1 minute and 1 hour buckets (count/sum/min/max). Old data is
+pruned per resolution according to the retention settings, every `pruneinterval` seconds.
+"""
+
+log = logging.getLogger('telemetry')
+
+FIELDS = {
+    'bed': ('temperature', 'bed'),
+    'nozzle': ('temperature', 'nozzle'),
+    'targetbed': ('targettemperature', 'bed'),
+    'targetnozzle': ('targettemperature', 'nozzle'),
+    'zheight': ('z-height',),
+    'progress': ('progress',),
+}
+
+RESOLUTIONS = {
+    '1m': 60,
+    '1h': 3600,
+}
+
+DEFAULT_RETENTION = {
+    'raw': 24 * 3600,
+    '1m': 7 * 24 * 3600,
+    '1h': 365 * 24 * 3600,
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS raw (printer TEXT, field TEXT, ts REAL, value REAL);
+CREATE INDEX IF NOT EXISTS raw_lookup ON raw (printer, field, ts);
+CREATE INDEX IF NOT EXISTS raw_age ON raw (ts);
+CREATE TABLE IF NOT EXISTS rollup_1m (printer TEXT, field TEXT, bucket INTEGER, count INTEGER, sum REAL, min REAL, max REAL,
+                                      PRIMARY KEY (printer, field, bucket));
+CREATE TABLE IF NOT EXISTS rollup_1h (printer TEXT, field TEXT, bucket INTEGER, count INTEGER, sum REAL, min REAL, max REAL,
+                                      PRIMARY KEY (printer, field, bucket));
+"""
+
+def numeric(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+class TelemetryStore:
+    def __init__(self, path='telemetry.db', flushinterval=60, retention=None, pruneinterval=3600) -> None:
+        self.flushinterval = flushinterval
+        self.pruneinterval = pruneinterval
+        self.retention = { **DEFAULT_RETENTION, **(retention or {}) }
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA cache_size=-2000")
+        self.db.executescript(SCHEMA)
+        self.series = []
+        self.seriesindex = {}
+        self._reset()
+        self.lastflush = time.monotonic()
+        self.lastprune = None
+
+    def _reset(self):
+        self.keys = array('H')
+        self.timestamps = array('d')
+        self.values = array('d')
+
+    def _series(self, printer, field):
+        key = (printer, field)
+        index = self.seriesindex.get(key)
+        if index is None:
+            index = len(self.series)
+            self.series.append(key)
+            self.seriesindex[key] = index
+        return index
+
+    def record(self, printer, state, ts=None):
+        """Buffer the numeric telemetry fields of one state snapshot."""
+        ts = time.time() if ts is None else ts
+        with self.lock:
+            for field, path in FIELDS.items():
+                value = state
+                for key in path:
+                    value = value.get(key) if isinstance(value, dict) else None
+                if numeric(value):
+                    self.keys.append(self._series(printer, field))
+                    self.timestamps.append(ts)
+                    self.values.append(value)
+
+    def maybeflush(self):
+        if time.monotonic() - self.lastflush >= self.flushinterval:
+            self.flush()
+
+    def flush(self):
+        """Write buffered samples, update the rollups and apply retention."""
+        with self.lock:
+            keys, timestamps, values = self.keys, self.timestamps, self.values
+            self._reset()
+            self.lastflush = time.monotonic()
+            if not keys:
+                return
+            rows = [(*self.series[k], t, v) for k, t, v in zip(keys, timestamps, values)]
+            with self.db:
+                self.db.executemany("INSERT INTO raw VALUES (?, ?, ?, ?)", rows)
+                for resolution, width in RESOLUTIONS.items():
+                    self.db.executemany(f"""
+                        INSERT INTO rollup_{resolution} VALUES (?, ?, ?, 1, ?, ?, ?)
+                        ON CONFLICT (printer, field, bucket) DO UPDATE SET
+                            count = count + 1, sum = sum + excluded.sum,
+                            min = MIN(min, excluded.min), max = MAX(max, excluded.max)
+                        """, [(p, f, int(t // width) * width, v, v, v) for p, f, t, v in rows])
+                if self.lastprune is None or self.lastflush - self.lastprune >= self.pruneinterval:
+                    self.lastprune = self.lastflush
+                    self._prune(time.time())
+        log.debug("Flushed %d telemetry samples", len(rows))
+
+    def _prune(self, now):
+        self.db.execute("DELETE FROM raw WHERE ts < ?", (now - self.retention['raw'],))
+        for resolution in RESOLUTIONS:
+            self.db.execute(f"DELETE FROM rollup_{resolution} WHERE bucket < ?", (now - self.retention[resolution],))
+
+    def range(self, printer, field, start, end=None, resolution='raw'):
+        """
+        Samples of `field` for `printer` between `start` and `end` (unix timestamps).
+        'raw' returns (ts, value) tuples; '1m' and '1h' return (bucket, avg, min, max) tuples.
+        """
+        end = time.time() if end is None else end
+        with self.lock:
+            if resolution == 'raw':
+                query = "SELECT ts, value FROM raw WHERE printer = ? AND field = ? AND ts BETWEEN ? AND ? ORDER BY ts"
+            elif resolution in RESOLUTIONS:
+                # Include the bucket that `start` falls in
+                start = start - RESOLUTIONS[resolution] + 1
+                query = f"""SELECT bucket, sum / count, min, max FROM rollup_{resolution}
+                            WHERE printer = ? AND field = ? AND bucket BETWEEN ? AND ? ORDER BY bucket"""
+            else:
+                raise ValueError(f"Unknown resolution {resolution}")
+            return self.db.execute(query, (printer, field, start, end)).fetchall()
+
+    def aggregate(self, printer, field, start, end=None, resolution='1m'):
+        """count/avg/min/max of `field` over a time range, computed from the rollups."""
+        end = time.time() if end is None else end
+        if resolution not in RESOLUTIONS:
+            raise ValueError(f"Unknown resolution {resolution}")
+        start = start - RESOLUTIONS[resolution] + 1
+        with self.lock:
+            count, total, low, high = self.db.execute(f"""
+                SELECT SUM(count), SUM(sum), MIN(min), MAX(max) FROM rollup_{resolution}
+                WHERE printer = ? AND field = ? AND bucket BETWEEN ? AND ?""", (printer, field, start, end)).fetchone()
+        return {
+            'count': count or 0,
+            'avg': total / count if count else None,
+            'min': low,
+            'max': high,
+        }
+
+    def close(self):
+        self.flush()
+        self.db.close()
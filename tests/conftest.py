@@ -0,0 +1,118 @@
+import json
+import os
+import sys
+from urllib.parse import urlsplit
+import pytest
+import requests
+
+# The modules live at the top of the repository, next to the Dockerfile that copies them to /
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import watcher
+from publisher import DeltaPublisher
+
+class FakeDispatcher:
+    def __init__(self) -> None:
+        self.messages = []
+
+    def submit(self, key, message, picture=None, force=False, done=None):
+        self.messages.append({ 'key': key, 'message': message, 'force': force, 'done': done })
+
+    def join(self, timeout=None):
+        return True
+
+class FakeMethod:
+    """The delivery details pika hands to a consumer callback."""
+
+    def __init__(self, delivery_tag) -> None:
+        self.delivery_tag = delivery_tag
+
+class FakeChannel:
+    """
+    Stands in for a pika channel and its connection: records what is published, acked and
+    rejected, runs thread-safe callbacks at once and only collects timers. The first `failures`
+    publishes raise.
+    """
+
+    is_open = True
+
+    def __init__(self, failures=0, connected=True) -> None:
+        self.failures = failures
+        self.connected = connected
+        # (exchange, routing_key, body, properties) as published, and the JSON bodies decoded
+        self.messages = []
+        self.published = []
+        self.acks = []
+        self.nacks = []
+        self.timers = []
+        self.connection = self
+
+    def confirm_delivery(self):
+        pass
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("channel closed")
+        self.messages.append((exchange, routing_key, body, properties))
+        self.published.append(json.loads(body))
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.acks.append((delivery_tag, multiple))
+
+    def basic_nack(self, delivery_tag, requeue=True):
+        self.nacks.append((delivery_tag, requeue))
+
+    def call_later(self, delay, callback):
+        self.timers.append((delay, callback))
+
+    def add_callback_threadsafe(self, callback):
+        callback()
+
+class FakeResponse:
+    def __init__(self, status_code=200, body=None, headers=None) -> None:
+        self.status_code = status_code
+        self.content = json.dumps(body).encode() if body is not None else b''
+        self.text = self.content.decode()
+        self.headers = headers or {}
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"HTTP {self.status_code}", response=self)
+
+class FakeSession:
+    """
+    Stands in for a requests session: answers by URL path from `routes`, with a FakeResponse or a
+    callable taking the request headers, and records every request as (method, path, headers, kwargs).
+    """
+
+    def __init__(self, routes=None, default=None) -> None:
+        self.routes = routes or {}
+        self.default = default or FakeResponse(body={ 'ok': True })
+        self.requests = []
+
+    def request(self, method, url, headers=None, **kwargs):
+        path = urlsplit(url).path
+        self.requests.append((method, path, headers or {}, kwargs))
+        answer = self.routes.get(path, self.default)
+        return answer(headers or {}) if callable(answer) else answer
+
+    def get(self, url, headers=None, **kwargs):
+        return self.request('GET', url, headers=headers, **kwargs)
+
+    def post(self, url, headers=None, **kwargs):
+        return self.request('POST', url, headers=headers, **kwargs)
+
+@pytest.fixture
+def dispatcher(monkeypatch):
+    """Run the watcher state machine with captured messages and no optional features."""
+    dispatcher = FakeDispatcher()
+    monkeypatch.setattr(watcher, 'dispatcher', dispatcher)
+    monkeypatch.setattr(watcher, 'publisher', DeltaPublisher(FakeChannel(), 'test', confirm=False, default=watcher.jsonserializer))
+    for name in ('telemetry', 'checkpoint', 'statuscache', 'detector', 'digest', 'recorder', 'jobqueue', 'membership'):
+        monkeypatch.setattr(watcher, name, None)
+    monkeypatch.setattr(watcher, 'adopting', set())
+    return dispatcher
@@ -0,0 +1,26 @@
+import amqp
+from conftest import FakeChannel
+
+def connection(outboxsize=3):
+    conn = amqp.AmqpConnection(outboxsize=outboxsize)
+    # No I/O thread: the tests drive the outbox themselves
+    conn.thread = object()
+    conn.channel = FakeChannel()
+    return conn
+
+def test_publishing_only_fills_the_outbox():
+    conn = connection()
+    conn.basic_publish('printers', '', b'1')
+    assert conn.channel.messages == []
+    conn._drain()
+    assert conn.channel.messages == [('printers', '', b'1', None)]
+    assert not conn.outbox
+
+def test_full_outbox_drops_the_oldest():
+    conn = connection(outboxsize=3)
+    for i in range(5):
+        conn.basic_publish('printers', '', str(i).encode(), properties='persistent' if i == 4 else None)
+    assert conn.dropped == 2
+    conn._drain()
+    assert conn.channel.published == [2, 3, 4]
+    assert conn.channel.messages[-1][3] == 'persistent'
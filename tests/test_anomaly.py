@@ -0,0 +1,58 @@
+from anomaly import AnomalyDetector
+
+PRINTER = { 'printer': 'mk4' }
+
+def printing(nozzle, bed=60, progress=0.5, z=1.0):
+    return { 'printstate': 'printing', 'progress': progress, 'z-height': z,
+             'temperature': { 'nozzle': nozzle, 'bed': bed }, 'targettemperature': { 'nozzle': 215, 'bed': 60 } }
+
+def run(detector, readings, start=0, step=10):
+    changes = []
+    for i, state in enumerate(readings):
+        changes += [(start + i * step, kind, started) for kind, _, started in detector.observe(PRINTER, state, now=start + i * step)]
+    return changes
+
+def test_heat_up_does_not_count_after_settling():
+    # Regression: the heat-up readings stayed in the EWMA and flagged the nozzle right after settling
+    detector = AnomalyDetector({ 'settle': 300, 'alpha': 0.1 })
+    heatup = [printing(nozzle=25 + 6 * i, progress=i / 1000) for i in range(30)]
+    steady = [printing(nozzle=215 + (i % 3 - 1), progress=0.03 + i / 1000) for i in range(30)]
+    assert run(detector, heatup + steady) == []
+
+def test_drift_is_flagged_and_cleared():
+    detector = AnomalyDetector({ 'settle': 60, 'alpha': 0.5 })
+    readings = ([printing(nozzle=215, progress=i / 1000) for i in range(10)]
+                + [printing(nozzle=190, progress=0.01 + i / 1000) for i in range(5)]
+                + [printing(nozzle=215, progress=0.02 + i / 1000) for i in range(10)])
+    changes = run(detector, readings)
+    assert [(kind, started) for _, kind, started in changes] == [('nozzle', True), ('nozzle', False)]
+    assert not detector.active('mk4')
+
+def test_recovery_while_printing_is_back_to_normal():
+    detector = AnomalyDetector({ 'settle': 0, 'alpha': 1 })
+    detector.observe(PRINTER, printing(nozzle=190), now=0)
+    [(kind, message, started)] = detector.observe(PRINTER, printing(nozzle=215, progress=0.6), now=10)
+    assert (kind, started) == ('nozzle', False)
+    assert message.endswith("Back to normal")
+
+def test_alerts_of_a_printer_that_stops_printing_are_dropped_silently():
+    # Regression: an unreachable printer with a thermal fault, or a cancelled stalled print, reported "Back to normal"
+    for printstate in ('unknown', 'idle'):
+        detector = AnomalyDetector({ 'settle': 0, 'alpha': 1 })
+        assert [kind for kind, _, started in detector.observe(PRINTER, printing(nozzle=190), now=0)] == ['nozzle']
+        assert detector.observe(PRINTER, { 'printstate': printstate }, now=10) == []
+        assert not detector.active('mk4')
+
+def test_sudden_jump_within_a_noisy_history():
+    detector = AnomalyDetector({ 'settle': 0, 'alpha': 0.1, 'nozzletolerance': 5 })
+    readings = [printing(nozzle=215 + (i % 2), progress=i / 1000) for i in range(20)] + [printing(nozzle=228, progress=0.5)]
+    assert [kind for _, kind, started in run(detector, readings) if started] == ['nozzle']
+
+def test_stall():
+    detector = AnomalyDetector({ 'stalltime': 120 })
+    readings = [printing(nozzle=215, progress=0.4, z=2.0)] * 20
+    changes = run(detector, readings, step=10)
+    assert changes[0][:2] == (120, 'stall')
+    assert detector.active('mk4')
+    detector.observe(PRINTER, { 'printstate': 'idle' }, now=1000)
+    assert not detector.active('mk4')
@@ -0,0 +1,52 @@
+import os
+import subprocess
+import sys
+import pytest
+import watcher
+
+ENVIRONMENT = { 'APITOKEN': 'token', 'CHATID': '1', 'MQRABBIT_EXCHANGE': 'printers', 'MQRABBIT_HOST': 'broker' }
+
+def checkconfig(tmp_path, monkeypatch, text):
+    path = tmp_path / 'settings.yaml'
+    path.write_text(text)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('INPUTFILE', str(path))
+    for name, value in ENVIRONMENT.items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.setattr('sys.argv', ['watcher.py', '--check-config'])
+    with pytest.raises(SystemExit) as exit:
+        watcher.main()
+    return exit.value.code
+
+def test_valid_settings(tmp_path, monkeypatch, capsys):
+    code = checkconfig(tmp_path, monkeypatch, """
+settings: { interval: 10, cooldowntimeout: 600, cooldowntemperature: 40 }
+printers:
+  - { printer: mk4, api: prusalink, host: mk4.local, key: x, statusinterval: 60 }
+""")
+    assert code == 0
+    assert "1 printer(s), 0 problem(s)" in capsys.readouterr().out
+
+def test_problems_are_reported(tmp_path, monkeypatch, capsys):
+    code = checkconfig(tmp_path, monkeypatch, """
+settings: { interval: 10, cooldowntimeout: 600 }
+printers:
+  - { printer: op, api: octoprint, url: http://op, statusinterval: 60 }
+  - { printer: x, api: nosuchapi, statusinterval: 60 }
+""")
+    out = capsys.readouterr().out
+    assert code == 1
+    assert "settings: missing 'cooldowntemperature'" in out
+    assert "op: missing 'key' for api 'octoprint'" in out
+    assert "x: Unknown api nosuchapi" in out
+
+def test_malformed_file_is_reported(tmp_path, monkeypatch, capsys):
+    # Regression: a printers entry that is not a mapping gave a traceback instead of a report
+    code = checkconfig(tmp_path, monkeypatch, "settings: {}\nprinters:\n  - just a string\n")
+    assert code == 1
+    assert "printer #1 must be a mapping" in capsys.readouterr().out
+
+def test_import_leaves_heavy_and_optional_modules_alone():
+    code = "import sys, watcher; print(' '.join(sorted(m for m in sys.modules if m.split('.')[0] in ('prometheus_client', 'requests', 'pika', 'anomaly', 'recording'))))"
+    result = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(watcher.__file__), capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == ""
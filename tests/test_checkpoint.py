@@ -0,0 +1,46 @@
+from datetime import datetime, timedelta
+import watcher
+from checkpoint import StateCheckpoint
+
+GLOBALSETTINGS = { 'interval': 10, 'cooldowntimeout': 600, 'cooldowntemperature': 40 }
+PRINTER = { 'printer': 'mk4', 'api': 'prusalink', 'host': 'mk4', 'key': 'x', 'statusinterval': 60 }
+
+def test_roundtrip_keeps_state_machine_fields(tmp_path):
+    checkpoint = StateCheckpoint(str(tmp_path))
+    lastsend = datetime(2024, 5, 1, 12, 0)
+    assert checkpoint.update('mk4', { 'printstate': 'printing', 'lastsend': lastsend, 'jobname': 'benchy', 'z-height': 3.2 })
+    # Nothing changed in the checkpointed fields, so nothing is written
+    assert not checkpoint.update('mk4', { 'printstate': 'printing', 'lastsend': lastsend, 'jobname': 'benchy', 'z-height': 4.0 })
+
+    restored = StateCheckpoint(str(tmp_path)).load('mk4')
+    assert restored == { 'printstate': 'printing', 'lastsend': lastsend, 'jobname': 'benchy' }
+
+def test_unreadable_checkpoint_is_ignored(tmp_path):
+    (tmp_path / 'mk4.json').write_text('{ not json')
+    assert StateCheckpoint(str(tmp_path)).load('mk4') == {}
+
+def test_restored_print_ending_while_offline(tmp_path, dispatcher):
+    # Regression: a restored 'printing' state followed by an unknown poll used to raise KeyError: 'z-height'
+    previous = StateCheckpoint(str(tmp_path))
+    previous.update('mk4', { 'printstate': 'printing', 'lastsend': datetime.now() - timedelta(minutes=5), 'jobname': 'benchy' })
+
+    state = watcher.init_states([PRINTER], checkpoint=StateCheckpoint(str(tmp_path)))
+    assert state['mk4']['printstate'] == 'printing'
+    watcher.handle_state(state, PRINTER, { 'printstate': 'unknown' }, GLOBALSETTINGS)
+
+    assert state['mk4']['printstate'] == 'unknown'
+    assert 'cooldowntimeout' in state['mk4']
+    assert len(dispatcher.messages) == 1
+    assert "Printjob ended on mk4" in dispatcher.messages[0]['message']
+    assert "benchy" in dispatcher.messages[0]['message']
+
+def test_one_failing_printer_does_not_stop_the_cycle(dispatcher, monkeypatch):
+    def handle_state(state, m, handleroutput, globalsettings):
+        if m['printer'] == 'broken':
+            raise RuntimeError("boom")
+        state[m['printer']] = handleroutput
+    monkeypatch.setattr(watcher, 'handle_state', handle_state)
+    state = {}
+    watcher.safe_handle_state(state, { 'printer': 'broken' }, { 'printstate': 'idle' }, GLOBALSETTINGS)
+    watcher.safe_handle_state(state, { 'printer': 'fine' }, { 'printstate': 'idle' }, GLOBALSETTINGS)
+    assert state == { 'fine': { 'printstate': 'idle' } }
@@ -0,0 +1,50 @@
+import os
+import pytest
+import config
+
+GOOD = """
+settings: { interval: 10 }
+printers:
+  - { printer: a, api: prusalink }
+  - { printer: b, api: octoprint }
+"""
+
+def write(path, text, mtime):
+    path.write_text(text)
+    os.utime(path, (mtime, mtime))
+
+def test_load_rejects_bad_structure(tmp_path):
+    path = tmp_path / 'settings.yaml'
+    for text in ("settings: [\n", "printers: []\n", "settings: {}\nprinters:\n  - just a string\n",
+                 "settings: {}\nprinters:\n  - { printer: a }\n  - { printer: a }\n"):
+        path.write_text(text)
+        with pytest.raises(ValueError):
+            config.load(str(path))
+
+def test_diffprinters():
+    old = [{ 'printer': 'a', 'host': '1' }, { 'printer': 'b', 'host': '2' }]
+    new = [{ 'printer': 'b', 'host': '3' }, { 'printer': 'c', 'host': '4' }]
+    added, removed, changed = config.diffprinters(old, new)
+    assert [m['printer'] for m in added] == ['c']
+    assert [m['printer'] for m in removed] == ['a']
+    assert changed == [{ 'printer': 'b', 'host': '3' }]
+
+def test_watcher_keeps_old_settings_on_a_broken_file(tmp_path):
+    path = tmp_path / 'settings.yaml'
+    write(path, GOOD, 1000)
+    watcher = config.ConfigWatcher(str(path))
+    assert watcher.changed() is None
+
+    # Regression: a printers entry that is not a mapping escaped changed() as AttributeError
+    write(path, "settings: {}\nprinters:\n  - just a string\n", 2000)
+    assert watcher.changed() is None
+
+    write(path, GOOD.replace('octoprint', 'prusalink'), 3000)
+    assert watcher.changed()['printers'][1]['api'] == 'prusalink'
+
+def test_watcher_survives_a_failing_validator(tmp_path):
+    path = tmp_path / 'settings.yaml'
+    write(path, GOOD, 1000)
+    watcher = config.ConfigWatcher(str(path), validate=lambda settings: settings['missing'])
+    write(path, GOOD, 2000)
+    assert watcher.changed() is None
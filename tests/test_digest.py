@@ -0,0 +1,44 @@
+from digest import FleetDigest, formatduration
+
+def printing(progress, left):
+    return { 'printstate': 'printing', 'progress': progress, 'stillprinting': left, 'z-height': 12.4,
+             'temperature': { 'nozzle': 215.2, 'bed': 60.1 } }
+
+def test_duration():
+    assert formatduration(3720) == "1:02"
+    assert formatduration(None) == "0:00"
+
+def test_digest_lists_active_printers_once_per_interval():
+    clock = [0]
+    digest = FleetDigest(interval=600, clock=lambda: clock[0])
+    digest.update({ 'printer': 'mk4' }, printing(0.5, 3720))
+    digest.update({ 'printer': 'mini' }, { 'printstate': 'idle', 'cooldowntimeout': 1, 'temperature': { 'bed': 50 } })
+    digest.update({ 'printer': 'xl' }, { 'printstate': 'idle' })
+    sent = []
+    send = lambda message, picture=None, key=None: sent.append((key, message))
+    assert not digest.maybesend(send)
+    clock[0] = 600
+    assert digest.maybesend(send)
+    assert [key for key, _ in sent] == ['digest']
+    message = sent[0][1]
+    assert "2 active" in message
+    lines = message.split('\n')
+    assert any(line.startswith('mini') and 'cool' in line for line in lines)
+    assert any(line.startswith('mk4') and '50.0' in line and '1:02' in line for line in lines)
+    assert not any(line.startswith('xl') for line in lines)
+
+    digest.remove('mk4')
+    digest.update({ 'printer': 'mini' }, { 'printstate': 'idle' })
+    clock[0] = 1200
+    assert not digest.maybesend(send)
+
+def test_sharded_digests_do_not_replace_each_other():
+    # Regression: every replica keyed its digest 'digest', and the leader kept only the last one queued
+    sent = []
+    send = lambda message, picture=None, key=None: sent.append((key, message))
+    for shard, printer in (('watcher-0', 'mk4'), ('watcher-1', 'mini')):
+        digest = FleetDigest(interval=0, shard=shard, clock=lambda: 600)
+        digest.update({ 'printer': printer }, printing(0.5, 3720))
+        assert digest.maybesend(send)
+    assert [key for key, _ in sent] == ['digest:watcher-0', 'digest:watcher-1']
+    assert "Fleet status (watcher-1)" in sent[1][1]
@@ -0,0 +1,37 @@
+import pytest
+from fields import Extractor, Field, resolve
+from protocol_prusalink import PRUSALINK_LEGACY, PRUSALINK_V1
+
+def test_resolve():
+    document = { 'a': { 'b': [10, 20] } }
+    assert resolve(document, ('a', 'b', 1)) == 20
+    assert resolve(document, ('a', 'x'), default=0) == 0
+    assert resolve(document, ('a', 'b', 5), default=0) == 0
+    assert resolve({ 'a': None }, ('a',), default='none') == 'none'
+
+def test_defaults_alternatives_and_conversion():
+    extractor = Extractor(
+        jobname=Field('job', 'display_name', default='Unknown', alternatives=[('job', 'name')]),
+        progress=Field('progress', default=0, convert=lambda p: p / 100),
+        printstate=Field('state', convert=str.lower, default='unknown'),
+    )
+    snapshot = extractor.extract({ 'job': { 'name': 'benchy' }, 'progress': 'n/a' })
+    assert (snapshot.jobname, snapshot.progress, snapshot.printstate) == ('benchy', 0, 'unknown')
+    with pytest.raises(ValueError):
+        Extractor(colour=Field('c'))
+
+def test_prusalink_v1_status():
+    status = { 'status': { 'printer': { 'state': 'PRINTING', 'temp_bed': 60.1, 'temp_nozzle': 214.8, 'target_bed': 60,
+                                        'target_nozzle': 215, 'axis_z': 1.2 },
+                           'job': { 'time_printing': 600, 'time_remaining': 1200, 'progress': 33 } },
+               'job': { 'file': { 'display_name': 'Benchy.gcode' } } }
+    state = PRUSALINK_V1.extract(status).asstate()
+    assert state['printstate'] == 'printing'
+    assert state['temperature'] == { 'bed': 60.1, 'nozzle': 214.8 }
+    assert state['targettemperature'] == { 'bed': 60, 'nozzle': 215 }
+    assert (state['z-height'], state['progress'], state['jobname']) == (1.2, 0.33, 'Benchy.gcode')
+
+def test_prusalink_legacy_idle():
+    state = PRUSALINK_LEGACY.extract({ 'job': { 'state': 'Operational' }, 'printer': {} }).asstate()
+    assert state['printstate'] == 'idle'
+    assert (state['progress'], state['jobname'], state['alreadyprinted']) == (0, 'Unknown', 0)
@@ -0,0 +1,59 @@
+import hashlib
+import jobs
+from prusalink import UploadBody
+from conftest import FakeResponse
+
+class Client:
+    def __init__(self, listing=None) -> None:
+        self.listing = listing or { 'files': [] }
+        self.uploads = []
+        self.started = []
+
+    def list_files(self, maxage=None):
+        return self.listing
+
+    def post_gcode(self, path, progress=None):
+        with UploadBody(path, progress=progress, chunksize=4) as body:
+            data = b''
+            while True:
+                chunk = body.read()
+                if not chunk:
+                    break
+                data += chunk
+        self.uploads.append(data)
+        return FakeResponse(201)
+
+    def post_print_gcode(self, path):
+        self.started.append(path)
+        return FakeResponse(201)
+
+def gcode(tmp_path, content=b'G28\nG1 X10\n'):
+    path = tmp_path / 'part.gcode'
+    path.write_bytes(content)
+    return str(path), hashlib.sha256(content).hexdigest()
+
+def test_upload_body_streams_a_multipart_form(tmp_path):
+    path, _ = gcode(tmp_path)
+    reports = []
+    with UploadBody(path, progress=lambda sent, total: reports.append((sent, total)), chunksize=4) as body:
+        data = b''.join(iter(body.read, b''))
+    assert len(data) == len(body)
+    assert body.contenttype == f'multipart/form-data; boundary={body.boundary}'
+    assert b'filename="part.gcode"' in data and b'\r\n\r\nG28\nG1 X10\n\r\n--' in data
+    assert reports[-1] == (len(body), len(body))
+
+def test_findfile_walks_folders():
+    listing = { 'files': [{ 'name': 'USB', 'children': [{ 'name': 'PART~1.GCO', 'display': 'part.gcode', 'size': 11 }] }] }
+    assert jobs.findfile(listing, 'part.gcode', 11, 'x')['name'] == 'PART~1.GCO'
+    assert jobs.findfile(listing, 'part.gcode', 12, 'x') is None
+    assert jobs.findfile({ 'files': [{ 'name': 'part.gcode', 'hash': 'abc' }] }, 'part.gcode', 11, 'def') is None
+
+def test_distribute_skips_printers_that_have_the_file(tmp_path):
+    path, digest = gcode(tmp_path)
+    clients = { 'a': Client(), 'b': Client({ 'files': [{ 'name': 'part.gcode', 'hash': digest }] }) }
+    dispatcher = jobs.JobDispatcher(lambda m: clients[m['printer']])
+    results = dispatcher.distribute([{ 'printer': 'a' }, { 'printer': 'b' }], path, start=True)
+    assert { name: future.result() for name, future in results.items() } == { 'a': 'uploaded and started', 'b': 'skipped and started' }
+    assert len(clients['a'].uploads) == 1 and clients['b'].uploads == []
+    # Uploaded once; the next time it is known without asking the printer
+    assert dispatcher.upload({ 'printer': 'a' }, path) == 'skipped'
@@ -0,0 +1,41 @@
+import gzip
+import json
+import logging
+import logsetup
+
+def test_rotating_json_file_with_compressed_backups(tmp_path):
+    path = str(tmp_path / 'debuglog')
+    handler = logsetup.filehandler({ **logsetup.DEFAULTS, 'file': path, 'maxbytes': 400, 'level': 'DEBUG' })
+    logger = logging.getLogger('test.logsetup')
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(handler)
+    try:
+        for i in range(20):
+            logsetup.debuglog(logger, f"State {i}", { 'printstate': 'idle', 'i': i })
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+    lines = open(path).read().splitlines()
+    entry = json.loads(lines[-1])
+    assert entry['message'] == "State 19" and entry['data'] == { 'printstate': 'idle', 'i': 19 }
+    with gzip.open(path + '.1.gz', 'rt') as backup:
+        assert json.loads(backup.readline())['logger'] == 'test.logsetup'
+    assert not (tmp_path / 'debuglog.4.gz').exists()
+
+def test_debuglog_copies_and_skips_when_disabled():
+    records = []
+    class Capture(logging.Handler):
+        def emit(self, record):
+            records.append(record)
+    logger = logging.getLogger('test.debuglog')
+    logger.propagate = False
+    logger.addHandler(Capture())
+    data = { 'printstate': 'idle' }
+    logger.setLevel(logging.INFO)
+    logsetup.debuglog(logger, "State", data)
+    assert records == []
+    logger.setLevel(logging.DEBUG)
+    logsetup.debuglog(logger, "State", data)
+    data['printstate'] = 'printing'
+    assert records[0].data == { 'printstate': 'idle' }
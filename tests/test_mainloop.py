@@ -0,0 +1,55 @@
+import concurrent.futures
+import time
+import watcher
+
+GLOBALSETTINGS = { 'interval': 10, 'cooldowntimeout': 600, 'cooldowntemperature': 40, 'polltimeout': 0.1 }
+
+def printers(count):
+    return [{ 'printer': f"p{i}", 'api': 'prusalink', 'statusinterval': 60 } for i in range(count)]
+
+def test_queued_polls_are_not_late(dispatcher, monkeypatch):
+    # Regression: the deadline ran from submit time, so printers waiting for a worker came back 'unknown'
+    def poll(m, timeout):
+        time.sleep(0.08)
+        return { 'printstate': 'idle' }
+    monkeypatch.setattr(watcher, 'poll', poll)
+    settings = printers(8)
+    state = watcher.init_states(settings)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        watcher.main_loop(state, settings, GLOBALSETTINGS, executor, workers=2)
+    assert [state[m['printer']]['printstate'] for m in settings] == ['idle'] * 8
+
+def test_slow_poll_is_used(dispatcher, monkeypatch):
+    # Regression: an answer slower than polltimeout * (retries + 1) was replaced by 'unknown'
+    def poll(m, timeout):
+        time.sleep(0.4 if m['printer'] == 'p1' else 0.01)
+        return { 'printstate': 'printing' }
+    monkeypatch.setattr(watcher, 'poll', poll)
+    settings = printers(3)
+    state = watcher.init_states(settings)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+        watcher.main_loop(state, settings, GLOBALSETTINGS, executor, workers=3)
+    assert [state[m['printer']]['printstate'] for m in settings] == ['printing'] * 3
+
+def test_missed_cycle_keeps_last_state(dispatcher, monkeypatch):
+    def poll(m, timeout):
+        time.sleep(0.5 if m['printer'] == 'p1' else 0.01)
+        return { 'printstate': 'printing' }
+    monkeypatch.setattr(watcher, 'poll', poll)
+    settings = printers(2)
+    state = watcher.init_states(settings)
+    state['p1']['printstate'] = 'printing'
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        watcher.main_loop(state, settings, { **GLOBALSETTINGS, 'cycletimeout': 0.2 }, executor, workers=2)
+    assert state['p1']['printstate'] == 'printing'
+    assert not any('ended' in m['message'] for m in dispatcher.messages)
+
+def test_failing_poll_is_unknown(dispatcher, monkeypatch):
+    def poll(m, timeout):
+        raise ConnectionError("no route to host")
+    monkeypatch.setattr(watcher, 'poll', poll)
+    settings = printers(1)
+    state = watcher.init_states(settings)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        watcher.main_loop(state, settings, GLOBALSETTINGS, executor)
+    assert state['p0']['printstate'] == 'unknown'
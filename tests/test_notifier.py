@@ -0,0 +1,87 @@
+import threading
+import time
+from notifier import TelegramDispatcher
+from conftest import FakeSession
+
+def text(kwargs):
+    return (kwargs.get('json') or {}).get('text') or (kwargs.get('params') or {}).get('caption')
+
+class GatedSession(FakeSession):
+    """Holds a message back until the event in `gate` for its text is set; the first `failures` posts raise."""
+
+    def __init__(self, failures=0) -> None:
+        super().__init__()
+        self.gate = {}
+        self.failures = failures
+
+    def post(self, url, **kwargs):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("telegram unreachable")
+        gate = self.gate.get(text(kwargs))
+        if gate:
+            gate.wait(5)
+        return super().post(url, **kwargs)
+
+def dispatcher(workers=2):
+    dispatcher = TelegramDispatcher('token', 'chat', workers=workers, batchwindow=0, apiurl='http://telegram.invalid')
+    dispatcher.session = GatedSession()
+    return dispatcher
+
+def sent(dispatcher):
+    return [text(kwargs) for _, _, _, kwargs in dispatcher.session.requests]
+
+def test_submit_wakes_a_worker_while_join_waits():
+    d = dispatcher(workers=2)
+    release = threading.Event()
+    d.session.gate['slow'] = release
+    other = next(key for key in 'bcdefgh' if d._worker(key) != d._worker('a'))
+    d.submit('a', 'slow', force=True)
+    time.sleep(0.1)
+    joined = threading.Thread(target=d.join, kwargs={ 'timeout': 5 })
+    joined.start()
+    time.sleep(0.1)
+    d.submit(other, 'quick', force=True)
+    deadline = time.monotonic() + 2
+    while 'quick' not in sent(d) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert 'quick' in sent(d)
+    release.set()
+    joined.join(5)
+    assert sorted(sent(d)) == ['quick', 'slow']
+
+def test_routine_message_is_superseded():
+    d = dispatcher(workers=1)
+    release = threading.Event()
+    d.session.gate['first'] = release
+    d.submit('x', 'first', force=True)
+    time.sleep(0.1)
+    done = []
+    d.submit('a', 'old', done=lambda: done.append('old'))
+    d.submit('a', 'new', done=lambda: done.append('new'))
+    assert done == ['old']
+    release.set()
+    assert d.join(timeout=5)
+    assert sent(d) == ['first', 'new']
+    assert done == ['old', 'new']
+
+def test_messages_of_one_printer_keep_their_order():
+    d = dispatcher(workers=4)
+    for i in range(20):
+        d.submit(f"p{i % 5}", f"p{i % 5} {i}\n", force=True)
+        time.sleep(0.005)
+    assert d.join(timeout=5)
+    lines = "".join(sent(d)).split()
+    for printer in range(5):
+        numbers = [int(n) for p, n in zip(lines[::2], lines[1::2]) if p == f"p{printer}"]
+        assert numbers == sorted(numbers) and len(numbers) == 4
+
+def test_forced_messages_are_retried_after_an_error(monkeypatch):
+    monkeypatch.setattr('notifier.ERRORPAUSE', 0)
+    d = dispatcher(workers=1)
+    d.session = GatedSession(failures=2)
+    d.submit('a', 'routine')
+    d.submit('b', 'ended', force=True)
+    assert d.join(timeout=5)
+    assert sent(d) == ['ended']
+    assert d.dropped == 1
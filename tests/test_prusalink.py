@@ -0,0 +1,50 @@
+from prusalink import prusalink
+from conftest import FakeResponse, FakeSession
+
+def asked(printer):
+    """(path, If-None-Match) of every request the client made."""
+    return [(path, headers.get('If-None-Match')) for _, path, headers, _ in printer.session.requests]
+
+def client(routes):
+    printer = prusalink('mk4.local', 'key')
+    printer.session = FakeSession(routes)
+    return printer
+
+def test_v1_status_is_one_round_trip():
+    status = { 'printer': { 'state': 'PRINTING' }, 'job': { 'id': 12, 'progress': 50 } }
+    printer = client({
+        '/api/version': FakeResponse(body={ 'api': '2.0.0' }),
+        '/api/v1/status': FakeResponse(body=status),
+        '/api/v1/job': FakeResponse(body={ 'id': 12, 'file': { 'name': 'benchy.gcode' } }),
+    })
+    first = printer.get_status()
+    assert first == { 'api': 'v1', 'status': status, 'job': { 'id': 12, 'file': { 'name': 'benchy.gcode' } } }
+    printer.session.requests.clear()
+    # Same job: only the status
+    assert printer.get_status()['job']['id'] == 12
+    assert [path for path, _ in asked(printer)] == ['/api/v1/status']
+
+def test_legacy_firmware_gets_printer_and_job():
+    printer = client({
+        '/api/version': FakeResponse(body={ 'api': '0.9.0-legacy' }),
+        '/api/printer': FakeResponse(body={ 'telemetry': { 'temp-bed': 60 } }),
+        '/api/job': FakeResponse(body={ 'state': 'Operational' }),
+    })
+    assert printer.get_status() == { 'api': 'legacy', 'printer': { 'telemetry': { 'temp-bed': 60 } }, 'job': { 'state': 'Operational' } }
+
+def test_not_modified_answers_with_the_cached_response():
+    status = FakeResponse(body={ 'printer': { 'state': 'IDLE' }, 'job': {} }, headers={ 'ETag': '"abc"' })
+    answers = iter([status, FakeResponse(304), FakeResponse(304)])
+    printer = client({ '/api/v1/status': lambda headers: next(answers) })
+    assert printer.get_v1_status() is status
+    assert printer.get_v1_status() is status
+    assert printer.get_v1_status().json() == { 'printer': { 'state': 'IDLE' }, 'job': {} }
+    assert asked(printer) == [('/api/v1/status', None), ('/api/v1/status', '"abc"'), ('/api/v1/status', '"abc"')]
+
+def test_answer_without_etag_drops_the_cache():
+    answers = iter([FakeResponse(body={ 'n': 1 }, headers={ 'ETag': '"1"' }), FakeResponse(body={ 'n': 2 }), FakeResponse(body={ 'n': 3 })])
+    printer = client({ '/api/job': lambda headers: next(answers) })
+    printer.get_job()
+    assert printer.get_job().json() == { 'n': 2 }
+    assert printer.get_job().json() == { 'n': 3 }
+    assert [etag for _, etag in asked(printer)] == [None, '"1"', None]
@@ -0,0 +1,70 @@
+import json
+import pytest
+import prusargb
+from conftest import FakeChannel, FakeMethod
+
+class RecordingSink:
+    def __init__(self) -> None:
+        self.offers = []
+
+    def offer(self, printer, state):
+        self.offers.append((printer, dict(state)))
+
+    def maybeflush(self):
+        pass
+
+    def due(self):
+        return None
+
+def full(printer, **state):
+    return json.dumps({ 'type': 'full', 'machine': { 'printer': printer }, 'state': state })
+
+def delta(printer, **state):
+    return json.dumps({ 'type': 'delta', 'machine': { 'printer': printer }, 'state': state })
+
+@pytest.fixture
+def sink(monkeypatch):
+    sink = RecordingSink()
+    monkeypatch.setattr(prusargb, 'states', {})
+    monkeypatch.setattr(prusargb, 'pending', [])
+    monkeypatch.setattr(prusargb, 'outputs', [sink])
+    monkeypatch.setattr(prusargb, 'flushscheduled', False)
+    monkeypatch.setattr(prusargb, 'batchsize', 4)
+    return sink
+
+def deliver(channel, bodies):
+    for tag, body in enumerate(bodies, start=1):
+        prusargb.callback(channel, FakeMethod(tag), None, body)
+
+def test_updates_for_one_printer_are_coalesced(sink):
+    channel = FakeChannel()
+    deliver(channel, [full('mk4', printstate='printing', progress=0.1), delta('mk4', progress=0.2),
+                      full('mini', printstate='idle'), delta('mk4', progress=0.3)])
+    assert sink.offers == [('mk4', { 'printstate': 'printing', 'progress': 0.3 }), ('mini', { 'printstate': 'idle' })]
+    assert channel.acks == [(4, True)]
+
+def test_first_message_schedules_the_flush(sink):
+    channel = FakeChannel()
+    deliver(channel, [full('mk4', printstate='idle')])
+    assert sink.offers == [] and len(channel.timers) == 1
+    delay, flush = channel.timers[0]
+    assert delay == prusargb.batchwait
+    flush()
+    assert sink.offers == [('mk4', { 'printstate': 'idle' })]
+    assert channel.acks == [(1, True)]
+
+def test_poison_messages_are_rejected_and_the_rest_acked(sink):
+    channel = FakeChannel()
+    deliver(channel, [full('mk4', printstate='printing'), b'not json', delta('mk4', progress=0.5), json.dumps({ 'type': 'delta' })])
+    # Not requeued, so a dead letter exchange on the queue gets them
+    assert channel.nacks == [(2, False), (4, False)]
+    # One multiple ack up to the last good message; the rejected tags are settled already
+    assert channel.acks == [(3, True)]
+    assert sink.offers == [('mk4', { 'printstate': 'printing', 'progress': 0.5 })]
+
+def test_batch_of_only_poison_messages_is_not_acked(sink):
+    channel = FakeChannel()
+    deliver(channel, [b'{', b'[]', b'null', b'"x"'])
+    assert [tag for tag, _ in channel.nacks] == [1, 2, 3, 4]
+    assert channel.acks == []
+    assert sink.offers == []
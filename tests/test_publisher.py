@@ -0,0 +1,74 @@
+import random
+import publisher
+from publisher import DeltaPublisher
+from conftest import FakeChannel
+
+def consume(bodies, states=None):
+    states = {} if states is None else states
+    for body in bodies:
+        for update in publisher.expand(body):
+            publisher.apply(states, update)
+    return states
+
+def test_first_update_is_full_then_deltas():
+    channel = FakeChannel()
+    clock = [0]
+    p = DeltaPublisher(channel, 'x', heartbeat=300, clock=lambda: clock[0])
+    p.update('mk4', { 'printstate': 'printing', 'progress': 0.1, 'temperature': { 'bed': 60.0 } })
+    p.flush()
+    p.update('mk4', { 'printstate': 'printing', 'progress': 0.2, 'temperature': { 'bed': 60.2 } })
+    p.flush()
+    first, second = [body['updates'][0] for body in channel.published]
+    assert first['type'] == 'full'
+    # The bed moved less than the temperature tolerance
+    assert second == { 'machine': { 'printer': 'mk4' }, 'type': 'delta', 'state': { 'progress': 0.2 } }
+    p.update('mk4', { 'printstate': 'printing', 'progress': 0.2, 'temperature': { 'bed': 60.2 } })
+    p.flush()
+    assert len(channel.published) == 2
+    clock[0] = 301
+    p.update('mk4', { 'printstate': 'printing', 'progress': 0.2, 'temperature': { 'bed': 60.2 } })
+    p.flush()
+    assert channel.published[-1]['updates'][0]['type'] == 'full'
+
+def test_deltas_of_one_cycle_are_merged():
+    channel = FakeChannel()
+    p = DeltaPublisher(channel, 'x')
+    p.update('mk4', { 'printstate': 'idle', 'cooldowntimeout': 'soon', 'jobname': 'a' })
+    p.flush()
+    p.update('mk4', { 'printstate': 'idle', 'jobname': 'b' })
+    p.update('mk4', { 'printstate': 'printing', 'jobname': 'b', 'cooldowntimeout': 'later' })
+    p.flush()
+    update = channel.published[-1]['updates'][0]
+    assert update['state'] == { 'printstate': 'printing', 'jobname': 'b', 'cooldowntimeout': 'later' }
+    assert 'removed' not in update
+
+def test_consumer_reconstructs_the_published_states():
+    random.seed(7)
+    channel = FakeChannel()
+    p = DeltaPublisher(channel, 'x', heartbeat=10 ** 9, tolerance={ 'temperature': 0 })
+    truth = {}
+    for cycle in range(200):
+        for name in ('a', 'b', 'c'):
+            state = { 'printstate': random.choice(['idle', 'printing']), 'progress': random.randint(0, 3) }
+            if random.random() < 0.5:
+                state['cooldowntimeout'] = random.randint(0, 2)
+            truth[name] = state
+            p.update(name, state)
+        p.flush()
+    assert consume(channel.published) == truth
+
+def test_old_style_messages_are_understood():
+    old = { 'machine': { 'printer': 'mk4', 'api': 'prusalink' }, 'state': { 'printstate': 'idle' } }
+    assert consume([old]) == { 'mk4': { 'printstate': 'idle' } }
+
+def test_failed_publish_forces_a_full_snapshot():
+    channel = FakeChannel(failures=1)
+    p = DeltaPublisher(channel, 'x')
+    p.update('mk4', { 'printstate': 'idle' })
+    try:
+        p.flush()
+    except ConnectionError:
+        pass
+    p.update('mk4', { 'printstate': 'idle' })
+    p.flush()
+    assert channel.published[0]['updates'][0]['type'] == 'full'
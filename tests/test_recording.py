@@ -0,0 +1,57 @@
+import pytest
+import recording
+import replay
+import watcher
+
+SETTINGS = {
+    'settings': { 'interval': 60, 'cooldowntimeout': 600, 'cooldowntemperature': 40 },
+    'printers': [{ 'printer': 'mk4', 'api': 'prusalink', 'statusinterval': 3600 }],
+}
+
+def printing(progress):
+    return { 'printstate': 'printing', 'progress': progress, 'jobname': 'benchy', 'z-height': 1.0,
+             'temperature': { 'bed': 60, 'nozzle': 215 }, 'targettemperature': { 'bed': 60, 'nozzle': 215 } }
+
+def idle(bed):
+    return { 'printstate': 'idle', 'temperature': { 'bed': bed, 'nozzle': 30 }, 'targettemperature': { 'bed': 0, 'nozzle': 0 } }
+
+def record(path, outputs, start=1_700_000_000):
+    clock = [start]
+    recorder = recording.Recorder(str(path), clock=lambda: clock[0])
+    for output in outputs:
+        recorder.record('mk4', output)
+        recorder.endcycle()
+        clock[0] += 60
+    recorder.close()
+
+def test_round_trip(tmp_path):
+    path = tmp_path / 'recording.jsonl.gz'
+    record(path, [idle(25), printing(0.1)])
+    entries = list(recording.read(str(path)))
+    assert entries == [(1_700_000_000, 'mk4', idle(25)), (1_700_000_000, None, None),
+                       (1_700_000_060, 'mk4', printing(0.1)), (1_700_000_060, None, None)]
+
+def test_cut_off_recording_is_read_up_to_the_damage(tmp_path):
+    path = tmp_path / 'recording.jsonl.gz'
+    record(path, [idle(25), printing(0.1)])
+    data = path.read_bytes()
+    path.write_bytes(data[:-12])
+    entries = list(recording.read(str(path)))
+    assert entries[0] == (1_700_000_000, 'mk4', idle(25))
+
+@pytest.fixture
+def restore(monkeypatch):
+    # replay() swaps the watcher's globals for its virtual clock and capturing fakes
+    for name in ('clock', 'dispatcher', 'publisher', 'detector', 'digest', 'telemetry', 'checkpoint',
+                 'statuscache', 'jobqueue', 'recorder', 'membership'):
+        monkeypatch.setattr(watcher, name, getattr(watcher, name))
+
+def test_replay_runs_the_state_machine(tmp_path, restore):
+    path = tmp_path / 'recording.jsonl.gz'
+    record(path, [idle(25), printing(0.1), printing(0.5), idle(58), idle(35), idle(30)])
+    result = replay.replay(str(path), SETTINGS)
+    headlines = [m['message'].strip().splitlines()[0] for m in result['messages']]
+    assert headlines == ["<b>Printjob started on mk4</b>", "<b>Printjob ended on mk4</b>", "<b>Final cool down on mk4</b>"]
+    assert result['polls'] == 6
+    assert result['state']['mk4']['printstate'] == 'idle'
+    assert result['published']
@@ -0,0 +1,53 @@
+import threading
+from scheduler import PollScheduler
+
+GLOBALSETTINGS = { 'interval': 60 }
+
+def printer(name, **poll):
+    return { 'printer': name, 'poll': poll } if poll else { 'printer': name }
+
+def test_cadence_follows_the_printer_state():
+    scheduler = PollScheduler([], GLOBALSETTINGS)
+    m = printer('mk4')
+    assert scheduler.cadence(m, { 'printstate': 'idle' }) == 240
+    assert scheduler.cadence(m, { 'printstate': 'idle', 'cooldowntimeout': 1 }) == 30
+    assert scheduler.cadence(m, { 'printstate': 'printing', 'alreadyprinted': 3600, 'stillprinting': 3600 }) == 60
+    # Just started or almost done
+    assert scheduler.cadence(m, { 'printstate': 'printing', 'alreadyprinted': 30, 'stillprinting': 3600 }) == 15
+    assert scheduler.cadence(m, { 'printstate': 'printing', 'alreadyprinted': 3600, 'stillprinting': 60 }) == 15
+    assert scheduler.cadence(printer('mini', idle=30), { 'printstate': 'idle' }) == 30
+
+def test_unreachable_printers_back_off():
+    scheduler = PollScheduler([printer('mk4')], GLOBALSETTINGS)
+    m = scheduler.printers['mk4']
+    delays = []
+    for i in range(8):
+        scheduler.reschedule(m, { 'printstate': 'unknown' }, now=0)
+        delays.append(scheduler.cadence(m, { 'printstate': 'unknown' }))
+    assert delays[:5] == [60, 120, 240, 480, 960]
+    assert max(delays) == 1200
+    scheduler.reschedule(m, { 'printstate': 'idle' }, now=0)
+    assert 'mk4' not in scheduler.failures
+
+def test_due_returns_each_printer_once():
+    scheduler = PollScheduler([printer('a'), printer('b')], GLOBALSETTINGS)
+    now = 1e9
+    assert sorted(m['printer'] for m in scheduler.due(now)) == ['a', 'b']
+    scheduler.reschedule(scheduler.printers['a'], { 'printstate': 'idle' }, now=now)
+    scheduler.reschedule(scheduler.printers['b'], { 'printstate': 'printing', 'alreadyprinted': 3600, 'stillprinting': 3600 }, now=now)
+    assert scheduler.due(now + 59) == []
+    assert scheduler.wait(now + 59) == 1
+    assert [m['printer'] for m in scheduler.due(now + 60)] == ['b']
+    scheduler.remove('a')
+    assert scheduler.due(now + 1000) == []
+
+def test_pollsoon_pulls_a_poll_forward_and_wakes_the_sleeper():
+    scheduler = PollScheduler([printer('mk4')], GLOBALSETTINGS)
+    scheduler.due()
+    scheduler.reschedule(scheduler.printers['mk4'], { 'printstate': 'idle' })
+    assert scheduler.due() == []
+    threading.Timer(0.05, scheduler.pollsoon, args=('mk4',)).start()
+    scheduler.sleep(5)
+    assert [m['printer'] for m in scheduler.due()] == ['mk4']
+    # The later, superseded entry does not come back
+    assert scheduler.wait() == GLOBALSETTINGS['interval']
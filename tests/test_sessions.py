@@ -0,0 +1,92 @@
+import threading
+import requests
+import sessions
+
+def test_parallel_keeps_order_and_raises():
+    assert sessions.parallel(lambda: 1, lambda: 2, lambda: 3) == [1, 2, 3]
+    try:
+        sessions.parallel(lambda: 1, lambda: 1 / 0)
+    except ZeroDivisionError:
+        pass
+    else:
+        raise AssertionError("expected the exception of the failing call")
+
+def test_pools_are_separate():
+    names = sessions.parallel(lambda: threading.current_thread().name, pool='notifier')
+    assert names[0].startswith('notifier_')
+    assert sessions.parallel(lambda: threading.current_thread().name)[0].startswith('subrequest_')
+
+def test_nested_calls_on_a_full_pool_do_not_deadlock(monkeypatch):
+    monkeypatch.setitem(sessions.POOLS, 'nested', 2)
+    inner = lambda: sessions.parallel(lambda: 1, lambda: 2, pool='nested')
+    assert sessions.parallel(inner, inner, inner, pool='nested') == [[1, 2]] * 3
+
+def test_digest_inside_notifier_task():
+    def compose():
+        return sum(sessions.parallel(*[lambda i=i: i for i in range(20)], pool='digest'))
+    results = sessions.parallel(*[compose for _ in range(20)], pool='notifier')
+    assert results == [190] * 20
+
+def test_sessions_are_shared_and_keep_connections_alive():
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    peers = []
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            peers.append(self.client_address)
+            self.send_response(200)
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'ok')
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        name = f"127.0.0.1:{server.server_address[1]}"
+        session = sessions.getsession(name)
+        assert sessions.getsession(name) is session
+        for _ in range(5):
+            assert session.get(f"http://{name}/").text == 'ok'
+        assert len(peers) == 5 and len(set(peers)) == 1
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_default_timeout_is_applied(monkeypatch):
+    seen = {}
+    def send(self, request, **kwargs):
+        seen.update(kwargs)
+        raise ConnectionError("stop here")
+    monkeypatch.setattr(sessions.HTTPAdapter, 'send', send)
+    session = sessions.newsession(timeout=7)
+    for kwargs, expected in (({}, 7), ({ 'timeout': 2 }, 2)):
+        try:
+            session.get("http://printer.invalid/", **kwargs)
+        except ConnectionError:
+            pass
+        assert seen['timeout'] == expected
+
+def test_octoprint_polls_use_the_poll_timeout(monkeypatch):
+    # Regression: octorest passes no timeout, so its requests waited the session default of 30 seconds
+    import protocol_octoprint
+    import sources
+    seen = []
+    def send(self, request, **kwargs):
+        seen.append(kwargs['timeout'])
+        response = requests.Response()
+        response.status_code = 200
+        response._content = b'{}'
+        return response
+    monkeypatch.setattr(sessions.HTTPAdapter, 'send', send)
+    m = { 'printer': 'op-timeout', 'api': 'octoprint', 'url': 'http://octoprint.invalid', 'key': 'key', 'layerplugin': True }
+    try:
+        for timeout in (3, 5):
+            seen.clear()
+            assert protocol_octoprint.poll(m, timeout=timeout)['printstate'] == 'idle'
+            assert seen and set(seen) == { timeout }
+    finally:
+        sources.clients.pop('op-timeout', None)
+        sessions._sessions.pop('octoprint:http://octoprint.invalid', None)
@@ -0,0 +1,79 @@
+import json
+import pytest
+import sharding
+from conftest import FakeChannel, FakeDispatcher, FakeMethod
+
+NAMES = [f"printer{i}" for i in range(200)]
+
+def test_ring_moves_only_the_printers_of_a_new_member():
+    before = sharding.HashRing(['watcher-0', 'watcher-1', 'watcher-2'])
+    after = sharding.HashRing(['watcher-0', 'watcher-1', 'watcher-2', 'watcher-3'])
+    moved = [name for name in NAMES if before.owner(name) != after.owner(name)]
+    assert moved
+    assert all(after.owner(name) == 'watcher-3' for name in moved)
+    # Every member gets a fair share
+    counts = { member: sum(after.owner(name) == member for name in NAMES) for member in after.members }
+    assert min(counts.values()) > 20
+
+def test_static_members_split_the_fleet(monkeypatch):
+    owners = []
+    for i in range(3):
+        monkeypatch.setenv('SHARD_ORDINAL', str(i))
+        membership = sharding.Membership(count=3)
+        owners.append({ name for name in NAMES if membership.owns(name) })
+    assert set().union(*owners) == set(NAMES)
+    assert sum(len(o) for o in owners) == len(NAMES)
+
+@pytest.mark.parametrize('hostname, count', [('printwatcher-7d9f8c-x2k4q', 2), ('printwatcher-3', 3)])
+def test_ordinal_outside_the_ring_fails(monkeypatch, hostname, count):
+    monkeypatch.delenv('SHARD_ORDINAL', raising=False)
+    monkeypatch.setenv('HOSTNAME', hostname)
+    with pytest.raises(ValueError):
+        sharding.Membership(count=count)
+
+def test_ordinal_from_statefulset_hostname(monkeypatch):
+    monkeypatch.delenv('SHARD_ORDINAL', raising=False)
+    monkeypatch.setenv('HOSTNAME', 'printwatcher-2')
+    assert sharding.Membership(count=3).me == 'watcher-2'
+
+def test_broker_mode_owns_nothing_until_settled(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(sharding.time, 'monotonic', lambda: clock[0])
+    membership = sharding.Membership(mode='broker', interval=10)
+    channel = FakeChannel()
+    membership.tick(channel)
+    assert not any(membership.owns(name) for name in NAMES)
+
+    membership._heard(None, None, None, json.dumps({ 'member': 'other' }).encode())
+    clock[0] += 15
+    version = membership.version
+    membership._heard(None, None, None, json.dumps({ 'member': 'other' }).encode())
+    membership.tick(channel)
+    assert membership.version > version
+    owned = [name for name in NAMES if membership.owns(name)]
+    assert 0 < len(owned) < len(NAMES)
+
+def test_forwarder_drops_pictures_while_disconnected():
+    channel = FakeChannel(connected=False)
+    forwarder = sharding.ForwardingDispatcher(channel, 'notifications')
+    forwarder.submit('mk4', 'started', picture=lambda: b'jpeg', force=True)
+    assert forwarder.join(timeout=5)
+    channel.connected = True
+    forwarder.submit('mk4', 'ended', picture=b'x' * (sharding.MAXPICTURE + 1), force=True)
+    forwarder.submit('mk4', 'cooling', picture=b'jpeg')
+    assert forwarder.join(timeout=5)
+    pictures = [body['picture'] for body in channel.published]
+    assert pictures == [None, None, 'anBlZw==']
+    assert all(properties.delivery_mode == 2 for _, _, _, properties in channel.messages)
+
+def test_leader_acks_after_sending():
+    dispatcher = FakeDispatcher()
+    leader = sharding.NotificationLeader('notifications', dispatcher)
+    ch = FakeChannel()
+    leader._notify(ch, FakeMethod(7), None, json.dumps({ 'key': 'mk4', 'message': 'ended', 'force': True }).encode())
+    assert ch.acks == []
+    dispatcher.messages[0]['done']()
+    assert ch.acks == [(7, False)]
+
+    leader._notify(ch, FakeMethod(7), None, b'not json')
+    assert ch.acks == [(7, False), (7, False)]
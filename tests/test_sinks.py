@@ -0,0 +1,49 @@
+import pytest
+import sinks
+from conftest import FakeChannel
+
+def test_printer_patterns_and_batching():
+    channel = FakeChannel()
+    sink = sinks.JsonSink(channel, 'out', printers=['mk*'], exclude=['mk3s'], batch=2, wait=60)
+    sink.offer('mini', { 'printstate': 'idle' })
+    sink.offer('mk3s', { 'printstate': 'idle' })
+    sink.offer('mk4', { 'printstate': 'idle' })
+    assert 0 < sink.due() <= 60
+    sink.offer('mk4', { 'printstate': 'printing' })
+    sink.offer('mk3', { 'printstate': 'idle' })
+    assert sink.due() == 0
+    sink.maybeflush()
+    assert channel.published == [{ 'mk3': { 'printstate': 'idle' }, 'mk4': { 'printstate': 'printing' } }]
+    assert sink.due() is None
+
+def test_failed_publish_keeps_the_batch():
+    channel = FakeChannel(failures=1)
+    sink = sinks.JsonSink(channel, 'out', retry=5)
+    sink.offer('mk4', { 'printstate': 'printing' })
+    with pytest.raises(ConnectionError):
+        sink.flush()
+    assert 4 < sink.due() <= 5
+    sink.flush()
+    assert channel.published == [{ 'mk4': { 'printstate': 'printing' } }]
+    assert sink.due() is None
+
+def test_rgb_statusline_of_partial_states():
+    sink = sinks.RgbSink(FakeChannel(), 'out')
+    assert sink.statusline('mk4', { 'printstate': 'printing' }) == "mk4:P 0:00"
+    assert sink.statusline('mk4', { 'printstate': 'printing', 'stillprinting': 3720 }) == "mk4:P 1:02"
+    assert sink.statusline('mk4', { 'printstate': 'idle', 'cooldowntimeout': 'x' }) == "mk4:CD ?"
+    assert sink.statusline('mk4', { 'printstate': 'unknown' }) == ""
+
+def test_senml_pack():
+    channel = FakeChannel()
+    sink = sinks.create(channel, { 'type': 'senml', 'exchange': 'out' })
+    sink.offer('mk4', { 'printstate': 'printing', 'z-height': 2.0, 'temperature': { 'bed': 60 } })
+    sink.flush()
+    pack = channel.published[0]
+    assert pack[0]['bn'] == 'urn:dev:printer:mk4:' and 'bt' in pack[0]
+    assert { record['n']: record.get('v', record.get('vs')) for record in pack } == {
+        'temperature:bed': 60, 'z-height': 0.002, 'printstate': 'printing' }
+
+def test_sink_needs_an_encoder():
+    with pytest.raises(TypeError):
+        sinks.Sink(FakeChannel(), 'out')
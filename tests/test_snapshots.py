@@ -0,0 +1,54 @@
+import threading
+import time
+import snapshots
+
+CAMERA = { 'url': 'http://camera.local/snapshot.jpg' }
+
+def test_concurrent_requests_share_one_capture_and_the_cache(monkeypatch):
+    service = snapshots.SnapshotService(ttl=60, warmup=0)
+    captures = []
+    def capture(config):
+        captures.append(config['url'])
+        time.sleep(0.1)
+        return b'jpeg'
+    monkeypatch.setattr(service, 'capture', capture)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(service.get(CAMERA))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [b'jpeg'] * 8
+    assert service.get(CAMERA) == b'jpeg'
+    assert len(captures) == 1
+
+def test_failed_capture_is_not_cached(monkeypatch):
+    service = snapshots.SnapshotService(ttl=60, warmup=0)
+    answers = iter([None, b'jpeg'])
+    monkeypatch.setattr(service, 'capture', lambda config: next(answers))
+    assert service.get(CAMERA) is None
+    assert service.get(CAMERA) == b'jpeg'
+
+class Controller:
+    def __init__(self) -> None:
+        self.calls = []
+
+    def savestate(self):
+        self.calls.append('save')
+
+    def lights(self, on):
+        self.calls.append('on' if on else 'off')
+
+    def restorestate(self):
+        self.calls.append('restore')
+
+def test_light_window_is_shared():
+    controller = Controller()
+    window = snapshots.LightWindow(controller, warmup=0.05)
+    started = time.monotonic()
+    with window:
+        with window:
+            pass
+        assert controller.calls == ['save', 'on']
+    assert controller.calls == ['save', 'on', 'restore']
+    assert time.monotonic() - started >= 0.05
@@ -0,0 +1,33 @@
+import sys
+import pytest
+import sources
+
+def test_unknown_api():
+    with pytest.raises(ValueError):
+        sources.protocol('nosuchapi')
+
+def test_protocols_are_imported_on_demand():
+    module = sources.protocol('prusalink')
+    assert module.REQUIRED == ('host', 'key')
+    assert 'protocol_prusalink' in sys.modules
+
+def test_polling_source_and_registered_factories(monkeypatch):
+    m = { 'printer': 'mk4', 'api': 'prusalink' }
+    monkeypatch.setattr(sources.protocol('prusalink'), 'poll', lambda m, timeout: { 'printstate': 'idle', 'timeout': timeout })
+    source = sources.create(m).start()
+    assert isinstance(source, sources.PollingSource)
+    assert source.poll(3) == { 'printstate': 'idle', 'timeout': 3 }
+
+    class Pushed(sources.PollingSource):
+        def poll(self, timeout):
+            return { 'printstate': 'printing' }
+    monkeypatch.setitem(sources.factories, 'prusalink', Pushed)
+    assert sources.create(m).poll(3) == { 'printstate': 'printing' }
+
+def test_clients_are_kept_per_printer(monkeypatch):
+    monkeypatch.setattr(sources, 'clients', {})
+    made = []
+    factory = lambda: made.append(1) or object()
+    first = sources.getclient({ 'printer': 'mk4' }, factory)
+    assert sources.getclient({ 'printer': 'mk4' }, factory) is first
+    assert len(made) == 1
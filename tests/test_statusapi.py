@@ -0,0 +1,56 @@
+import http.client
+import pytest
+import statusapi
+
+@pytest.fixture
+def server():
+    cache = statusapi.StatusCache(keepalive=0.2)
+    server = statusapi.serve(cache, 0, '127.0.0.1')
+    yield cache, server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+def request(port, method, path, headers={}):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    connection.request(method, path, headers=headers)
+    response = connection.getresponse()
+    body = response.read()
+    connection.close()
+    return response, body
+
+def test_etag_and_not_modified(server):
+    cache, port = server
+    assert cache.update('mk4', { 'printstate': 'idle' })
+    assert not cache.update('mk4', { 'printstate': 'idle' })
+    response, body = request(port, 'GET', '/printers/mk4')
+    assert response.status == 200 and body == b'{"printstate": "idle"}'
+    tag = response.getheader('ETag')
+    response, body = request(port, 'GET', '/printers/mk4', { 'If-None-Match': tag })
+    assert response.status == 304 and body == b''
+    cache.update('mk4', { 'printstate': 'printing' })
+    response, _ = request(port, 'GET', '/printers/mk4', { 'If-None-Match': tag })
+    assert response.status == 200
+    response, body = request(port, 'GET', '/printers')
+    assert body == b'{"mk4": {"printstate": "printing"}}'
+    assert request(port, 'GET', '/printers/mini')[0].status == 404
+
+def test_head_events_returns_headers_only(server):
+    # Regression: HEAD /events entered the event loop and never returned
+    cache, port = server
+    cache.update('mk4', { 'printstate': 'idle' })
+    response, body = request(port, 'HEAD', '/events')
+    assert response.status == 200
+    assert response.getheader('Content-Type') == 'text/event-stream'
+    assert body == b''
+    assert not cache.subscribers
+
+def test_events_stream(server):
+    cache, port = server
+    cache.update('mk4', { 'printstate': 'idle' })
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    connection.request('GET', '/events')
+    response = connection.getresponse()
+    assert response.readline() == b'event: state\n'
+    assert response.readline().startswith(b'id: ')
+    assert response.readline() == b'data: {"printer": "mk4", "state": {"printstate": "idle"}}\n'
+    connection.close()
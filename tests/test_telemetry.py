@@ -0,0 +1,38 @@
+import time
+from telemetry import TelemetryStore
+
+STATE = { 'temperature': { 'bed': 60.0, 'nozzle': 215.0 }, 'targettemperature': { 'bed': 60, 'nozzle': 215 },
+          'z-height': 1.2, 'progress': 0.5, 'printstate': 'printing' }
+
+def test_rollups(tmp_path):
+    store = TelemetryStore(str(tmp_path / 'telemetry.db'))
+    start = (time.time() // 3600) * 3600 - 3600
+    for i in range(120):
+        store.record('mk4', { **STATE, 'temperature': { 'bed': 60.0 + i % 2, 'nozzle': 215.0 } }, ts=start + i)
+    store.flush()
+    assert len(store.range('mk4', 'bed', start, start + 119)) == 120
+    minutes = store.range('mk4', 'bed', start, start + 119, resolution='1m')
+    assert [(bucket, avg, low, high) for bucket, avg, low, high in minutes] == [(start, 60.5, 60.0, 61.0), (start + 60, 60.5, 60.0, 61.0)]
+    assert store.aggregate('mk4', 'nozzle', start, start + 119, resolution='1h')['count'] == 120
+
+def test_retention_uses_the_age_index_and_runs_per_interval(tmp_path):
+    store = TelemetryStore(str(tmp_path / 'telemetry.db'), retention={ 'raw': 60 }, pruneinterval=3600)
+    plan = " ".join(row[-1] for row in store.db.execute("EXPLAIN QUERY PLAN DELETE FROM raw WHERE ts < 1"))
+    assert 'raw_age' in plan
+
+    now = time.time()
+    store.record('mk4', STATE, ts=now - 120)
+    store.flush()
+    # Pruned on the first flush only; the next one comes an interval later
+    assert store.range('mk4', 'bed', now - 300) == []
+    store.record('mk4', STATE, ts=now - 120)
+    store.flush()
+    assert len(store.range('mk4', 'bed', now - 300)) == 1
+
+def test_close_writes_buffered_samples(tmp_path):
+    path = str(tmp_path / 'telemetry.db')
+    store = TelemetryStore(path, flushinterval=3600)
+    store.record('mk4', STATE)
+    store.maybeflush()
+    store.close()
+    assert len(TelemetryStore(path).range('mk4', 'bed', time.time() - 60)) == 1
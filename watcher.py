@@ -1,61 +1,56 @@
 #!/bin/env -S python -u
 
 import os
-import yaml
+import signal
+import sys
 import time
 from datetime import datetime, timedelta, date
-from prusalink import prusalink
-import requests
 import textwrap
-import octorest
-import traceback
-import lights
-import pika
-import json
-from dotenv import load_dotenv
-
-load_dotenv()
-
-apiToken = os.getenv('APITOKEN')
-chatID = os.getenv('CHATID')
-apiURL = f'https://api.telegram.org/bot{apiToken}/sendMessage'
-pictureURL = f'https://api.telegram.org/bot{apiToken}/sendPhoto'
-
-mqrabbit_user = os.getenv("MQRABBIT_USER")
-mqrabbit_password = os.getenv("MQRABBIT_PASSWORD")
-mqrabbit_host = os.getenv("MQRABBIT_HOST")
-mqrabbit_vhost = os.getenv("MQRABBIT_VHOST", "/")
-mqrabbit_port = os.getenv("MQRABBIT_PORT")
-mqrabbit_exchange = os.getenv("MQRABBIT_EXCHANGE")
-
-mqrabbit_credentials = pika.PlainCredentials(mqrabbit_user, mqrabbit_password)
-
-mqparameters = pika.ConnectionParameters(
-    host=mqrabbit_host,
-    virtual_host=mqrabbit_vhost,
-    port=mqrabbit_port,
-    credentials=mqrabbit_credentials)
-
-mqconnection = pika.BlockingConnection(mqparameters)
-channel = mqconnection.channel()
-channel.exchange_declare(exchange=mqrabbit_exchange, exchange_type='fanout')
-
-def sendmessage(message, picture=None):
-    print(f"apitoken = [{apiToken}]. chatid = [{chatID}]. apiUrl = [{apiURL}].")
-    if picture:
-        response = requests.post(pictureURL, params={
-            'chat_id': chatID, 
-            'parse_mode': "HTML",
-            'caption': message },
-            files={'photo': picture}
-            )
-    else:
-        response = requests.post(apiURL, json={
-            'chat_id': chatID, 
-            'parse_mode': "HTML",
-            'text': message }
-            )
-    print(f"response = [{response.text}]")
+import logging
+import logsetup
+import metrics
+import argparse
+import concurrent.futures
+import config
+import sources
+from scheduler import PollScheduler
+from publisher import DeltaPublisher
+
+"""
+Importing this module has no side effects: protocols are imported when a configured printer needs
+them, and the optional features, the Telegram dispatcher and the broker connection are only set up
+by main() once the settings have been validated.
+"""
+
+log = logging.getLogger('watcher')
+
+apiToken = None
+chatID = None
+telegramURL = None
+mqrabbit_exchange = None
+
+channel = None
+dispatcher = None
+publisher = None
+telemetry = None
+checkpoint = None
+snapshotservice = None
+membership = None
+digest = None
+jobqueue = None
+statuscache = None
+detector = None
+recorder = None
+
+# Wall clock of the state machine; replay.py swaps in a virtual one
+clock = datetime.now
+
+# Printers this replica just took over from another one; their first answer is adopted silently
+adopting = set()
+
+def sendmessage(message, picture=None, key=None, force=False):
+    """Hand the message to the background dispatcher; `picture` may be a callable producing the image."""
+    dispatcher.submit(key, message, picture=picture, force=force)
 
 def jsonserializer(obj):
     """JSON serializer for objects not serializable by default json code"""
@@ -64,38 +59,6 @@ def jsonserializer(obj):
         return obj.isoformat()
     raise TypeError ("Type %s not serializable" % type(obj))
 
-class safedict(dict):
-    def __getitem__(self, __key):
-        #print(f"Getting: [{__key}] {len(__key)} {type(__key)}")
-        #print(isinstance(__key,tuple))
-        if isinstance(__key,tuple):
-            try:
-                val = super().__getitem__(__key[0])
-                if isinstance(val, dict):
-                    return safedict(dict)
-                else:
-                    return super().__getitem__(__key[0])
-            except:
-                return __key[1]
-        else:
-            try:
-                val = super().__getitem__(__key)
-                if val is None:
-                    return safedict()
-                else:
-                    if isinstance(val,dict):
-                        return safedict(val)
-                    else:
-                        return val
-            except:
-                return safedict()
-        
-    def __str__(self) -> str:
-        return super().__str__() if len(self) else "None"
-    
-    def __repr__(self) -> str:
-        return super().__repr__() if len(self) else "None"
-
 def formatsecondduration(d):
     sec = d % 60
     minleft = d // 60
@@ -103,127 +66,38 @@ def formatsecondduration(d):
     hrs = minleft // 60
     return f"{hrs}:{min:02}:{sec:02}"
 
-def debuglog(state):
-    with open("debuglog", "a") as logfile:
-        print(f"{datetime.now()}: {state}", file=logfile)
-
-def protocol_prusalink(printerinfo, timeout=30):
-    host = printerinfo['host']
-    key = printerinfo['key']
-    try:
-        prusa = prusalink(host, key, port=80, timeout=timeout)
-        printer = safedict(prusa.get_printer().json())
-        job = safedict(prusa.get_job().json())
-    
-        debuglog( { 'printer': printer, 'job': job })
-        print(f"printer = {printer}\njob = {job}")
-
-        print(f"jobsprogress = {job['progress']} [{type(job)}] [{type(job['progress'])}]")
-        state = {
-            'printstate': 'printing' if job['state'] == 'Printing' else 'idle',
-            'temperature': {
-                'bed': printer['telemetry']['temp-bed'],
-                'nozzle': printer['telemetry']['temp-nozzle'],
-            },
-            'targettemperature': {
-                'bed': printer['temperature']['bed']['target'],
-                'nozzle': printer['temperature']['tool0']['target'],
-            },
-            'z-height': printer['telemetry']['z-height'],
-            'fulljobtime': job['job']['estimatedPrintTime'],
-            'alreadyprinted': job['progress']['printTime', 0],
-            'stillprinting': job['progress']['printTimeLeft', 0],
-            'progress': job['progress']['completion', 0],
-            'jobname': job['job']['file']['name','Unknown'],
-        }
-    except requests.exceptions.ConnectionError:
-        state = {
-            'printstate': 'unknown',
-        }
-
-    return state
-
-def protocol_octoprint(printerinfo):
-    def getlayerplugindata(client):
-        layer = f"{client.url}/plugin/DisplayLayerProgress/values"
-        session = client.__dict__['session']
-        
-        r = requests.get(headers=session.headers, url=layer)
-        return r.json()
-
-    url = printerinfo['url']
-    key = printerinfo['key']
-
-    try:
-        client = octorest.OctoRest(url=url, apikey=key)
-
-        cinfo = client.connection_info()
-        print(cinfo)
-
-        job =  safedict(client.job_info())
-        print(f"job = {job}")
+def debuglog(message, data=None):
+    logsetup.debuglog(log, message, data)
 
-        printer = safedict(client.printer())
-        print(f"printer = {printer}")
+# One source per printer, created on first use or by main() with a scheduler to wake
+printersources = {}
 
-        print(f"printerinfo = {printerinfo}")
-        zheight = "unknown"
-        if 'layerplugin' in printerinfo and printerinfo['layerplugin']:
-            print("Getting layer info")
-            data = getlayerplugindata(client=client)
-            print(f"Got layerinfo {data}")
-            try:
-                zheight = f"{data['height']['current']} ({data['layer']['current']}/{data['layer']['total']})"
-            except:
-                try:
-                    zheight = f"{data['height']['current']}"
-                except:
-                    pass
+def getsource(m, wake=None):
+    source = printersources.get(m['printer'])
+    if source is None:
+        source = sources.create(m, wake).start()
+        printersources[m['printer']] = source
+    return source
 
-        try:
-            printTime = job['progress']['printTime']
-        except:
-            printTime = 0
+def dropsource(name):
+    source = printersources.pop(name, None)
+    if source:
+        source.stop()
 
-        try:
-            printTimeLeft = int(job['progress']['printTimeLeft'])
-        except:
-            printTimeLeft = 0
-
-        state = {
-            'printstate': 'printing' if printer['state']['flags']['printing'] else 'idle',
-            'temperature': {
-                'bed': printer['temperature']['bed']['actual'],
-                'nozzle': printer['temperature']['tool0']['actual'],
-            },
-            'targettemperature': {
-                'bed': printer['temperature']['bed']['target'],
-                'nozzle': printer['temperature']['tool0']['target'],
-            },
-            'z-height': zheight,
-            'fulljobtime': printTime + printTimeLeft,
-            'alreadyprinted': printTime,
-            'stillprinting': printTimeLeft,
-            'progress': job['progress']['completion', 0]/100,
-            'jobname': job['job']['file']['name','Unknown'],
-        }
-    except Exception as exc:
-        #print(traceback.format_exc())
-        #print(exc)
-        state = {
-            'printstate': 'unknown',
-        }
-    return state
-
-def init_states(settings):
+def init_states(settings, checkpoint=None):
     state = {}
     for m in settings:
-        state[m['printer']] = { 'printstate': 'idle', 'lastsend': datetime.now() - timedelta(days=1) }
+        state[m['printer']] = { 'printstate': 'idle', 'lastsend': clock() - timedelta(days=1) }
+        if checkpoint:
+            restored = checkpoint.load(m['printer'])
+            if restored:
+                log.info("Restored state of %s: %s", m['printer'], restored['printstate'])
+                state[m['printer']].update(restored)
 
-    return safedict(state)
+    return state
 
 def processtimes(status):
-    _now = datetime.now()
+    _now = clock()
 
     if 'stillprinting' in status:
         status['time_finished'] = (_now + timedelta(seconds=status['stillprinting'])).strftime('%H:%M')
@@ -232,131 +106,464 @@ def processtimes(status):
         status['time_started'] = (_now - timedelta(seconds=status['alreadyprinted'])).strftime('%H:%M')
 
 def statusmessage(headerline,status):
+    # A state restored from a checkpoint, or an 'unknown' poll, carries only part of the fields
     processtimes(status)
-    if 'stillprinting' not in status or status['stillprinting'] == 0:
+    temperature = status.get('temperature') or {}
+    target = status.get('targettemperature') or {}
+    progress = status.get('progress') or 0
+    if not status.get('stillprinting'):
         finishmessage = "-- Unknown --"
     else:
         finishmessage = f"{status['time_finished']} ({formatsecondduration(status['stillprinting'])} from now)"
     return textwrap.dedent(f"""
         <b>{headerline}</b>
         <pre>
-        Printjob:    {status['jobname']}
-        Z-Height:    {status['z-height']}
-        % done:      {status['progress']*100:.1f}
+        Printjob:    {status.get('jobname', 'Unknown')}
+        Z-Height:    {status.get('z-height', '-')}
+        % done:      {progress*100:.1f}
         time to end: {finishmessage}
-        Start time:  {status['time_started']} ({formatsecondduration(status['alreadyprinted'])} ago)
-        Nozzle temp: {status['temperature']['nozzle']}\U000000B0 / {status['targettemperature']['nozzle']}\U000000B0
-        Bed temp:    {status['temperature']['bed']}\U000000B0 / {status['targettemperature']['bed']}\U000000B0
+        Start time:  {status.get('time_started', '-')} ({formatsecondduration(status.get('alreadyprinted') or 0)} ago)
+        Nozzle temp: {temperature.get('nozzle', '-')}\U000000B0 / {target.get('nozzle', '-')}\U000000B0
+        Bed temp:    {temperature.get('bed', '-')}\U000000B0 / {target.get('bed', '-')}\U000000B0
         </pre>
     """)
 
 def picturethis(config):
-    print(f"Making picture using {config}")
-    controller = None
-    if 'lights' in config:
-        controller_ = getattr(lights,config['lights']['controller'])
-        controller = controller_(config['lights']['arguments'])
-
-        controller.savestate()
-        controller.lights(True)
+    return snapshotservice.get(config)
+
+def handle_state(state, m, handleroutput, globalsettings):
+    limit = m['statusinterval']
+
+    if recorder:
+        recorder.record(m['printer'], handleroutput)
+    laststate = state[m['printer']]
+    if m['printer'] in adopting and handleroutput.get('printstate', 'unknown') != 'unknown':
+        # The previous owner already announced whatever this printer is doing
+        adopting.discard(m['printer'])
+        laststate = { **laststate, 'printstate': handleroutput['printstate'] }
+    currentstate = laststate.copy()
+    currentstate.update(handleroutput)
+    if currentstate['printstate'] == 'unknown':
+        metrics.unknown_states.labels(m['printer']).inc()
+    debuglog(f"Current state of {m['printer']}", currentstate)
+
+    log.debug("%s: current printstate: [%s]. previous printstate: [%s]", m['printer'], currentstate['printstate'], laststate['printstate'])
+    forcemessage = False
+    allowmessage = True
+
+    if currentstate['printstate'] == 'printing' and laststate['printstate'] == 'printing':    
+        log.info("outputting ongoing print job %s", m['printer'])
+        message = statusmessage(f"Printjob in progress on {m['printer']}", currentstate)
+    elif currentstate['printstate'] == 'printing' and laststate['printstate'] != 'printing':
+        forcemessage = True
+        log.info("outputting start of print job %s", m['printer'])
+        message = statusmessage(f"Printjob started on {m['printer']}", currentstate)
+    elif currentstate['printstate'] != 'printing' and laststate['printstate'] == 'printing':
+        forcemessage = True
+        log.info("outputting end of print job %s", m['printer'])
+        message = statusmessage(f"Printjob ended on {m['printer']}", currentstate)
+        currentstate['cooldowntimeout'] = clock() + timedelta(seconds=globalsettings['cooldowntimeout'])
+    elif (currentstate['printstate'] == 'idle' and laststate['printstate'] == 'idle' and 'cooldowntimeout' in currentstate):
+        message = statusmessage(f"Cooling down on {m['printer']}", currentstate)
+        bed = (currentstate.get('temperature') or {}).get('bed')
+        if currentstate['cooldowntimeout'] < clock() or (bed is not None and bed < globalsettings['cooldowntemperature']):
+            del currentstate['cooldowntimeout']
+            message = statusmessage(f"Final cool down on {m['printer']}", currentstate)
+            forcemessage = True
+    else:
+        log.debug("no messaging needed but do publish!")
+        allowmessage = False
 
-    time.sleep(1)
-    snapshoturl = config['url']
-    response = requests.get(snapshoturl)
+    try:
+        timesincelastmessage = (clock() - laststate['lastsend']).total_seconds()
+    except Exception:
+        timesincelastmessage = -1
+
+    laststate = currentstate
+    log.debug("Time since last: %s", timesincelastmessage)
+    if detector:
+        for kind, alert, started in detector.observe(m, laststate):
+            picture = (lambda: picturethis(m['camera'])) if started and 'camera' in m else None
+            try:
+                sendmessage(message=alert, picture=picture, key=f"{m['printer']}:{kind}", force=True)
+            except Exception as exc:
+                log.exception(exc)
+    if digest:
+        digest.update(m, laststate)
+        # Only transitions are sent per printer, routine updates go into the digest
+        allowmessage = allowmessage and forcemessage
+    if allowmessage:
+        if forcemessage or timesincelastmessage > limit:
+            picture = None
+            if 'camera' in m:
+                log.debug("Need to take a picture")
+                picture = lambda: picturethis(m['camera'])
+            else:
+                log.debug("No camera defined")
 
-    content = None
-    if response.status_code == 200:
-        content = response.content
-    if controller:
-        controller.restorestate()
+            try:
+                sendmessage(message=message, picture=picture, key=m['printer'], force=forcemessage)
+                laststate['lastsend'] = clock()
+            except Exception as exc:
+                log.exception(exc)
+
+    if jobqueue and m['api'] == 'prusalink':
+        jobqueue.observe(m, laststate)
+
+    publisher.update(m['printer'], laststate)
+    if statuscache:
+        statuscache.update(m['printer'], laststate)
+    if telemetry:
+        telemetry.record(m['printer'], laststate)
+    if checkpoint:
+        try:
+            checkpoint.update(m['printer'], laststate)
+        except OSError as exc:
+            log.warning("Could not checkpoint %s: %s", m['printer'], exc)
 
-    return content
+    state[m['printer']] = laststate
 
-def main_loop(state, settings, globalsettings):
+def safe_handle_state(state, m, handleroutput, globalsettings):
+    """handle_state for one printer of a cycle; a printer that trips it must not stop the others."""
+    try:
+        handle_state(state, m, handleroutput, globalsettings)
+    except Exception:
+        log.exception("Handling the state of %s failed", m['printer'])
+
+def poll(m, timeout):
+    with metrics.poll_seconds.labels(m['api']).time():
+        return getsource(m).poll(timeout)
+
+def main_loop(state, settings, globalsettings, executor, workers=None):
+    """Poll all printers concurrently and handle the results as they come in.
+
+    Each poll is bounded by its HTTP requests: `polltimeout` seconds per attempt, and with the
+    connect retries of the sessions (retries + 1) attempts. Every answer that arrives within the
+    cycle is used, however long it took. The whole cycle gets `cycletimeout` seconds, by default
+    enough for every printer to use its full budget in turn on `workers` threads; a printer that
+    has not answered by then keeps its last known state until the next cycle.
+    """
+    # Protocol modules, and with them sessions, are only imported once there are printers to poll
+    import sessions
+    polltimeout = globalsettings.get('polltimeout', 30)
+    pollbudget = polltimeout * (sessions.RETRIES + 1)
+    rounds = -(-len(settings) // (workers or len(settings) or 1))
+    deadline = time.monotonic() + globalsettings.get('cycletimeout', rounds * pollbudget + 5)
+
+    started = time.monotonic()
+    futures = {}
     for m in settings:
-        print(f"Doing {m['printer']}")
-        handler = f"protocol_{m['api']}"
-        handler = globals()[handler]
-        limit = m['statusinterval']
-
-        laststate = state[m['printer']]
-        currentstate = laststate.copy()
-        handleroutput = handler(m)
-        currentstate.update(handleroutput)
-        print(f"Current state: {currentstate}")
-        debuglog(f"Current state: {currentstate}")
-
-        print(f"current printstate: [{currentstate['printstate']}]. previous printstate: [{laststate['printstate']}]")
-        forcemessage = False
-        allowmessage = True
-
-        if currentstate['printstate'] == 'printing' and laststate['printstate'] == 'printing':    
-            print("outputting ongoing print job")
-            message = statusmessage(f"Printjob in progress on {m['printer']}", currentstate)
-        elif currentstate['printstate'] == 'printing' and laststate['printstate'] != 'printing':
-            forcemessage = True
-            print(f"outputting start of print job {m['printer']}")
-            message = statusmessage(f"Printjob started on {m['printer']}", currentstate)
-        elif currentstate['printstate'] != 'printing' and laststate['printstate'] == 'printing':
-            forcemessage = True
-            print(f"outputting end of print job {m['printer']}")
-            message = statusmessage(f"Printjob ended on {m['printer']}", currentstate)
-            currentstate['cooldowntimeout'] = datetime.now() + timedelta(seconds=globalsettings['cooldowntimeout'])
-        elif (currentstate['printstate'] == 'idle' and laststate['printstate'] == 'idle' and 'cooldowntimeout' in currentstate):
-            message = statusmessage(f"Cooling down on {m['printer']}", currentstate)
-            if currentstate['cooldowntimeout'] < datetime.now() or currentstate['temperature']['bed'] < globalsettings['cooldowntemperature']:
-                del currentstate['cooldowntimeout']
-                message = statusmessage(f"Final cool down on {m['printer']}", currentstate)
-                forcemessage = True
-        else:
-            print("no messaging needed but do publish!")
-            allowmessage = False
+        log.debug("Doing %s", m['printer'])
+        futures[executor.submit(poll, m, polltimeout)] = m
 
-        try:
-            timesincelastmessage = (datetime.now() - laststate['lastsend']).total_seconds()
-        except Exception as exc:
-            timesincelastmessage = -1
-
-        laststate = currentstate
-        print(f"Time since last: {timesincelastmessage}")
-        if allowmessage:
-            if forcemessage or timesincelastmessage > limit:
-                picture = None
-                try:
-                    if 'camera' in m:
-                        print("Need to take a picture")
-                        picture = picturethis(m['camera'])
-                    else:
-                        print("No camera defined")
-                except:
-                    print("error making picture")
-
-                try:
-                    sendmessage(message=message, picture=picture)
-                    laststate['lastsend'] = datetime.now()
-                except Exception as exc:
-                    print(traceback.format_exc())
-                    print(exc)
-
-        channel.basic_publish(exchange=mqrabbit_exchange, routing_key='', body=json.dumps({ 'machine': m, 'state': laststate}, default=jsonserializer))
-
-        state[m['printer']] = laststate
+    pending = set(futures)
+    try:
+        for future in concurrent.futures.as_completed(futures, timeout=max(0, deadline - time.monotonic())):
+            pending.discard(future)
+            m = futures[future]
+            try:
+                handleroutput = future.result()
+            except Exception as exc:
+                log.warning("Polling %s failed: %s", m['printer'], exc)
+                # Protocol modules are imported lazily, and all of them talk HTTP through requests
+                import requests
+                if isinstance(exc, requests.exceptions.Timeout):
+                    metrics.timeouts.labels(m['printer']).inc()
+                handleroutput = { 'printstate': 'unknown' }
+            safe_handle_state(state, m, handleroutput, globalsettings)
+    except concurrent.futures.TimeoutError:
+        log.warning("Cycle deadline passed with %d printer(s) still pending", len(pending))
+
+    for future in pending:
+        future.cancel()
+        m = futures[future]
+        # A late answer says nothing about the printer; ending its print job over it would be wrong
+        log.warning("%s did not answer before the cycle deadline, keeping its last state", m['printer'])
+        metrics.timeouts.labels(m['printer']).inc()
+
+    if recorder:
+        recorder.endcycle()
 
+    try:
+        publisher.flush()
+        if telemetry:
+            telemetry.maybeflush()
+    except Exception as exc:
+        log.exception(exc)
+
+    metrics.cycle_seconds.observe(time.monotonic() - started)
+    log.info("Cycle took %.2f seconds", time.monotonic() - started)
+
+def rebalance(pollscheduler, printers):
+    """Start polling the printers this replica owns now and stop polling the ones it lost."""
+    for m in printers:
+        owned = membership.owns(m['printer'])
+        if owned and m['printer'] not in pollscheduler.printers:
+            log.info("Taking over %s", m['printer'])
+            adopting.add(m['printer'])
+            pollscheduler.add(m)
+            getsource(m, wake=pollscheduler.pollsoon)
+        elif not owned and m['printer'] in pollscheduler.printers:
+            log.info("Handing over %s", m['printer'])
+            pollscheduler.remove(m['printer'])
+            adopting.discard(m['printer'])
+            publisher.forget(m['printer'])
+            dropsource(m['printer'])
+            if statuscache:
+                statuscache.remove(m['printer'])
+            if detector:
+                detector.forget(m['printer'])
+            if digest:
+                digest.remove(m['printer'])
+def reload(settings, newsettings, state, pollscheduler):
+    """Apply changed settings in place: only added, removed and changed printers are touched."""
+    added, removed, changed = config.diffprinters(settings['printers'], newsettings['printers'])
+    for m in removed:
+        log.info("Removing %s", m['printer'])
+        pollscheduler.remove(m['printer'])
+        dropsource(m['printer'])
+        sources.clients.pop(m['printer'], None)
+        publisher.forget(m['printer'])
+        adopting.discard(m['printer'])
+        state.pop(m['printer'], None)
+        if statuscache:
+            statuscache.remove(m['printer'])
+        if detector:
+            detector.forget(m['printer'])
+        if digest:
+            digest.remove(m['printer'])
+        if checkpoint:
+            checkpoint.remove(m['printer'])
+    for m in changed:
+        # New connection details need a new client; the state of the printer is kept
+        log.info("Updating %s", m['printer'])
+        dropsource(m['printer'])
+        sources.clients.pop(m['printer'], None)
+        if m['printer'] in pollscheduler.printers:
+            pollscheduler.add(m)
+            getsource(m, wake=pollscheduler.pollsoon)
+    for m in added:
+        log.info("Adding %s", m['printer'])
+        state.update(init_states(settings=[m], checkpoint=checkpoint))
+        if membership is None or membership.owns(m['printer']):
+            pollscheduler.add(m)
+            getsource(m, wake=pollscheduler.pollsoon)
+
+    # Everybody holds on to the same settings dict, so update it rather than replace it
+    settings['settings'].clear()
+    settings['settings'].update(newsettings['settings'])
+    settings['printers'] = newsettings['printers']
+
+def checksettings(settings):
+    """Everything main() needs before it connects to anything; returns a list of problems."""
+    problems = []
+    for key in ('interval', 'cooldowntimeout', 'cooldowntemperature'):
+        if key not in settings['settings']:
+            problems.append(f"settings: missing '{key}'")
+    for i, m in enumerate(settings['printers']):
+        name = m.get('printer') or f"printer #{i + 1}"
+        for key in ('printer', 'api', 'statusinterval'):
+            if key not in m:
+                problems.append(f"{name}: missing '{key}'")
+        if 'api' not in m:
+            continue
+        try:
+            module = sources.protocol(m['api'])
+        except ImportError as exc:
+            problems.append(f"{name}: api '{m['api']}' needs a module that is not installed: {exc}")
+            continue
+        except ValueError as exc:
+            problems.append(f"{name}: {exc}")
+            continue
+        for key in module.REQUIRED:
+            if key not in m:
+                problems.append(f"{name}: missing '{key}' for api '{m['api']}'")
+    for variable in ('APITOKEN', 'CHATID', 'MQRABBIT_EXCHANGE', 'MQRABBIT_HOST'):
+        if not os.getenv(variable):
+            problems.append(f"environment: {variable} is not set")
+    return problems
 
 def main():
-    print(f"Opening {os.getenv('INPUTFILE')}")
-    with open(os.getenv('INPUTFILE'),"r") as settingsfile:
-        settings = yaml.safe_load(settingsfile)
-
-    print(f"Settings: {settings}")
-
-    state=init_states(settings=settings['printers'])
-
-    while True:
-        main_loop(state=state, settings=settings['printers'], globalsettings=settings['settings'])
-        print(f"state is now {state}")
-        print(f"Sleeping for {settings['settings']['interval']} seconds")
-        time.sleep(settings['settings']['interval'])
+    parser = argparse.ArgumentParser(description="Watch printers and report on Telegram and the exchange.")
+    parser.add_argument('--check-config', action='store_true',
+                        help="validate the settings file and environment, then exit without connecting to anything")
+    args = parser.parse_args()
+
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    global apiToken, chatID, telegramURL, mqrabbit_exchange
+    apiToken = os.getenv('APITOKEN')
+    chatID = os.getenv('CHATID')
+    telegramURL = os.getenv('TELEGRAMURL', 'https://api.telegram.org')
+    mqrabbit_exchange = os.getenv('MQRABBIT_EXCHANGE')
+
+    path = os.getenv('INPUTFILE')
+    if not path:
+        print("INPUTFILE is not set")
+        raise SystemExit(1)
+    print(f"Opening {path}")
+    try:
+        settings = config.load(path)
+    except (OSError, ValueError) as exc:
+        print(f"Cannot load settings from {path}: {exc}")
+        raise SystemExit(1)
+    problems = checksettings(settings)
+    for problem in problems:
+        print(problem)
+    if args.check_config:
+        print(f"{len(settings['printers'])} printer(s), {len(problems)} problem(s)")
+        raise SystemExit(1 if problems else 0)
+    if problems:
+        raise SystemExit(1)
+
+    logsetup.setup(settings['settings'].get('logging'))
+    metrics.serve(settings['settings'].get('metrics', {}).get('port'))
+    log.debug("Settings", extra={ 'data': settings })
+
+    # The broker only now: a settings file that does not validate never opens a connection
+    from amqp import AmqpConnection
+    global channel
+    channel = AmqpConnection().exchange_declare(mqrabbit_exchange)
+
+    from notifier import TelegramDispatcher
+    global dispatcher
+    dispatcher = TelegramDispatcher(apiToken, chatID, apiurl=telegramURL,
+                                    workers=settings['settings'].get('notifyworkers', 2),
+                                    batchwindow=settings['settings'].get('batchwindow', 2))
+
+    global membership
+    if 'sharding' in settings['settings']:
+        from sharding import Membership, NotificationLeader, ForwardingDispatcher
+        shardsettings = settings['settings']['sharding']
+        try:
+            membership = Membership(mode=shardsettings.get('mode', 'static'),
+                                    count=int(os.getenv('SHARD_COUNT', shardsettings.get('count', 1))),
+                                    exchange=shardsettings.get('exchange', 'printwatcher_members'),
+                                    interval=shardsettings.get('interval', 10))
+        except ValueError as exc:
+            log.error("Cannot shard: %s", exc)
+            raise SystemExit(1)
+        channel.onconnect(membership.setup)
+        # Only the replica holding the notification queue talks to Telegram
+        notifyqueue = shardsettings.get('notifyqueue', 'printwatcher_notifications')
+        channel.onconnect(NotificationLeader(notifyqueue, dispatcher).setup)
+        dispatcher = ForwardingDispatcher(channel, notifyqueue)
+
+    global publisher
+    publishsettings = settings['settings'].get('publish', {})
+    publisher = DeltaPublisher(channel, mqrabbit_exchange,
+                               heartbeat=publishsettings.get('heartbeat', 300),
+                               tolerance=publishsettings.get('tolerance'),
+                               batch=publishsettings.get('batch', True),
+                               confirm=publishsettings.get('confirm', True),
+                               default=jsonserializer)
+    channel.outboxsize = publishsettings.get('outboxsize', channel.outboxsize)
+    channel.onresync(publisher.resync).start()
+
+    global telemetry
+    if 'telemetry' in settings['settings']:
+        from telemetry import TelemetryStore
+        telemetrysettings = settings['settings']['telemetry']
+        telemetry = TelemetryStore(telemetrysettings.get('path', 'telemetry.db'),
+                                   flushinterval=telemetrysettings.get('flushinterval', 60),
+                                   retention=telemetrysettings.get('retention'),
+                                   pruneinterval=telemetrysettings.get('pruneinterval', 3600))
+
+    from snapshots import SnapshotService
+    global snapshotservice
+    snapshotsettings = settings['settings'].get('snapshots', {})
+    snapshotservice = SnapshotService(ttl=snapshotsettings.get('ttl', 10),
+                                      warmup=snapshotsettings.get('warmup', 1),
+                                      maxwidth=snapshotsettings.get('maxwidth'),
+                                      quality=snapshotsettings.get('quality'))
+
+    global digest
+    if 'digest' in settings['settings']:
+        from digest import FleetDigest
+        digestsettings = settings['settings']['digest'] or {}
+        digest = FleetDigest(interval=digestsettings.get('interval', 600),
+                             contactsheet=digestsettings.get('contactsheet', False),
+                             columns=digestsettings.get('columns', 3),
+                             thumbwidth=digestsettings.get('thumbwidth', 320),
+                             snapshot=picturethis,
+                             shard=membership.me if membership else None)
+
+    global statuscache
+    if 'statusapi' in settings['settings']:
+        import statusapi
+        apisettings = settings['settings']['statusapi']
+        statuscache = statusapi.StatusCache(default=jsonserializer, keepalive=apisettings.get('keepalive', 15))
+        statusapi.serve(statuscache, apisettings.get('port', 8080), apisettings.get('address', ''))
+
+    global detector
+    if 'anomaly' in settings['settings']:
+        from anomaly import AnomalyDetector
+        detector = AnomalyDetector(settings['settings']['anomaly'])
+
+    global recorder
+    if 'record' in settings['settings']:
+        from recording import Recorder
+        recorder = Recorder(settings['settings']['record'].get('path', 'recording.jsonl.gz'))
+
+    global jobqueue
+    if 'jobs' in settings['settings']:
+        from jobs import JobDispatcher, PrintQueue
+        jobsettings = settings['settings']['jobs']
+        jobqueue = PrintQueue(JobDispatcher(sources.protocol('prusalink').client,
+                                            concurrency=jobsettings.get('concurrency', 4)),
+                              jobsettings.get('directory', 'jobs'),
+                              autostart=jobsettings.get('autostart', False))
+
+    global checkpoint
+    if 'checkpoint' in settings['settings']:
+        from checkpoint import StateCheckpoint
+        checkpoint = StateCheckpoint(settings['settings']['checkpoint'].get('path', 'state'))
+
+    state=init_states(settings=settings['printers'], checkpoint=checkpoint)
+    workers = settings['settings'].get('workers', min(32, len(settings['printers'])) or 1)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='poller')
+
+    owned = [m for m in settings['printers'] if membership is None or membership.owns(m['printer'])]
+    pollscheduler = PollScheduler(owned, settings['settings'])
+    ringversion = membership.version if membership else 0
+    for m in owned:
+        getsource(m, wake=pollscheduler.pollsoon)
+
+    configwatcher = config.ConfigWatcher(path, validate=checksettings)
+
+    # Kubernetes stops the pod with SIGTERM; as SystemExit it runs the cleanup below
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            newsettings = configwatcher.changed()
+            if newsettings:
+                reload(settings, newsettings, state, pollscheduler)
+            if membership:
+                membership.tick(channel)
+                if membership.version != ringversion:
+                    ringversion = membership.version
+                    rebalance(pollscheduler, settings['printers'])
+            due = pollscheduler.due()
+            if due:
+                main_loop(state=state, settings=due, globalsettings=settings['settings'], executor=executor, workers=workers)
+                for m in due:
+                    pollscheduler.reschedule(m, state[m['printer']])
+                    if detector and detector.active(m['printer']):
+                        # Keep a close eye on a printer that looks like it is in trouble
+                        pollscheduler.pollsoon(m['printer'], detector.config(m)['fastpoll'])
+                debuglog("State", state)
+            if digest:
+                digest.maybesend(sendmessage)
+            wait = min(pollscheduler.wait(), settings['settings'].get('reloadinterval', 10))
+            if membership:
+                wait = min(wait, membership.interval)
+            log.debug("Sleeping for %.1f seconds", wait)
+            pollscheduler.sleep(wait)
+    finally:
+        if telemetry:
+            # The samples buffered since the last flush
+            telemetry.close()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file